@@ -3,15 +3,67 @@ Flask backend for the AI Python Teacher application.
 
 This module provides the REST API endpoints for the tutoring service.
 """
+import functools
+import json
+import math
 import os
+import time
 import uuid
-from typing import Any, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 from flask_cors import CORS
 
-from config import CORS_ORIGINS, logger
-from gemini_ai import build_tutor_prompt, generate_response, sanitize_tutor_output
+import faq
+import fingerprint
+import idempotency
+import metrics
+import server_timing
+from cache import SingleFlight, build_cache_key
+from compaction import compact_fields
+from config import (
+    ADMISSION_MAX_CONCURRENT,
+    ADMISSION_MAX_QUEUE,
+    ADMISSION_MAX_WAIT_S,
+    BATCH_MAX_ITEMS,
+    BATCH_MAX_PARALLEL,
+    CORS_ORIGINS,
+    GEMINI_MODEL,
+    IDEMPOTENCY_ENABLED,
+    IDEMPOTENCY_MAX_ENTRIES,
+    IDEMPOTENCY_TTL_S,
+    METRICS_ENABLED,
+    RATE_LIMIT_API_KEYS,
+    RATE_LIMIT_CLIENT_BURST,
+    RATE_LIMIT_CLIENT_RPS,
+    RATE_LIMIT_ENABLED,
+    RATE_LIMIT_GLOBAL_BURST,
+    RATE_LIMIT_GLOBAL_RPS,
+    RATE_LIMIT_MAX_CLIENTS,
+    RATE_LIMIT_PROXY_HOPS,
+    RATE_LIMIT_TRUST_PROXY,
+    SERVER_TIMING_ENABLED,
+    logger,
+)
+from gemini_ai import (
+    GENERATION_CONFIG,
+    PROMPT_TEMPLATE_VERSION,
+    TUTOR_SYSTEM_INSTRUCTION,
+    StreamingSanitizer,
+    build_tutor_prompt,
+    generate_response,
+    sanitize_tutor_output,
+    stream_response,
+    tutor_context,
+    upstream_breaker,
+    upstream_hedging,
+)
+from persistent_cache import open_response_cache
+from ratelimit import RateLimiter, client_identity
+from resilience import AdmissionController, CircuitBreaker
+from syntax_check import fast_path_answer
+from validation import resolve_deadline, validate_ask_fields
 
 
 # -----------------------------
@@ -20,15 +72,116 @@ from gemini_ai import build_tutor_prompt, generate_response, sanitize_tutor_outp
 app = Flask(__name__)
 CORS(
     app,
-    resources={r"/ask-ai": {"origins": CORS_ORIGINS}},
+    resources={r"/ask-ai(/.*)?": {"origins": CORS_ORIGINS}},
+    expose_headers=[
+        "X-Cache", "X-Cache-Match", "X-Answer-Source", "X-Idempotent-Replay", "Retry-After", "Server-Timing",
+    ],
     supports_credentials=False,
 )
 
+# Sanitized answers keyed on the normalized prompt, model, generation config and
+# template version; in process, or in SQLite shared by all workers (RESPONSE_CACHE_BACKEND).
+response_cache = open_response_cache()
+
+# Map the FAQ index (or index the corpus) now rather than on the first question.
+faq.get_index()
+
+# Identical prompts that are already in flight share one upstream call.
+upstream_calls = SingleFlight()
+
+# Responses by X-Request-Id, so client retries attach to or replay the original.
+idempotency_store = idempotency.IdempotencyStore(IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_TTL_S)
+
+# Response headers kept when a response is replayed to a retried request.
+_REPLAYED_HEADERS = ("Content-Type", "X-Cache", "X-Cache-Match", "X-Answer-Source", "Retry-After")
+
+# Bounded concurrency and wait queue for upstream calls; excess load is shed.
+admission = AdmissionController(ADMISSION_MAX_CONCURRENT, ADMISSION_MAX_QUEUE, ADMISSION_MAX_WAIT_S)
+
+# Per-client and global token buckets guarding the Gemini quota.
+rate_limiter = RateLimiter(
+    client_rate_per_s=RATE_LIMIT_CLIENT_RPS,
+    client_burst=RATE_LIMIT_CLIENT_BURST,
+    global_rate_per_s=RATE_LIMIT_GLOBAL_RPS,
+    global_burst=RATE_LIMIT_GLOBAL_BURST,
+    max_clients=RATE_LIMIT_MAX_CLIENTS,
+    enabled=RATE_LIMIT_ENABLED,
+)
+
+# Endpoints that spend Gemini quota, one token per request. /ask-ai/batch is
+# charged per item once the batch has been validated (see ask_ai_batch).
+_RATE_LIMITED_PATHS = frozenset({"/ask-ai", "/ask-ai/stream"})
+
+
+@app.before_request
+def start_request_timer():
+    """Remember when the request started, and start Server-Timing when enabled."""
+    g.request_started = time.perf_counter()
+    if SERVER_TIMING_ENABLED:
+        g.server_timing, g.server_timing_token = server_timing.start()
+
+
+@app.after_request
+def record_request_metrics(response: Response) -> Response:
+    """Count the request and observe its latency by route and status code."""
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        status = str(response.status_code)
+        metrics.http_requests.inc(route, status)
+        metrics.http_request_seconds.observe(time.perf_counter() - started, route, status)
+    recorder = g.get("server_timing")
+    if recorder is not None:
+        response.headers["Server-Timing"] = recorder.header_value()
+    return response
+
+
+@app.teardown_request
+def stop_server_timing(exc: Optional[BaseException]) -> None:
+    """Deactivate the request's Server-Timing recorder."""
+    token = g.pop("server_timing_token", None)
+    if token is not None:
+        server_timing.stop(token)
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Prometheus scrape endpoint (404 when METRICS_ENABLED is off)."""
+    if not METRICS_ENABLED:
+        return jsonify({"error": "Not found."}), 404
+    _sample_gauges()
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def _sample_gauges() -> None:
+    """Copy admission and breaker state into their gauges for a scrape."""
+    state = admission.snapshot()
+    metrics.admission_in_flight.set(state["in_flight"])
+    metrics.admission_queue_depth.set(state["queue_depth"])
+    current = upstream_breaker.state
+    for name in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN):
+        metrics.upstream_breaker_state.set(1 if name == current else 0, name)
+
 
 @app.get("/health")
 def health():
-    """Health check endpoint."""
-    return jsonify({"status": "ok"}), 200
+    """Health check endpoint; status is "degraded" while the upstream breaker is not closed."""
+    breaker = upstream_breaker.snapshot()
+    return jsonify({
+        "status": "ok" if breaker["state"] == "closed" else "degraded",
+        "cache": response_cache.stats(),
+        "upstream": {
+            "in_flight": upstream_calls.in_flight(),
+            "coalesced": upstream_calls.coalesced,
+            "breaker": breaker,
+            "hedging": upstream_hedging.snapshot(),
+            "admission": admission.snapshot(),
+            "context_cache": tutor_context.snapshot(),
+        },
+        "idempotency": idempotency_store.snapshot(),
+        "rate_limit": rate_limiter.snapshot(),
+        "faq": faq.snapshot(),
+    }), 200
 
 
 def _json_error(status: int, message: str, request_id: str, details: Optional[Dict[str, Any]] = None):
@@ -39,7 +192,207 @@ def _json_error(status: int, message: str, request_id: str, details: Optional[Di
     return jsonify(payload), status
 
 
+def _idempotent(view: Callable[[], Any]) -> Callable[[], Response]:
+    """
+    Share one run of view between requests with the same X-Request-Id and body.
+
+    Duplicates get the original response with an X-Idempotent-Replay header;
+    requests without an X-Request-Id always run.
+    """
+    @functools.wraps(view)
+    def wrapper():
+        key = None
+        if IDEMPOTENCY_ENABLED:
+            key = idempotency.request_key(request.headers.get("X-Request-Id"), request.path, request.get_data())
+        if key is None:
+            return view()
+
+        original = []
+
+        def handle() -> idempotency.StoredResponse:
+            resp = app.make_response(view())
+            original.append(resp)
+            headers = tuple((name, resp.headers[name]) for name in _REPLAYED_HEADERS if name in resp.headers)
+            return idempotency.StoredResponse(resp.status_code, resp.get_data(), headers)
+
+        stored, outcome = idempotency_store.do(key, handle)
+        if outcome is None:
+            return original[0]
+        logger.info("idempotent_%s request_id=%s path=%s", outcome, request.headers.get("X-Request-Id"), request.path)
+        resp = Response(stored.body, status=stored.status, headers=list(stored.headers))
+        resp.headers["X-Idempotent-Replay"] = "true"
+        return resp
+
+    return wrapper
+
+
+def _upstream_status(err: Optional[Dict[str, Any]]) -> Tuple[int, str]:
+    """Map a generate_response() error to an HTTP status and message."""
+    if err and err.get("overloaded"):
+        return 503, "Server is busy. Please try again shortly."
+    if err and err.get("circuit_open"):
+        return 503, "AI provider is temporarily unavailable. Please try again shortly."
+    if err and err.get("deadline_exceeded"):
+        return 504, "AI provider did not answer in time. Please try again."
+    return 502, "AI provider error. Please try again."
+
+
+def _upstream_error(request_id: str, err: Optional[Dict[str, Any]]):
+    """Return the error response for a failed upstream call."""
+    status, message = _upstream_status(err)
+    resp, status = _json_error(status, message, request_id, details=err)
+    if status == 503:
+        resp.headers["Retry-After"] = str(max(1, math.ceil(err.get("retry_after_s") or 0)))
+    return resp, status
+
+
+def _parse_ask_request(request_id: str):
+    """
+    Parse the JSON body of the current tutoring request.
+
+    Returns:
+        A tuple of (fields, error_response). Exactly one of them is None.
+    """
+    if not request.is_json:
+        return None, _json_error(
+            400,
+            "Content-Type must be application/json.",
+            request_id,
+        )
+
+    body = request.get_json(silent=True) or {}
+    fields, error = validate_ask_fields(body)
+    if error:
+        return None, _json_error(error[0], error[1], request_id)
+    return fields, None
+
+
+def _build_prompt(fields: Dict[str, str], request_id: str) -> str:
+    """Compact the code, build the tutor prompt and record their sizes."""
+    metrics.code_chars.observe(len(fields["code"]))
+    prompt = build_tutor_prompt(**compact_fields(fields, request_id))
+    metrics.prompt_chars.observe(len(prompt))
+    return prompt
+
+
+def _local_answer(fields: Dict[str, str], request_id: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Answer without calling Gemini when possible.
+
+    Returns:
+        A tuple of (answer, source): syntax-check for code that does not
+        parse, faq for a code-less question matching the FAQ index, or
+        (None, None) when the request needs the model
+    """
+    answer = fast_path_answer(fields, request_id)
+    if answer is not None:
+        return answer, "syntax-check"
+    answer = faq.faq_answer(fields, request_id)
+    if answer is not None:
+        return answer, "faq"
+    return None, None
+
+
+def _cached_answer(
+    cache_key: str, fp: Optional[fingerprint.Fingerprint], request_id: str
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Look up an answer for the exact prompt, then for equivalent or similar code.
+
+    Returns:
+        A tuple of (answer, match) where match is exact, equivalent or near,
+        or (None, None) on a miss
+    """
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return cached, "exact"
+    return fingerprint.lookup(fp, request_id)
+
+
+def _sse_event(event: str, data: Dict[str, Any]) -> str:
+    """Format one Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _generate_answer(
+    prompt: str,
+    cache_key: str,
+    request_id: str,
+    deadline: Optional[float],
+    fp: Optional[fingerprint.Fingerprint] = None,
+) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """Call Gemini, sanitize the answer and store it in the response cache under the key and fingerprint."""
+    queued_at = time.monotonic()
+    with server_timing.stage("queue"):
+        admitted = admission.acquire(deadline)
+    if admission.enabled:
+        metrics.admission_wait_seconds.observe(time.monotonic() - queued_at, "admitted" if admitted else "shed")
+    if not admitted:
+        logger.warning("ask_ai_shed request_id=%s", request_id)
+        return None, {"overloaded": True, "retry_after_s": admission.retry_after_s()}
+    try:
+        raw_text, err = generate_response(prompt, request_id=request_id, deadline=deadline)
+    finally:
+        admission.release()
+    if err or not raw_text:
+        return None, err
+    with server_timing.stage("sanitize"):
+        answer = sanitize_tutor_output(raw_text)
+    response_cache.set(cache_key, answer)
+    fingerprint.remember(fp, answer)
+    return answer, None
+
+
+@app.before_request
+def enforce_rate_limit():
+    """
+    Reject over-limit tutoring requests with 429 before any work is done.
+
+    Runs ahead of body parsing, prompt building and the upstream call so a
+    flood of requests costs as little as possible.
+    """
+    if request.method != "POST" or request.path not in _RATE_LIMITED_PATHS:
+        return None
+
+    wait_s = rate_limiter.acquire(_rate_limit_client())
+    if wait_s <= 0:
+        return None
+
+    request_id = request.headers.get("X-Request-Id") or str(uuid.uuid4())
+    return _rate_limited(request_id, wait_s)
+
+
+def _rate_limit_client() -> str:
+    """Identify the current request's client for the rate limiter."""
+    return client_identity(
+        request.headers.get("X-Api-Key"),
+        request.headers.get("X-Forwarded-For"),
+        request.remote_addr,
+        RATE_LIMIT_TRUST_PROXY,
+        RATE_LIMIT_API_KEYS,
+        RATE_LIMIT_PROXY_HOPS,
+    )
+
+
+def _retry_after(wait_s: float) -> int:
+    """Whole seconds for a Retry-After header, between 1 and an hour."""
+    return max(1, math.ceil(min(wait_s, 3600)))
+
+
+def _rate_limited(request_id: str, wait_s: float) -> Tuple[Response, int]:
+    """Build the 429 response for a request over the rate limit."""
+    logger.warning("rate_limited request_id=%s path=%s wait_s=%.2f", request_id, request.path, wait_s)
+    resp, status = _json_error(
+        429,
+        "Too many requests. Please slow down and try again.",
+        request_id,
+    )
+    resp.headers["Retry-After"] = str(_retry_after(wait_s))
+    return resp, status
+
+
 @app.post("/ask-ai")
+@_idempotent
 def ask_ai():
     """
     Main endpoint for AI tutoring requests.
@@ -53,27 +406,24 @@ def ask_ai():
     Returns JSON with:
         - answer: The tutor's response
         - request_id: Unique identifier for the request
+
+    The X-Cache response header reports HIT or MISS against the response
+    cache. Answers built locally instead of by Gemini carry an X-Answer-Source
+    header instead (syntax-check for code that does not parse, faq for a
+    common question answered from the FAQ index). An optional X-Deadline-Ms
+    header shortens the upstream time budget; when it runs out the endpoint
+    answers 504. A retry with the same X-Request-Id and body gets the original
+    response, marked with X-Idempotent-Replay.
     """
     request_id = request.headers.get("X-Request-Id") or str(uuid.uuid4())
+    deadline = resolve_deadline(request.headers.get("X-Deadline-Ms"))
 
     try:
-        if not request.is_json:
-            return _json_error(
-                400,
-                "Content-Type must be application/json.",
-                request_id,
-            )
-
-        body = request.get_json(silent=True) or {}
-        topic = str(body.get("topic") or "").strip()
-        code = str(body.get("code") or "")
-        question = str(body.get("question") or "").strip()
-        level = str(body.get("level") or "beginner").strip()
-
-        if not question:
-            return _json_error(400, "Field 'question' is required.", request_id)
-        if len(code) > 80_000:
-            return _json_error(413, "Field 'code' is too large.", request_id)
+        with server_timing.stage("parse"):
+            fields, error = _parse_ask_request(request_id)
+        if error:
+            return error
+        topic, code, question, level = fields["topic"], fields["code"], fields["question"], fields["level"]
 
         logger.info(
             "ask_ai request_id=%s topic=%s level=%s question_len=%s code_len=%s",
@@ -84,25 +434,264 @@ def ask_ai():
             len(code),
         )
 
-        prompt = build_tutor_prompt(topic=topic, code=code, question=question, level=level)
-        raw_text, err = generate_response(prompt, request_id=request_id)
+        with server_timing.stage("local"):
+            local_answer, source = _local_answer(fields, request_id)
+        if local_answer is not None:
+            resp = jsonify({"answer": local_answer, "request_id": request_id})
+            resp.headers["X-Answer-Source"] = source
+            return resp, 200
 
-        if err or not raw_text:
-            return _json_error(
-                502,
-                "AI provider error. Please try again.",
-                request_id,
-                details=err,
-            )
+        with server_timing.stage("prompt"):
+            prompt = _build_prompt(fields, request_id)
+        with server_timing.stage("fingerprint"):
+            fp = fingerprint.fingerprint_fields(fields)
+        cache_key = build_cache_key(
+            prompt, GEMINI_MODEL, GENERATION_CONFIG, TUTOR_SYSTEM_INSTRUCTION, PROMPT_TEMPLATE_VERSION
+        )
+        cached, match = _cached_answer(cache_key, fp, request_id)
+        if cached is not None:
+            logger.info("ask_ai_cache_hit request_id=%s match=%s", request_id, match)
+            resp = jsonify({"answer": cached, "request_id": request_id})
+            resp.headers["X-Cache"] = "HIT"
+            if match != "exact":
+                resp.headers["X-Cache-Match"] = match
+            return resp, 200
 
-        answer = sanitize_tutor_output(raw_text)
-        return jsonify({"answer": answer, "request_id": request_id}), 200
+        (answer, err), shared = upstream_calls.do(
+            cache_key,
+            lambda: _generate_answer(prompt, cache_key, request_id, deadline, fp),
+        )
+        if shared:
+            logger.info("ask_ai_coalesced request_id=%s", request_id)
+
+        if err or not answer:
+            return _upstream_error(request_id, err)
+
+        resp = jsonify({"answer": answer, "request_id": request_id})
+        resp.headers["X-Cache"] = "MISS"
+        return resp, 200
 
     except Exception as exc:
         logger.exception("ask_ai_unhandled request_id=%s err=%s", request_id, exc)
         return _json_error(500, "Internal server error.", request_id)
 
 
+def _answer_batch_item(fields: Dict[str, str], request_id: str, deadline: Optional[float]) -> Dict[str, Any]:
+    """
+    Answer one validated item of a batch request.
+
+    Returns:
+        The per-item result: status plus either answer and cache (or source
+        for local answers), or error (and details for upstream failures)
+    """
+    try:
+        local_answer, source = _local_answer(fields, request_id)
+        if local_answer is not None:
+            return {"status": 200, "answer": local_answer, "source": source}
+
+        prompt = _build_prompt(fields, request_id)
+        fp = fingerprint.fingerprint_fields(fields)
+        cache_key = build_cache_key(
+            prompt, GEMINI_MODEL, GENERATION_CONFIG, TUTOR_SYSTEM_INSTRUCTION, PROMPT_TEMPLATE_VERSION
+        )
+        cached, match = _cached_answer(cache_key, fp, request_id)
+        if cached is not None:
+            result = {"status": 200, "answer": cached, "cache": "HIT"}
+            if match != "exact":
+                result["match"] = match
+            return result
+
+        (answer, err), _ = upstream_calls.do(
+            cache_key,
+            lambda: _generate_answer(prompt, cache_key, request_id, deadline, fp),
+        )
+        if err or not answer:
+            status, message = _upstream_status(err)
+            result = {"status": status, "error": message}
+            if err:
+                result["details"] = err
+            return result
+        return {"status": 200, "answer": answer, "cache": "MISS"}
+
+    except Exception as exc:
+        logger.exception("ask_ai_batch_item_unhandled request_id=%s err=%s", request_id, exc)
+        return {"status": 500, "error": "Internal server error."}
+
+
+@app.post("/ask-ai/batch")
+@_idempotent
+def ask_ai_batch():
+    """
+    Answer several tutoring requests in one call.
+
+    Expects a JSON array of /ask-ai bodies, or an object with an "items"
+    array. Items are validated like /ask-ai and answered concurrently, at
+    most BATCH_MAX_PARALLEL at a time, sharing one deadline.
+
+    Each valid item costs one rate-limit token. When no token is left the
+    whole batch gets 429; when only some are, the valid items beyond them
+    get a 429 result with retry_after_s.
+
+    Returns JSON with:
+        - results: One entry per item, in input order, each with a status
+          and either answer and cache (HIT/MISS) or source (syntax-check or faq),
+          or error
+        - request_id: Unique identifier for the request
+    """
+    request_id = request.headers.get("X-Request-Id") or str(uuid.uuid4())
+    deadline = resolve_deadline(request.headers.get("X-Deadline-Ms"))
+
+    try:
+        if not request.is_json:
+            return _json_error(400, "Content-Type must be application/json.", request_id)
+
+        body = request.get_json(silent=True)
+        items = body.get("items") if isinstance(body, dict) else body
+        if not isinstance(items, list) or not items:
+            return _json_error(400, "Field 'items' must be a non-empty array.", request_id)
+        if len(items) > BATCH_MAX_ITEMS:
+            return _json_error(413, f"At most {BATCH_MAX_ITEMS} items are allowed per batch.", request_id)
+
+        validated = [validate_ask_fields(item) for item in items]
+        valid = [index for index, (_, error) in enumerate(validated) if not error]
+        granted, wait_s = rate_limiter.acquire_many(_rate_limit_client(), len(valid))
+        if valid and not granted:
+            return _rate_limited(request_id, wait_s)
+        admitted = set(valid[:granted])
+
+        logger.info(
+            "ask_ai_batch request_id=%s items=%s valid=%s admitted=%s",
+            request_id, len(items), len(valid), granted,
+        )
+
+        results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+        for index, (_, error) in enumerate(validated):
+            if error:
+                results[index] = {"status": error[0], "error": error[1]}
+            elif index not in admitted:
+                results[index] = {
+                    "status": 429,
+                    "error": "Too many requests. Please slow down and try again.",
+                    "retry_after_s": _retry_after(wait_s),
+                }
+
+        if admitted:
+            with ThreadPoolExecutor(max_workers=max(1, min(BATCH_MAX_PARALLEL, len(admitted)))) as pool:
+                answered = pool.map(
+                    lambda index: (index, _answer_batch_item(validated[index][0], f"{request_id}-{index}", deadline)),
+                    sorted(admitted),
+                )
+                for index, result in answered:
+                    results[index] = result
+
+        return jsonify({"results": results, "request_id": request_id}), 200
+
+    except Exception as exc:
+        logger.exception("ask_ai_batch_unhandled request_id=%s err=%s", request_id, exc)
+        return _json_error(500, "Internal server error.", request_id)
+
+
+@app.post("/ask-ai/stream")
+def ask_ai_stream():
+    """
+    Streaming variant of /ask-ai using Server-Sent Events.
+
+    Accepts the same JSON body as /ask-ai. Validation errors and failures to
+    reach Gemini are returned as JSON errors; otherwise the response is a
+    text/event-stream, sanitized incrementally, with these events:
+        - chunk: {"text": ...} for each piece of the answer
+        - error: {"error": ..., "request_id": ...} if the stream breaks
+        - done: {"request_id": ..., "ttft_ms": ..., "total_ms": ...}
+    """
+    request_id = request.headers.get("X-Request-Id") or str(uuid.uuid4())
+    deadline = resolve_deadline(request.headers.get("X-Deadline-Ms"))
+    t0 = time.monotonic()
+
+    try:
+        fields, error = _parse_ask_request(request_id)
+        if error:
+            return error
+
+        logger.info(
+            "ask_ai_stream request_id=%s topic=%s level=%s question_len=%s code_len=%s",
+            request_id,
+            fields["topic"][:80],
+            fields["level"],
+            len(fields["question"]),
+            len(fields["code"]),
+        )
+
+        answer_source = cache_status = cache_match = fp = None
+        cache_key = ""
+        local_answer, answer_source = _local_answer(fields, request_id)
+        if local_answer is not None:
+            chunks = iter([local_answer])
+        else:
+            prompt = _build_prompt(fields, request_id)
+            fp = fingerprint.fingerprint_fields(fields)
+            cache_key = build_cache_key(
+                prompt, GEMINI_MODEL, GENERATION_CONFIG, TUTOR_SYSTEM_INSTRUCTION, PROMPT_TEMPLATE_VERSION
+            )
+            cached, cache_match = _cached_answer(cache_key, fp, request_id)
+            if cached is not None:
+                chunks = iter([cached])
+                cache_status = "HIT"
+            else:
+                chunks, err = stream_response(prompt, request_id=request_id, deadline=deadline)
+                if err or chunks is None:
+                    return _upstream_error(request_id, err)
+                cache_status = "MISS"
+
+    except Exception as exc:
+        logger.exception("ask_ai_stream_unhandled request_id=%s err=%s", request_id, exc)
+        return _json_error(500, "Internal server error.", request_id)
+
+    def events():
+        # Cached and local answers are already safe; live output goes through the guardrail.
+        sanitizer = StreamingSanitizer() if cache_status == "MISS" else None
+        ttft_ms = None
+        parts = []
+        try:
+            for text in chunks:
+                if sanitizer is not None:
+                    text = sanitizer.feed(text)
+                if not text:
+                    continue
+                if ttft_ms is None:
+                    ttft_ms = int((time.monotonic() - t0) * 1000)
+                parts.append(text)
+                yield _sse_event("chunk", {"text": text})
+            if sanitizer is not None:
+                tail = sanitizer.close()
+                if tail:
+                    parts.append(tail)
+                    yield _sse_event("chunk", {"text": tail})
+        except Exception as exc:
+            logger.warning("ask_ai_stream_broken request_id=%s err=%s", request_id, exc)
+            yield _sse_event("error", {"error": "AI provider error. Please try again.", "request_id": request_id})
+            return
+
+        if sanitizer is not None and parts:
+            response_cache.set(cache_key, "".join(parts))
+            fingerprint.remember(fp, "".join(parts))
+        yield _sse_event("done", {
+            "request_id": request_id,
+            "ttft_ms": ttft_ms,
+            "total_ms": int((time.monotonic() - t0) * 1000),
+        })
+
+    resp = Response(stream_with_context(events()), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    if answer_source is not None:
+        resp.headers["X-Answer-Source"] = answer_source
+    else:
+        resp.headers["X-Cache"] = cache_status
+        if cache_match not in (None, "exact"):
+            resp.headers["X-Cache-Match"] = cache_match
+    return resp
+
+
 if __name__ == "__main__":
     # Dev-friendly defaults; use a real WSGI server (gunicorn/uvicorn) in production.
     host = os.getenv("HOST", "0.0.0.0")
@@ -0,0 +1,277 @@
+"""
+ASGI backend for the AI Python Teacher application.
+
+Async counterpart of app.py for /ask-ai. Upstream Gemini calls are awaited
+instead of blocking a worker thread, so a single process can hold many slow
+tutoring requests at once.
+
+/ask-ai takes the same request and returns the same body as in app.py, with
+local answers, the response cache, fingerprint reuse, coalescing and the
+circuit breaker. Rate limiting, admission control, idempotent replay,
+/metrics, Server-Timing and the batch and stream endpoints are Flask-only,
+and /health reports a subset of the Flask fields (see README).
+
+Run with:
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+"""
+import math
+import os
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional, Tuple
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+import faq
+import fingerprint
+from cache import AsyncSingleFlight, build_cache_key
+from compaction import compact_fields
+from config import (
+    CORS_ORIGINS,
+    GEMINI_MODEL,
+    logger,
+)
+from gemini_ai import (
+    GENERATION_CONFIG,
+    PROMPT_TEMPLATE_VERSION,
+    TUTOR_SYSTEM_INSTRUCTION,
+    build_tutor_prompt,
+    sanitize_tutor_output,
+    upstream_breaker,
+)
+from gemini_ai_async import close_async_client, generate_response_async
+from persistent_cache import open_response_cache
+from syntax_check import fast_path_answer
+from validation import resolve_deadline, validate_ask_fields
+
+
+# Sanitized answers keyed on the normalized prompt, model, generation config and
+# template version; in process, or in SQLite shared by all workers (RESPONSE_CACHE_BACKEND).
+response_cache = open_response_cache()
+
+# Map the FAQ index (or index the corpus) now rather than on the first question.
+faq.get_index()
+
+# Identical prompts that are already in flight share one upstream call.
+upstream_calls = AsyncSingleFlight()
+
+
+async def health(request: Request) -> JSONResponse:
+    """Health check endpoint; status is "degraded" while the upstream breaker is not closed."""
+    breaker = upstream_breaker.snapshot()
+    return JSONResponse({
+        "status": "ok" if breaker["state"] == "closed" else "degraded",
+        "cache": await run_in_threadpool(response_cache.stats),
+        "upstream": {
+            "in_flight": upstream_calls.in_flight(),
+            "coalesced": upstream_calls.coalesced,
+            "breaker": breaker,
+        },
+        "faq": faq.snapshot(),
+    })
+
+
+def _local_answer(fields: Dict[str, str], request_id: str) -> Tuple[Optional[str], Optional[str]]:
+    """Answer from the syntax check or the FAQ index; returns (answer, source) or (None, None)."""
+    answer = fast_path_answer(fields, request_id)
+    if answer is not None:
+        return answer, "syntax-check"
+    answer = faq.faq_answer(fields, request_id)
+    if answer is not None:
+        return answer, "faq"
+    return None, None
+
+
+def _json_error(status: int, message: str, request_id: str, details: Optional[Dict[str, Any]] = None) -> JSONResponse:
+    """Return a JSON error response with standard format."""
+    payload = {"error": message, "request_id": request_id}
+    if details:
+        payload["details"] = details
+    return JSONResponse(payload, status_code=status)
+
+
+def _upstream_error(request_id: str, err: Optional[Dict[str, Any]]) -> JSONResponse:
+    """Return the error response for a failed upstream call."""
+    if err and err.get("circuit_open"):
+        resp = _json_error(
+            503,
+            "AI provider is temporarily unavailable. Please try again shortly.",
+            request_id,
+            details=err,
+        )
+        resp.headers["Retry-After"] = str(max(1, math.ceil(err.get("retry_after_s") or 0)))
+        return resp
+    if err and err.get("deadline_exceeded"):
+        return _json_error(
+            504,
+            "AI provider did not answer in time. Please try again.",
+            request_id,
+            details=err,
+        )
+    return _json_error(
+        502,
+        "AI provider error. Please try again.",
+        request_id,
+        details=err,
+    )
+
+
+def _is_json(request: Request) -> bool:
+    """Mirror Flask's request.is_json mimetype check."""
+    mimetype = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    return mimetype == "application/json" or (
+        mimetype.startswith("application/") and mimetype.endswith("+json")
+    )
+
+
+def _build_prompt(fields: Dict[str, str], request_id: str) -> str:
+    """Compact the student's code and build the tutor prompt (CPU-bound; run in a thread)."""
+    return build_tutor_prompt(**compact_fields(fields, request_id))
+
+
+async def _generate_answer(
+    prompt: str,
+    cache_key: str,
+    request_id: str,
+    deadline: Optional[float],
+    fp: Optional[fingerprint.Fingerprint] = None,
+) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """Call Gemini, sanitize the answer and store it in the response cache under the key and fingerprint."""
+    raw_text, err = await generate_response_async(prompt, request_id=request_id, deadline=deadline)
+    if err or not raw_text:
+        return None, err
+    answer = sanitize_tutor_output(raw_text)
+    await run_in_threadpool(_store_answer, cache_key, fp, answer)
+    return answer, None
+
+
+def _cached_answer(
+    cache_key: str,
+    fp: Optional[fingerprint.Fingerprint],
+    request_id: str,
+) -> Tuple[Optional[str], Optional[str]]:
+    """Look up an exact or fingerprint match (may block on SQLite; run in a thread)."""
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return cached, "exact"
+    return fingerprint.lookup(fp, request_id)
+
+
+def _store_answer(cache_key: str, fp: Optional[fingerprint.Fingerprint], answer: str) -> None:
+    """Store an answer under its key and fingerprint (may block on SQLite; run in a thread)."""
+    response_cache.set(cache_key, answer)
+    fingerprint.remember(fp, answer)
+
+
+async def ask_ai(request: Request) -> JSONResponse:
+    """
+    Main endpoint for AI tutoring requests.
+
+    Accepts and returns the same JSON as the Flask /ask-ai endpoint,
+    including the X-Cache response header and X-Deadline-Ms handling.
+    """
+    request_id = request.headers.get("X-Request-Id") or str(uuid.uuid4())
+    deadline = resolve_deadline(request.headers.get("X-Deadline-Ms"))
+
+    try:
+        if not _is_json(request):
+            return _json_error(
+                400,
+                "Content-Type must be application/json.",
+                request_id,
+            )
+
+        try:
+            body = await request.json()
+        except ValueError:
+            body = {}
+        fields, error = validate_ask_fields(body or {})
+        if error:
+            return _json_error(error[0], error[1], request_id)
+
+        logger.info(
+            "ask_ai request_id=%s topic=%s level=%s question_len=%s code_len=%s",
+            request_id,
+            fields["topic"][:80],
+            fields["level"],
+            len(fields["question"]),
+            len(fields["code"]),
+        )
+
+        local_answer, source = _local_answer(fields, request_id)
+        if local_answer is not None:
+            return JSONResponse(
+                {"answer": local_answer, "request_id": request_id},
+                headers={"X-Answer-Source": source},
+            )
+
+        prompt = await run_in_threadpool(_build_prompt, fields, request_id)
+        fp = await run_in_threadpool(fingerprint.fingerprint_fields, fields)
+        cache_key = build_cache_key(
+            prompt, GEMINI_MODEL, GENERATION_CONFIG, TUTOR_SYSTEM_INSTRUCTION, PROMPT_TEMPLATE_VERSION
+        )
+        cached, match = await run_in_threadpool(_cached_answer, cache_key, fp, request_id)
+        if cached is not None:
+            logger.info("ask_ai_cache_hit request_id=%s match=%s", request_id, match)
+            headers = {"X-Cache": "HIT"}
+            if match != "exact":
+                headers["X-Cache-Match"] = match
+            return JSONResponse({"answer": cached, "request_id": request_id}, headers=headers)
+
+        (answer, err), shared = await upstream_calls.do(
+            cache_key,
+            lambda: _generate_answer(prompt, cache_key, request_id, deadline, fp),
+        )
+        if shared:
+            logger.info("ask_ai_coalesced request_id=%s", request_id)
+
+        if err or not answer:
+            return _upstream_error(request_id, err)
+
+        return JSONResponse(
+            {"answer": answer, "request_id": request_id},
+            headers={"X-Cache": "MISS"},
+        )
+
+    except Exception as exc:
+        logger.exception("ask_ai_unhandled request_id=%s err=%s", request_id, exc)
+        return _json_error(500, "Internal server error.", request_id)
+
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    """Release pooled upstream connections on shutdown."""
+    yield
+    await close_async_client()
+
+
+app = Starlette(
+    routes=[
+        Route("/health", health, methods=["GET"]),
+        Route("/ask-ai", ask_ai, methods=["POST"]),
+    ],
+    middleware=[
+        Middleware(
+            CORSMiddleware,
+            allow_origins=["*"] if CORS_ORIGINS == "*" else CORS_ORIGINS,
+            allow_methods=["POST", "OPTIONS"],
+            allow_headers=["*"],
+            expose_headers=["X-Cache", "X-Cache-Match", "X-Answer-Source"],
+        ),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", "5000"))
+    uvicorn.run(app, host=host, port=port)
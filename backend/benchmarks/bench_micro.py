@@ -0,0 +1,190 @@
+"""
+Microbenchmarks for the per-request CPU paths.
+
+Times build_tutor_prompt() and compact_code() across code sizes up to the
+80 KB limit, and sanitize_tutor_output() on realistic tutor answers and on
+the adversarial outputs from bench_sanitizer.py at one fixed size. The code
+and answers are the shared fixtures in fixtures.py.
+Results can be saved as JSON and compared with an earlier run, so
+regressions show up as a ratio against the baseline. Comparisons use the
+fastest sample, which is the least sensitive to noise from other processes.
+
+Usage (from the backend directory):
+    python benchmarks/bench_micro.py --save benchmarks/results/baseline.json
+    python benchmarks/bench_micro.py --compare benchmarks/results/baseline.json [--max-ratio 1.3]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_sanitizer import ADVERSARIAL_INPUTS  # noqa: E402
+from benchmarks.fixtures import STUDENT_QUESTION, TUTOR_ANSWER, make_code  # noqa: E402
+from compaction import compact_code  # noqa: E402
+from config import CODE_STRIP_COMMENTS, CODE_TOKEN_BUDGET  # noqa: E402
+from gemini_ai import build_tutor_prompt, sanitize_tutor_output  # noqa: E402
+from validation import MAX_CODE_CHARS  # noqa: E402
+
+# Ratio of new to baseline best time above which --compare fails.
+DEFAULT_MAX_RATIO = 1.3
+
+# Size, in characters, of the adversarial sanitizer inputs
+ADVERSARIAL_SIZE = 64_000
+
+
+def _block(lines: int) -> str:
+    return "```python\n" + "total += values[i]\n" * lines + "```\n"
+
+
+def _solution_dump(functions: int) -> str:
+    body = "import math\nfrom statistics import mean\n\n"
+    body += "".join(f"def helper_{i}(x):\n    return x + {i}\n\n" for i in range(functions))
+    return body + "if __name__ == '__main__':\n    print(helper_0(1))\n"
+
+
+def _cases() -> Dict[str, Callable[[], Any]]:
+    """Build the benchmark cases; inputs are created once, outside the timing."""
+    cases: Dict[str, Callable[[], Any]] = {}
+    for size in (0, 1_000, 10_000, 40_000, MAX_CODE_CHARS):
+        code = make_code(size)
+        cases[f"prompt/code_{size // 1000}k"] = (
+            lambda code=code: build_tutor_prompt("loops", code, STUDENT_QUESTION, "beginner")
+        )
+    # As configured for requests: over CODE_TOKEN_BUDGET this slices and trims
+    for size in (10_000, 40_000, MAX_CODE_CHARS):
+        code = make_code(size)
+        cases[f"compact/code_{size // 1000}k"] = (
+            lambda code=code: compact_code(code, STUDENT_QUESTION, CODE_TOKEN_BUDGET, CODE_STRIP_COMMENTS)
+        )
+
+    sanitize_inputs = {
+        # Realistic answers
+        "plain_answer": TUTOR_ANSWER,
+        "answer_with_short_block": TUTOR_ANSWER + _block(3),
+        "answer_with_long_block": TUTOR_ANSWER + _block(30),
+        "solution_dump": _solution_dump(40),
+    }
+    sanitize_inputs.update((name, make(ADVERSARIAL_SIZE)) for name, make in ADVERSARIAL_INPUTS.items())
+    for name, text in sanitize_inputs.items():
+        cases[f"sanitize/{name}"] = lambda text=text: sanitize_tutor_output(text)
+    return cases
+
+
+def _time_case(fn: Callable[[], Any], repeat: int, min_sample_s: float) -> Dict[str, float]:
+    """Calibrate a loop count, then take repeat samples of the per-call time."""
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_sample_s or number >= 1_000_000:
+            break
+        number *= 2 if elapsed == 0 else max(2, min(10, int(min_sample_s / elapsed) + 1))
+
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - t0) / number)
+    return {
+        "median_us": round(statistics.median(samples) * 1e6, 3),
+        "min_us": round(min(samples) * 1e6, 3),
+        "loops": number,
+    }
+
+
+def run(repeat: int = 7, min_sample_s: float = 0.05, only: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+    """Run every case (or those whose name contains only) and return timings."""
+    return {
+        name: _time_case(fn, repeat, min_sample_s)
+        for name, fn in _cases().items()
+        if only is None or only in name
+    }
+
+
+def _metadata() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, timeout=5,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], max_ratio: float) -> List[str]:
+    """
+    Print results next to a baseline and list the cases that regressed.
+
+    Returns:
+        Names of cases whose best time is more than max_ratio times the baseline
+    """
+    regressed = []
+    print(f"{'case':<36}{'baseline':>14}{'now':>14}{'ratio':>9}")
+    for name, now in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<36}{'-':>14}{now['min_us']:>12.1f}us{'new':>9}")
+            continue
+        ratio = now["min_us"] / max(base["min_us"], 1e-9)
+        flag = "  <-- slower" if ratio > max_ratio else ""
+        print(f"{name:<36}{base['min_us']:>12.1f}us{now['min_us']:>12.1f}us{ratio:>8.2f}x{flag}")
+        if ratio > max_ratio:
+            regressed.append(name)
+    return regressed
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=7, help="timed samples per case")
+    parser.add_argument("--min-sample-ms", type=float, default=50, help="minimum duration of one sample")
+    parser.add_argument("--only", help="run only cases whose name contains this text")
+    parser.add_argument("--save", help="write results as JSON to this path")
+    parser.add_argument("--compare", help="compare with a JSON file written by --save")
+    parser.add_argument("--max-ratio", type=float, default=DEFAULT_MAX_RATIO,
+                        help="with --compare, exit 1 if any case is slower than baseline by this factor")
+    args = parser.parse_args()
+
+    results = run(args.repeat, args.min_sample_ms / 1000, args.only)
+
+    status = 0
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as fh:
+            baseline = json.load(fh)
+        meta = baseline.get("meta", {})
+        print(f"baseline: {args.compare} (commit {meta.get('commit')}, {meta.get('timestamp')})")
+        regressed = compare(results, baseline.get("results", {}), args.max_ratio)
+        if regressed:
+            print(f"regressed beyond {args.max_ratio}x: {', '.join(regressed)}", file=sys.stderr)
+            status = 1
+    else:
+        print(f"{'case':<36}{'median':>14}{'min':>14}")
+        for name, r in results.items():
+            print(f"{name:<36}{r['median_us']:>12.1f}us{r['min_us']:>12.1f}us")
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w", encoding="utf-8") as fh:
+            json.dump({"meta": _metadata(), "results": results}, fh, indent=2)
+            fh.write("\n")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""
+Adversarial-input benchmark for sanitize_tutor_output().
+
+Times the sanitizer on inputs that stress the fence scanner (many fences,
+unterminated fences, long language tags, backtick runs, thousands of
+suspicious lines) at doubling sizes and reports how time grows per doubling.
+A linear scanner stays close to 2x; anything quadratic trends towards 4x.
+
+Usage (from the backend directory):
+    python benchmarks/bench_sanitizer.py [--sizes 4000 8000 16000 32000] [--check]
+"""
+import argparse
+import math
+import os
+import sys
+import time
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gemini_ai import sanitize_tutor_output  # noqa: E402
+
+# Per-doubling growth above this fails --check (2.0 is linear, 4.0 quadratic).
+MAX_GROWTH_PER_DOUBLING = 3.0
+
+ADVERSARIAL_INPUTS: Dict[str, Callable[[int], str]] = {
+    "many_short_blocks": lambda n: "```py\nx = 1\n```\n" * (n // 15),
+    "many_opening_fences": lambda n: "```py\n" * (n // 6),
+    "unterminated_fence": lambda n: "```python\n" + "x = 1\n" * (n // 6),
+    "long_language_tag": lambda n: "```" + "a" * n,
+    "backtick_run": lambda n: "`" * n,
+    "fences_without_newline": lambda n: "```a " * (n // 5),
+    "long_blocks": lambda n: ("```py\n" + "y = 2\n" * 20 + "```\n") * (n // 130),
+    "import_lines": lambda n: "import module\n" * (n // 14),
+    "indented_suspicious": lambda n: "    \t def f():\r\n" * (n // 16),
+}
+
+
+def _time_call(text: str, repeat: int) -> float:
+    """Return the best-of-repeat wall time of one sanitizer call, in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        sanitize_tutor_output(text)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def run(sizes: List[int], repeat: int) -> Dict[str, List[float]]:
+    """Time every adversarial input at every size."""
+    results = {}
+    for name, make in ADVERSARIAL_INPUTS.items():
+        results[name] = [_time_call(make(size), repeat) for size in sizes]
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[8_000, 16_000, 32_000, 64_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--check", action="store_true", help="exit 1 if growth looks super-linear")
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.repeat)
+    failed = []
+    print(f"{'input':<24}" + "".join(f"{size:>12}" for size in args.sizes) + f"{'growth':>10}")
+    for name, timings in results.items():
+        # Geometric mean of the growth per doubling across the size ladder.
+        doublings = max(1e-9, math.log2(args.sizes[-1] / args.sizes[0]))
+        growth = (timings[-1] / max(timings[0], 1e-9)) ** (1 / doublings)
+        cells = "".join(f"{t * 1000:>10.3f}ms" for t in timings)
+        print(f"{name:<24}{cells}{growth:>9.2f}x")
+        if growth > MAX_GROWTH_PER_DOUBLING:
+            failed.append(name)
+
+    if args.check and failed:
+        print(f"super-linear growth: {', '.join(failed)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,44 @@
+"""
+Shared payloads for the benchmarks.
+
+The load test sends this student code, the Gemini stub answers with this
+tutor answer, and the microbenchmarks time the prompt, compaction and
+sanitizer paths on both, so every benchmark measures the same kind of
+request.
+"""
+
+STUDENT_QUESTION = "Why does my average come out wrong?"
+
+STUDENT_CODE_LINES = (
+    "def average(values):\n",
+    "    total = 0\n",
+    "    for i in range(len(values) - 1):\n",
+    "        total += values[i]\n",
+    "    return total / len(values)\n",
+    "\n",
+    "print(average([1, 2, 3]))\n",
+)
+
+TUTOR_ANSWER = (
+    "1) What's going wrong\nYour loop stops one step early because range() excludes its end value.\n\n"
+    "2) Why it happens (conceptual explanation)\n"
+    "range(a, b) yields a, a+1, ... b-1, so the last index is never visited.\n\n"
+    "3) Hints\n- Print the loop variable on each pass.\n- Compare the last value with len(items).\n"
+    "- Check what range(len(items)) produces for a short list.\n\n"
+    "4) Check yourself\n- What does range(3) produce?\n- Which index holds the last item?\n\n"
+    "5) Next small step\nAdd a print() inside the loop and run it on a list of three items.\n"
+)
+
+
+def make_code(size: int) -> str:
+    """
+    Return plausible student code of at most size characters.
+
+    The code is made of whole copies of STUDENT_CODE_LINES so it always
+    parses; cutting mid-line would send it down the syntax-error fast path
+    instead of to compaction and the upstream.
+    """
+    if size <= 0:
+        return ""
+    block = "".join(STUDENT_CODE_LINES)
+    return block * (size // len(block))
@@ -0,0 +1,309 @@
+"""
+Local stand-in for the Gemini API, for offline load testing.
+
+Serves POST /v1beta/models/{model}:generateContent and
+:streamGenerateContent?alt=sse with configurable latency, output speed and
+injected faults, so the backend can be driven hard without spending quota.
+POST /v1beta/cachedContents creates a context cache; generate calls naming an
+unknown cachedContent get a 404, like an expired cache on the real API.
+GET /stats returns request and fault counters; POST /stats/reset clears them.
+
+Usage (from the backend directory):
+    python benchmarks/gemini_stub.py --port 8089 --latency lognormal:400,0.5 --rate-503 0.05
+    GEMINI_BASE_URL=http://127.0.0.1:8089 GEMINI_API_KEY=stub python app.py
+
+Latency specs (milliseconds): const:MS, uniform:LO,HI, exp:MEAN, lognormal:MEDIAN,SIGMA
+"""
+import argparse
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fixtures import TUTOR_ANSWER  # noqa: E402
+
+_ROUTE_RE = re.compile(r"^/v1beta/models/(?P<model>[^/:]+):(?P<method>generateContent|streamGenerateContent)$")
+_CACHED_CONTENTS_PATH = "/v1beta/cachedContents"
+
+_ANSWER_WORDS = TUTOR_ANSWER.split(" ")
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """
+    Parse a latency spec into a sampler returning seconds.
+
+    Args:
+        spec: const:MS, uniform:LO,HI, exp:MEAN or lognormal:MEDIAN,SIGMA
+
+    Returns:
+        A function drawing one latency from the given random generator
+    """
+    kind, _, raw = spec.partition(":")
+    try:
+        values = [float(v) for v in raw.split(",")]
+    except ValueError:
+        values = []
+    if kind == "const" and len(values) == 1:
+        return lambda rng: values[0] / 1000
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1]) / 1000
+    if kind == "exp" and len(values) == 1 and values[0] > 0:
+        return lambda rng: rng.expovariate(1000 / values[0])
+    if kind == "lognormal" and len(values) == 2 and values[0] > 0:
+        return lambda rng: rng.lognormvariate(math.log(values[0] / 1000), values[1])
+    raise ValueError(f"Invalid latency spec: {spec!r}")
+
+
+@dataclass
+class StubConfig:
+    """Behaviour of the stub; rates are probabilities per request."""
+
+    latency: str = "const:0"
+    output_tokens: int = 120
+    tokens_per_s: float = 0.0  # 0 sends output as fast as possible
+    rate_429: float = 0.0
+    rate_500: float = 0.0
+    rate_503: float = 0.0
+    rate_timeout: float = 0.0
+    rate_malformed: float = 0.0
+    timeout_s: float = 60.0  # how long a "timeout" request hangs before closing
+    seed: Optional[int] = None
+    _sample_latency: Callable[[random.Random], float] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._sample_latency = parse_latency(self.latency)
+
+
+class StubState:
+    """Shared counters and random source for all handler threads."""
+
+    def __init__(self, config: StubConfig):
+        self.config = config
+        self._lock = threading.Lock()
+        self._rng = random.Random(config.seed)
+        self.counts: Dict[str, int] = {}
+        self.cached_contents: Set[str] = set()
+
+    def count(self, key: str) -> None:
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def draw(self) -> Tuple[str, float]:
+        """Pick the outcome (ok or an injected fault) and latency of one request."""
+        cfg = self.config
+        with self._lock:
+            roll = self._rng.random()
+            latency = max(0.0, cfg._sample_latency(self._rng))
+        for outcome, rate in (
+            ("429", cfg.rate_429),
+            ("500", cfg.rate_500),
+            ("503", cfg.rate_503),
+            ("timeout", cfg.rate_timeout),
+            ("malformed", cfg.rate_malformed),
+        ):
+            if roll < rate:
+                return outcome, latency
+            roll -= rate
+        return "ok", latency
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counts)
+
+    def create_cached_content(self) -> str:
+        with self._lock:
+            name = f"cachedContents/stub-{len(self.cached_contents) + 1}"
+            self.cached_contents.add(name)
+            self.counts["cached_contents_created"] = self.counts.get("cached_contents_created", 0) + 1
+            return name
+
+    def has_cached_content(self, name: str) -> bool:
+        with self._lock:
+            return name in self.cached_contents
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counts.clear()
+            self.cached_contents.clear()
+
+
+def _answer_tokens(n: int) -> List[str]:
+    words = [_ANSWER_WORDS[i % len(_ANSWER_WORDS)] for i in range(max(1, n))]
+    return [w + " " for w in words[:-1]] + [words[-1]]
+
+
+def _response_body(text: str) -> Dict:
+    return {
+        "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+        "usageMetadata": {"candidatesTokenCount": len(text.split())},
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Request handler; the server's .state holds config and counters."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # noqa: A002 - quiet by default
+        pass
+
+    @property
+    def state(self) -> StubState:
+        return self.server.state  # type: ignore[attr-defined]
+
+    def do_GET(self):
+        if self.path == "/stats":
+            return self._send_json(200, self.state.snapshot())
+        return self._send_json(404, {"error": {"code": 404, "message": "Not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        path = self.path.split("?", 1)[0]
+        if path == "/stats/reset":
+            self.state.reset()
+            return self._send_json(200, {})
+
+        match = _ROUTE_RE.match(path)
+        if not match and path != _CACHED_CONTENTS_PATH:
+            return self._send_json(404, {"error": {"code": 404, "message": "Not found"}})
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            return self._send_json(400, {"error": {"code": 400, "message": "Invalid JSON payload"}})
+        if not match:
+            return self._send_json(200, {"name": self.state.create_cached_content(), "ttl": payload.get("ttl")})
+
+        streaming = match.group("method") == "streamGenerateContent"
+        self.state.count("requests_stream" if streaming else "requests")
+        cached_content = payload.get("cachedContent")
+        if cached_content is not None:
+            if not self.state.has_cached_content(cached_content):
+                self.state.count("cached_content_missing")
+                return self._send_json(404, {"error": {"code": 404, "message": "CachedContent not found"}})
+            self.state.count("with_cached_content")
+        elif "systemInstruction" in payload:
+            self.state.count("with_system_instruction")
+        outcome, latency = self.state.draw()
+        self.state.count(outcome)
+        time.sleep(latency)
+
+        if outcome in ("429", "500", "503"):
+            status = int(outcome)
+            return self._send_json(status, {"error": {"code": status, "message": f"Injected {status}"}})
+        if outcome == "timeout":
+            time.sleep(self.state.config.timeout_s)
+            self.close_connection = True
+            return None
+        if outcome == "malformed":
+            return self._send_raw(200, b'{"candidates": [{"content": ', "application/json")
+
+        tokens = _answer_tokens(self.state.config.output_tokens)
+        if streaming:
+            return self._stream(tokens)
+        tps = self.state.config.tokens_per_s
+        if tps > 0:
+            time.sleep(len(tokens) / tps)
+        return self._send_json(200, _response_body("".join(tokens)))
+
+    def _stream(self, tokens: List[str], per_event: int = 8) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        tps = self.state.config.tokens_per_s
+        for i in range(0, len(tokens), per_event):
+            group = tokens[i:i + per_event]
+            if tps > 0:
+                time.sleep(len(group) / tps)
+            event = f"data: {json.dumps(_response_body(''.join(group)))}\r\n\r\n".encode("utf-8")
+            self.wfile.write(f"{len(event):X}\r\n".encode("ascii") + event + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _send_json(self, status: int, payload: Dict) -> None:
+        self._send_raw(status, json.dumps(payload).encode("utf-8"), "application/json")
+
+    def _send_raw(self, status: int, body: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(config: StubConfig, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Create (but do not start) a stub server; port 0 picks a free port."""
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.state = StubState(config)  # type: ignore[attr-defined]
+    return server
+
+
+def start_in_thread(config: StubConfig, host: str = "127.0.0.1", port: int = 0) -> Tuple[ThreadingHTTPServer, str]:
+    """
+    Start a stub server on a background thread.
+
+    Returns:
+        A tuple of (server, base_url); call server.shutdown() to stop it
+    """
+    server = make_server(config, host, port)
+    threading.Thread(
+        target=server.serve_forever,
+        kwargs={"poll_interval": 0.05},
+        name="gemini-stub",
+        daemon=True,
+    ).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", default="const:0", help="time to first byte, e.g. lognormal:400,0.5")
+    parser.add_argument("--output-tokens", type=int, default=120)
+    parser.add_argument("--tokens-per-s", type=float, default=0.0, help="output speed; 0 means instant")
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-500", type=float, default=0.0)
+    parser.add_argument("--rate-503", type=float, default=0.0)
+    parser.add_argument("--rate-timeout", type=float, default=0.0)
+    parser.add_argument("--rate-malformed", type=float, default=0.0)
+    parser.add_argument("--timeout-s", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    config = StubConfig(
+        latency=args.latency,
+        output_tokens=args.output_tokens,
+        tokens_per_s=args.tokens_per_s,
+        rate_429=args.rate_429,
+        rate_500=args.rate_500,
+        rate_503=args.rate_503,
+        rate_timeout=args.rate_timeout,
+        rate_malformed=args.rate_malformed,
+        timeout_s=args.timeout_s,
+        seed=args.seed,
+    )
+    server = make_server(config, args.host, args.port)
+    print(f"Gemini stub listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
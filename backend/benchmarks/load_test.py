@@ -0,0 +1,335 @@
+"""
+End-to-end load test for /ask-ai and /health.
+
+Drives the backend with a realistic payload mix (short questions, medium
+snippets, 80 KB code blobs, all skill levels) either at a fixed concurrency
+(closed loop) or at a target arrival rate (open loop, Poisson arrivals), and
+writes a JSON report with throughput, latency percentiles, status counts,
+error rates and upstream attempts per request.
+
+By default the Flask app and the Gemini stub (benchmarks/gemini_stub.py)
+both run in this process, so no quota is spent. Use --target to load an
+already running backend and --stub-url to read attempt counts from an
+external stub.
+
+Usage (from the backend directory):
+    python benchmarks/load_test.py --concurrency 16 --duration 20 --latency lognormal:400,0.5
+    python benchmarks/load_test.py --rate 30 --duration 30 --rate-503 0.05 --out report.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fixtures import STUDENT_QUESTION, make_code  # noqa: E402
+from benchmarks.gemini_stub import StubConfig, start_in_thread  # noqa: E402
+from validation import MAX_CODE_CHARS  # noqa: E402
+
+LEVELS = ("beginner", "intermediate", "advanced")
+
+# (name, weight, approximate code size in characters)
+PAYLOAD_MIX = (
+    ("small_question", 0.6, 0),
+    ("snippet", 0.3, 2_000),
+    ("code_blob_80k", 0.1, MAX_CODE_CHARS),
+)
+
+
+def make_ask_body(rng: random.Random, seq: int) -> Tuple[str, Dict[str, str]]:
+    """
+    Draw one /ask-ai body from the payload mix.
+
+    The sequence number makes every question unique so the response cache
+    and request coalescing do not hide upstream load.
+    """
+    roll = rng.random()
+    for name, weight, size in PAYLOAD_MIX:
+        if roll < weight:
+            break
+        roll -= weight
+    body = {
+        "topic": "loops",
+        "code": make_code(size),
+        "question": f"{STUDENT_QUESTION} (#{seq})",
+        "level": rng.choice(LEVELS),
+    }
+    return name, body
+
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile of an ascending list (None when empty)."""
+    if not sorted_values:
+        return None
+    rank = max(1, min(len(sorted_values), int(-(-pct * len(sorted_values) // 100))))
+    return sorted_values[rank - 1]
+
+
+class Recorder:
+    """Thread-safe store of per-request samples."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: List[Tuple[str, str, int, float]] = []  # endpoint, payload, status, seconds
+
+    def add(self, endpoint: str, payload: str, status: int, seconds: float) -> None:
+        with self._lock:
+            self.samples.append((endpoint, payload, status, seconds))
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value, 2)
+
+
+def _summarize(samples: List[Tuple[str, str, int, float]], elapsed_s: float) -> Dict[str, Any]:
+    latencies = sorted(s[3] * 1000 for s in samples)
+    statuses: Dict[str, int] = {}
+    for s in samples:
+        statuses[str(s[2])] = statuses.get(str(s[2]), 0) + 1
+    errors = sum(1 for s in samples if s[2] != 200)
+    return {
+        "requests": len(samples),
+        "rps": round(len(samples) / elapsed_s, 2) if elapsed_s else 0.0,
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "status_counts": statuses,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies), 2) if latencies else None,
+            "p50": _round(percentile(latencies, 50)),
+            "p95": _round(percentile(latencies, 95)),
+            "p99": _round(percentile(latencies, 99)),
+            "max": _round(latencies[-1] if latencies else None),
+        },
+    }
+
+
+def build_report(
+    recorder: Recorder,
+    elapsed_s: float,
+    settings: Dict[str, Any],
+    upstream_stats: Optional[Dict[str, int]],
+) -> Dict[str, Any]:
+    """Turn the recorded samples into the JSON report."""
+    ask = [s for s in recorder.samples if s[0] == "/ask-ai"]
+    health = [s for s in recorder.samples if s[0] == "/health"]
+    report: Dict[str, Any] = {
+        "settings": settings,
+        "elapsed_s": round(elapsed_s, 3),
+        "total": _summarize(recorder.samples, elapsed_s),
+        "endpoints": {
+            "/ask-ai": _summarize(ask, elapsed_s),
+            "/health": _summarize(health, elapsed_s),
+        },
+        "payloads": {
+            name: _summarize([s for s in ask if s[1] == name], elapsed_s) for name, _, _ in PAYLOAD_MIX
+        },
+        "upstream": None,
+    }
+    if upstream_stats is not None:
+        attempts = upstream_stats.get("requests", 0) + upstream_stats.get("requests_stream", 0)
+        report["upstream"] = {
+            "attempts": attempts,
+            "attempts_per_request": round(attempts / len(ask), 3) if ask else None,
+            "outcomes": {k: v for k, v in upstream_stats.items() if not k.startswith("requests")},
+        }
+    return report
+
+
+def _one_request(
+    session: requests.Session,
+    target: str,
+    rng: random.Random,
+    seq: int,
+    health_ratio: float,
+    timeout_s: float,
+    recorder: Recorder,
+    scheduled: Optional[float] = None,
+) -> None:
+    # Open-loop latency counts from the scheduled start so queueing in the
+    # harness is not hidden (coordinated omission).
+    t0 = scheduled if scheduled is not None else time.perf_counter()
+    if rng.random() < health_ratio:
+        endpoint, payload = "/health", "health"
+        call = lambda: session.get(target + endpoint, timeout=timeout_s)  # noqa: E731
+    else:
+        endpoint = "/ask-ai"
+        payload, body = make_ask_body(rng, seq)
+        call = lambda: session.post(target + endpoint, json=body, timeout=timeout_s)  # noqa: E731
+    try:
+        status = call().status_code
+    except requests.RequestException:
+        status = 0  # connection error or client timeout
+    recorder.add(endpoint, payload, status, time.perf_counter() - t0)
+
+
+def run_load(
+    target: str,
+    duration_s: float,
+    concurrency: int,
+    rate: float = 0.0,
+    health_ratio: float = 0.05,
+    timeout_s: float = 60.0,
+    seed: int = 0,
+) -> Tuple[Recorder, float]:
+    """
+    Send load to target for duration_s seconds.
+
+    With rate 0 each of the concurrency workers sends requests back to back.
+    With rate > 0 requests start on a Poisson schedule at that many per
+    second, with at most concurrency in flight (late arrivals wait).
+
+    Returns:
+        A tuple of (recorder, elapsed_seconds)
+    """
+    recorder = Recorder()
+    seq_lock = threading.Lock()
+    counter = [0]
+    start = time.perf_counter()
+    stop_at = start + duration_s
+
+    def next_seq() -> int:
+        with seq_lock:
+            counter[0] += 1
+            return counter[0]
+
+    schedule = None
+    if rate > 0:
+        sched_rng = random.Random(seed)
+        schedule = []
+        t = 0.0
+        while t < duration_s:
+            t += sched_rng.expovariate(rate)
+            schedule.append(start + t)
+        schedule.reverse()  # pop() from the end in time order
+
+    def worker(index: int) -> None:
+        rng = random.Random(seed * 1000 + index)
+        session = requests.Session()
+        while True:
+            due = None
+            if schedule is not None:
+                with seq_lock:
+                    if not schedule:
+                        return
+                    due = schedule.pop()
+                if due >= stop_at:
+                    return
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            elif time.perf_counter() >= stop_at:
+                return
+            _one_request(session, target, rng, next_seq(), health_ratio, timeout_s, recorder, due)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(max(1, concurrency))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder, time.perf_counter() - start
+
+
+def start_backend(stub_url: str, keep_cache: bool) -> Tuple[Any, str]:
+    """
+    Start the Flask app in this process, pointed at the stub.
+
+    Rate limiting is turned off so the harness measures capacity rather than
+    the limiter, and the response cache is emptied unless keep_cache is set.
+    """
+    import app as backend_app
+    import gemini_ai
+    from werkzeug.serving import make_server
+
+    # Per-request log lines would dominate the run; keep warnings and errors.
+    for name in ("ai-python-teacher", "werkzeug"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    gemini_ai.GEMINI_BASE_URL = stub_url
+    gemini_ai.GEMINI_API_KEY = "stub"
+    backend_app.rate_limiter.enabled = False
+    if not keep_cache:
+        backend_app.response_cache.max_entries = 0
+
+    server = make_server("127.0.0.1", 0, backend_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="backend", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", help="base URL of a running backend (default: start one in-process)")
+    parser.add_argument("--stub-url", help="base URL of an external Gemini stub, for attempt counts")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+    parser.add_argument("--concurrency", type=int, default=8, help="workers / max requests in flight")
+    parser.add_argument("--rate", type=float, default=0.0, help="open-loop arrivals per second (0 = closed loop)")
+    parser.add_argument("--health-ratio", type=float, default=0.05, help="share of requests sent to /health")
+    parser.add_argument("--timeout", type=float, default=60.0, help="client timeout per request, seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep-cache", action="store_true", help="leave the response cache on (in-process only)")
+    parser.add_argument("--out", help="write the JSON report here instead of stdout")
+    stub = parser.add_argument_group("in-process stub")
+    stub.add_argument("--latency", default="lognormal:400,0.5")
+    stub.add_argument("--tokens-per-s", type=float, default=0.0)
+    stub.add_argument("--output-tokens", type=int, default=120)
+    stub.add_argument("--rate-429", type=float, default=0.0)
+    stub.add_argument("--rate-500", type=float, default=0.0)
+    stub.add_argument("--rate-503", type=float, default=0.0)
+    stub.add_argument("--rate-timeout", type=float, default=0.0)
+    stub.add_argument("--rate-malformed", type=float, default=0.0)
+    args = parser.parse_args()
+
+    stub_server = backend_server = None
+    stub_url = args.stub_url
+    target = args.target
+    if target is None:
+        if stub_url is None:
+            stub_server, stub_url = start_in_thread(StubConfig(
+                latency=args.latency,
+                output_tokens=args.output_tokens,
+                tokens_per_s=args.tokens_per_s,
+                rate_429=args.rate_429,
+                rate_500=args.rate_500,
+                rate_503=args.rate_503,
+                rate_timeout=args.rate_timeout,
+                rate_malformed=args.rate_malformed,
+                seed=args.seed,
+            ))
+        backend_server, target = start_backend(stub_url, args.keep_cache)
+    target = target.rstrip("/")
+
+    if stub_url:
+        requests.post(stub_url + "/stats/reset", timeout=5)
+    recorder, elapsed = run_load(
+        target,
+        duration_s=args.duration,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        health_ratio=args.health_ratio,
+        timeout_s=args.timeout,
+        seed=args.seed,
+    )
+    upstream_stats = requests.get(stub_url + "/stats", timeout=5).json() if stub_url else None
+
+    settings = {k: v for k, v in vars(args).items() if k != "out"}
+    settings["target"] = target
+    report = json.dumps(build_report(recorder, elapsed, settings, upstream_stats), indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fh:
+            fh.write(report + "\n")
+    else:
+        print(report)
+
+    for server in (backend_server, stub_server):
+        if server is not None:
+            server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
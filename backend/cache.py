@@ -0,0 +1,241 @@
+"""
+Response caching for the AI Python Teacher backend.
+
+This module provides a bounded in-process LRU cache with per-entry expiry,
+used to reuse sanitized tutor answers for prompts that were already answered,
+and singleflight helpers (threaded and asyncio) that coalesce identical
+in-flight upstream calls.
+"""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+
+def build_cache_key(
+    prompt: str,
+    model: str,
+    generation_config: Dict[str, Any],
+    system_instruction: str = "",
+    template_version: str = "",
+) -> str:
+    """
+    Build a stable cache key for a tutor prompt.
+
+    The prompt is normalized (line endings and trailing whitespace) so that
+    cosmetic differences in student input do not defeat the cache.
+
+    Args:
+        prompt: The prompt produced by build_tutor_prompt()
+        model: The Gemini model name
+        generation_config: The generationConfig sent upstream
+        system_instruction: The systemInstruction text sent with the prompt
+        template_version: Version of the prompt template and answer
+            post-processing, so persisted answers are not reused across
+            incompatible releases
+
+    Returns:
+        A hex digest identifying the request
+    """
+    normalized = "\n".join(line.rstrip() for line in prompt.splitlines()).strip()
+    material = json.dumps(
+        {
+            "model": model,
+            "config": generation_config,
+            "system": hashlib.sha256(system_instruction.encode("utf-8")).hexdigest(),
+            "prompt": normalized,
+            "template": template_version,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire after a fixed time-to-live.
+
+    A max_entries of 0 disables the cache: every lookup is a miss and
+    nothing is stored.
+    """
+
+    def __init__(self, max_entries: int, ttl_s: float):
+        self.max_entries = max(0, int(max_entries))
+        self.ttl_s = float(ttl_s)
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the cache stores anything at all."""
+        return self.max_entries > 0 and self.ttl_s > 0
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value for key, or None on a miss or expiry."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        """Store value under key, evicting the least recently used entries."""
+        if not self.enabled:
+            return
+        expires_at = time.monotonic() + self.ttl_s
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """Drop all entries and reset counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Return a snapshot of cache counters."""
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+class _Call:
+    """A single in-flight call whose outcome is shared with waiters."""
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls that share a key into one execution.
+
+    The first caller for a key runs the function; callers arriving while it
+    is in flight block until it finishes and receive the same result, or the
+    same exception.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Run fn once per key among concurrent callers.
+
+        Args:
+            key: Identity of the call
+            fn: Zero-argument callable performing the work
+
+        Returns:
+            A tuple of (result, shared). shared is True when the result came
+            from another caller's execution.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def in_flight(self) -> int:
+        """Return the number of keys currently being executed."""
+        with self._lock:
+            return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """
+    asyncio counterpart of SingleFlight for coroutine callers on one event loop.
+
+    The shared call runs as its own task and every caller awaits it through
+    asyncio.shield(), so cancelling one caller (the first included) does not
+    cancel the call for the others.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, "asyncio.Task[Any]"] = {}
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Await fn() once per key among concurrent callers.
+
+        Returns:
+            A tuple of (result, shared), as for SingleFlight.do().
+        """
+        call = self._calls.get(key)
+        if call is not None:
+            self.coalesced += 1
+            return await asyncio.shield(call), True
+
+        call = asyncio.ensure_future(fn())
+        self._calls[key] = call
+        call.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(call), False
+
+    def _finish(self, key: str, call: "asyncio.Task[Any]") -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if not call.cancelled():
+            call.exception()  # mark retrieved when every caller was cancelled
+
+    def in_flight(self) -> int:
+        """Return the number of keys currently being awaited."""
+        return len(self._calls)
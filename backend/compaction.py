@@ -0,0 +1,373 @@
+"""
+Code compaction for the AI Python Teacher backend.
+
+Student code can be up to 80,000 characters, and every character is paid for
+in upstream tokens and latency. compact_code() shrinks it before prompting:
+
+1. Trailing whitespace and trailing blank lines are stripped.
+2. Optionally, comments are blanked out and multi-line docstrings collapsed.
+3. If the code is still over the token budget and parses, it is sliced
+   (see slicing.slice_code): the definitions the question refers to and
+   their direct dependencies are kept, other definitions become signatures.
+4. If it is still over budget, the lines most relevant to the question are
+   kept: lines named in a pasted traceback, functions and classes the
+   question mentions, imports, then the rest of the slice (signatures of
+   summarized definitions last), nearest to those first. This step works
+   line by line, so it also handles code that does not parse, and the
+   omission markers it adds count against the budget.
+
+Steps 1 and 2 never add or remove lines before the end of the code (removed
+comment and docstring lines are left blank), so under budget every line keeps
+its number and the student's traceback matches the code the tutor sees. Over
+budget, omitted regions are replaced by a marker comment and summarized
+definitions by a signature, both giving the original line numbers.
+"""
+import io
+import re
+import tokenize
+from dataclasses import dataclass, field
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+import metrics
+from config import CODE_COMPACTION_ENABLED, CODE_STRIP_COMMENTS, CODE_TOKEN_BUDGET, logger
+from slicing import question_hints, slice_code
+
+# Rough characters-per-token ratio for Python source
+CHARS_PER_TOKEN = 4
+
+# Lines kept on each side of a line named in a traceback
+TRACEBACK_CONTEXT_LINES = 3
+
+# Longest run of omitted blank lines written out as blank lines when over
+# budget; longer runs get an omission marker
+MAX_BLANK_GAP = 3
+
+_DEF_RE = re.compile(r"^(\s*)(?:async\s+def|def|class)\s+(\w+)")
+_IMPORT_RE = re.compile(r"^(?:import|from)\s")
+
+
+class _Line(NamedTuple):
+    """Text standing for original lines first..last (1-based; equal unless a signature)."""
+
+    first: int
+    last: int
+    text: str
+
+
+@dataclass
+class Compaction:
+    """Result of compact_code(): the code to send and how much was removed."""
+
+    code: str
+    original_chars: int
+    original_lines: int
+    steps: List[str] = field(default_factory=list)
+
+    @property
+    def chars_removed(self) -> int:
+        return self.original_chars - len(self.code)
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.steps)
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of model tokens in text."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _strip_trailing_whitespace(lines: List[_Line]) -> List[_Line]:
+    """Strip each line's trailing whitespace and drop blank lines at the end."""
+    out = [line._replace(text=line.text.rstrip()) for line in lines]
+    while out and not out[-1].text:
+        out.pop()
+    return out
+
+
+def _strip_comments(code: str, lines: List[_Line]) -> List[_Line]:
+    """
+    Drop comments and collapse multi-line docstrings to one line.
+
+    Lines left empty are kept as blank lines so line numbers do not move.
+    Code that does not tokenize (for example an unterminated string) is
+    returned unchanged.
+    """
+    cuts: Dict[int, int] = {}  # original line -> column where a comment starts
+    docstrings: List[Tuple[int, int]] = []  # (first, last) original lines
+    try:
+        prev = tokenize.NEWLINE
+        for tok in tokenize.generate_tokens(io.StringIO(code).readline):
+            if tok.type == tokenize.COMMENT:
+                cuts[tok.start[0]] = tok.start[1]
+            elif (
+                tok.type == tokenize.STRING
+                and prev in (tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT)
+                and tok.end[0] > tok.start[0]
+            ):
+                docstrings.append((tok.start[0], tok.end[0]))
+            if tok.type not in (tokenize.COMMENT, tokenize.NL):
+                prev = tok.type
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return lines
+
+    collapsed: Dict[int, int] = {}  # line inside a docstring -> its first line
+    for first, last in docstrings:
+        for lineno in range(first, last + 1):
+            collapsed[lineno] = first
+
+    out: List[_Line] = []
+    for line in lines:
+        first = collapsed.get(line.first)
+        if first is not None:
+            if first == line.first:
+                indent = line.text[: len(line.text) - len(line.text.lstrip())]
+                out.append(line._replace(text=f'{indent}"""..."""'))
+            else:
+                out.append(line._replace(text=""))
+            continue
+        col = cuts.get(line.first)
+        if col is not None:
+            line = line._replace(text=line.text[:col].rstrip())
+        out.append(line)
+    return out
+
+
+def _block_end(lines: List[_Line], start: int) -> int:
+    """Return the index just past the indented block whose header is lines[start]."""
+    indent = len(lines[start].text) - len(lines[start].text.lstrip())
+    end = start + 1
+    while end < len(lines):
+        text = lines[end].text
+        if text and len(text) - len(text.lstrip()) <= indent:
+            break
+        end += 1
+    while end > start + 1 and not lines[end - 1].text:
+        end -= 1
+    return end
+
+
+def _relevance(lines: List[_Line], question: str) -> Tuple[Set[int], Set[int], List[int]]:
+    """
+    Work out which lines matter for the question.
+
+    Returns:
+        A tuple of (anchors, imports, anchor_positions): indexes of lines that
+        must be kept first, indexes of import lines, and positions used to
+        rank the remaining lines by distance.
+    """
+    index_of = {line.first: i for i, line in enumerate(lines)}
+    anchors: Set[int] = set()
+    positions: List[int] = []
+    linenos, named = question_hints(question)
+
+    for lineno in linenos:
+        nearest = min(index_of, key=lambda n: abs(n - lineno), default=None)
+        if nearest is None or abs(nearest - lineno) > TRACEBACK_CONTEXT_LINES:
+            continue
+        i = index_of[nearest]
+        positions.append(i)
+        anchors.update(range(max(0, i - TRACEBACK_CONTEXT_LINES), min(len(lines), i + TRACEBACK_CONTEXT_LINES + 1)))
+
+    imports: Set[int] = set()
+    for i, line in enumerate(lines):
+        match = _DEF_RE.match(line.text)
+        if match and match.group(2) in named:
+            positions.append(i)
+            anchors.update(range(i, _block_end(lines, i)))
+        elif _IMPORT_RE.match(line.text):
+            imports.add(i)
+    return anchors, imports - anchors, positions
+
+
+def _omits(prev_last: int, first: int, present: Set[int]) -> bool:
+    """Whether any line in present lies strictly between two kept lines."""
+    return any(n in present for n in range(prev_last + 1, first))
+
+
+def _marker(first: int, last: int) -> str:
+    """Return the comment standing for omitted original lines first..last."""
+    return f"# ... lines {first}-{last} omitted ..."
+
+
+def _fit_budget(
+    lines: List[_Line],
+    question: str,
+    budget_tokens: int,
+    present: Set[int],
+    original_lines: int,
+    summarized: Set[int],
+) -> List[_Line]:
+    """
+    Keep the most relevant lines that fit in budget_tokens, in order.
+
+    Lines are ranked anchors first, then imports, then other lines, then the
+    signatures of summarized definitions (by first line in summarized), and
+    by distance from the anchors within each group. The rendered result,
+    omission markers included, fits the budget.
+    """
+    anchors, imports, positions = _relevance(lines, question)
+    # joined[i]: nothing in present lies between lines[i - 1] and lines[i]
+    joined = [False] + [not _omits(lines[i - 1].last, lines[i].first, present) for i in range(1, len(lines))]
+
+    def distance(i: int) -> int:
+        return min((abs(i - p) for p in positions), default=i)
+
+    def group(i: int) -> int:
+        if i in anchors:
+            return 0
+        if i in imports:
+            return 1
+        return 3 if lines[i].first in summarized else 2
+
+    order = sorted(range(len(lines)), key=lambda i: (group(i), distance(i), i))
+    budget_chars = budget_tokens * CHARS_PER_TOKEN
+    marker_chars = len(_marker(original_lines, original_lines)) + 1
+    keep: Set[int] = set()
+    used = 0
+    for i in order:
+        cost = len(lines[i].text) + 1
+        if not (i - 1 in keep and joined[i]) and not (i + 1 in keep and joined[i + 1]):
+            # A new region may need an omission marker; the first one may need two
+            cost += marker_chars if keep else 2 * marker_chars
+        if used + cost > budget_chars:
+            continue
+        keep.add(i)
+        used += cost
+
+    # Blank lines written back between regions are not estimated above, so
+    # drop the least relevant lines until the rendered code fits.
+    ranked = [i for i in order if i in keep]
+    while ranked:
+        kept = [line for i, line in enumerate(lines) if i in keep]
+        if estimate_tokens(_render(kept, present, original_lines)) <= budget_tokens:
+            return kept
+        keep.discard(ranked.pop())
+    return []
+
+
+def _apply_slice(lines: List[_Line], code: str, question: str) -> Optional[Tuple[List[_Line], Set[int]]]:
+    """
+    Reduce lines to the AST slice for question.
+
+    Returns:
+        A tuple of (the sliced lines, first lines of the definitions reduced
+        to signatures), or None if there is no slice
+    """
+    plan = slice_code(code, question)
+    if plan is None:
+        return None
+    out: List[_Line] = []
+    covered = 0  # last original line replaced by a signature
+    for line in lines:
+        if line.first <= covered:
+            continue
+        summary = plan.summaries.get(line.first)
+        if summary is not None:
+            covered, text = summary
+            out.append(_Line(line.first, covered, text))
+        elif line.first in plan.keep or (not line.text and out and out[-1].first in plan.keep):
+            out.append(line)
+    return out, set(plan.summaries)
+
+
+def _render(kept: List[_Line], present: Set[int], original_lines: int) -> str:
+    """
+    Join kept lines, with a marker wherever lines in present were left out.
+
+    Short runs of omitted blank lines are written back as blank lines so the
+    lines after them keep their numbers; longer runs get a marker too.
+    """
+    parts: List[str] = []
+    prev_last = 0
+    end = original_lines + 1
+    for line in kept + [_Line(end, end, "")]:
+        gap = line.first - prev_last - 1
+        if _omits(prev_last, line.first, present) or (gap > MAX_BLANK_GAP and line.first != end):
+            parts.append(_marker(prev_last + 1, line.first - 1))
+        elif gap > 0 and line.first != end:
+            parts.extend([""] * gap)
+        parts.append(line.text)
+        prev_last = line.last
+    return "\n".join(parts[:-1])
+
+
+def compact_code(code: str, question: str = "", budget_tokens: int = 0, strip_comments: bool = False) -> Compaction:
+    """
+    Shrink student code before it is pasted into the prompt.
+
+    Args:
+        code: The student's Python code
+        question: The student's question, searched for traceback line numbers
+            and for names of functions and classes in the code
+        budget_tokens: Estimated token limit for the code (0 for no limit)
+        strip_comments: Whether to drop comments and collapse docstrings
+
+    Returns:
+        A Compaction with the code to send and what was removed
+    """
+    original_lines = len(code.splitlines())
+    result = Compaction(code=code, original_chars=len(code), original_lines=original_lines)
+    if not code:
+        return result
+
+    lines = [_Line(n, n, text) for n, text in enumerate(code.splitlines(), start=1)]
+    lines_out = _strip_trailing_whitespace(lines)
+    text = "\n".join(line.text for line in lines_out)
+    if text != code.rstrip("\n"):
+        result.steps.append("whitespace")
+
+    if strip_comments:
+        stripped = _strip_comments(code, lines_out)
+        if stripped != lines_out:
+            result.steps.append("comments")
+            lines_out = stripped
+            text = "\n".join(line.text for line in lines_out)
+
+    if budget_tokens > 0 and estimate_tokens(text) > budget_tokens:
+        kept = lines_out
+        summarized: Set[int] = set()
+        sliced = _apply_slice(lines_out, code, question)
+        if sliced is not None:
+            result.steps.append("slice")
+            kept, summarized = sliced
+        # Only omitted non-blank lines get a marker
+        present = {line.first for line in lines_out if line.text}
+        if estimate_tokens("\n".join(line.text for line in kept)) > budget_tokens:
+            result.steps.append("budget")
+            kept = _fit_budget(kept, question, budget_tokens, present, original_lines, summarized)
+        text = _render(kept, present, original_lines)
+
+    if result.steps:
+        result.code = text
+    return result
+
+
+def compact_fields(fields: Dict[str, str], request_id: str) -> Dict[str, str]:
+    """
+    Compact the code of validated request fields as configured.
+
+    Args:
+        fields: Validated topic, code, question and level
+        request_id: Request identifier for logging
+
+    Returns:
+        The fields with code replaced by its compacted form
+    """
+    if not CODE_COMPACTION_ENABLED or not fields["code"]:
+        return fields
+    result = compact_code(fields["code"], fields["question"], CODE_TOKEN_BUDGET, CODE_STRIP_COMMENTS)
+    metrics.code_chars_removed.observe(result.chars_removed)
+    if not result.changed:
+        return fields
+    for step in result.steps:
+        metrics.code_compactions.inc(step)
+    logger.info(
+        "code_compacted request_id=%s steps=%s chars=%s->%s removed=%s",
+        request_id,
+        ",".join(result.steps),
+        result.original_chars,
+        len(result.code),
+        result.chars_removed,
+    )
+    return {**fields, "code": result.code}
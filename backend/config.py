@@ -20,9 +20,113 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "").strip()
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash").strip()
 GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com").strip()
 
+# Gemini context caching of the static tutor instructions (off by default;
+# the API rejects contents below its minimum cacheable token count)
+GEMINI_CONTEXT_CACHE_ENABLED = os.getenv("GEMINI_CONTEXT_CACHE_ENABLED", "0") == "1"
+GEMINI_CONTEXT_CACHE_TTL_S = float(os.getenv("GEMINI_CONTEXT_CACHE_TTL_S", "3600"))
+# Longest a request waits for the cache to be created (never more than half its
+# remaining deadline) before sending the instructions inline; creation goes on
+# in the background
+GEMINI_CONTEXT_CACHE_MAX_WAIT_S = float(os.getenv("GEMINI_CONTEXT_CACHE_MAX_WAIT_S", "1"))
+
+# Compaction of student code before prompting (a budget of 0 disables the
+# relevance cut; whitespace is always normalized when enabled)
+CODE_COMPACTION_ENABLED = os.getenv("CODE_COMPACTION_ENABLED", "1") == "1"
+CODE_TOKEN_BUDGET = int(os.getenv("CODE_TOKEN_BUDGET", "4000"))
+CODE_STRIP_COMMENTS = os.getenv("CODE_STRIP_COMMENTS", "0") == "1"
+
+# Answer code that does not parse locally, from the SyntaxError, without calling Gemini
+SYNTAX_FAST_PATH_ENABLED = os.getenv("SYNTAX_FAST_PATH_ENABLED", "1") == "1"
+
+# FAQ answers for common questions asked without code (see faq.py); the index
+# is memory-mapped from FAQ_INDEX_PATH, or built from FAQ_CORPUS_PATH if missing
+_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+FAQ_ENABLED = os.getenv("FAQ_ENABLED", "1") == "1"
+FAQ_INDEX_PATH = os.getenv("FAQ_INDEX_PATH", os.path.join(_DATA_DIR, "faq.idx"))
+FAQ_CORPUS_PATH = os.getenv("FAQ_CORPUS_PATH", os.path.join(_DATA_DIR, "faq.jsonl"))
+FAQ_MIN_SCORE = float(os.getenv("FAQ_MIN_SCORE", "0.8"))
+
 # Request configuration
 REQUEST_TIMEOUT_S = float(os.getenv("REQUEST_TIMEOUT_S", "20"))
 RETRY_DELAYS_S: List[int] = [1, 2, 4, 8, 16]
+# Total time budget per request across all attempts and backoff (0 disables);
+# clients may ask for less with an X-Deadline-Ms header.
+REQUEST_DEADLINE_S = float(os.getenv("REQUEST_DEADLINE_S", "25"))
+
+# Circuit breaker around the Gemini upstream
+CIRCUIT_BREAKER_ENABLED = os.getenv("CIRCUIT_BREAKER_ENABLED", "1") == "1"
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))
+CIRCUIT_TIMEOUT_RATE = float(os.getenv("CIRCUIT_TIMEOUT_RATE", "0.3"))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "10"))
+CIRCUIT_WINDOW_S = float(os.getenv("CIRCUIT_WINDOW_S", "30"))
+CIRCUIT_OPEN_S = float(os.getenv("CIRCUIT_OPEN_S", "15"))
+CIRCUIT_HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", "2"))
+
+# Hedged upstream requests (off by default)
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "0") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_DELAY_S = float(os.getenv("HEDGE_MIN_DELAY_S", "1.0"))
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MAX_WORKERS = int(os.getenv("HEDGE_MAX_WORKERS", "64"))
+
+# Rate limiting for /ask-ai (a rate of 0 disables that bucket). Clients without a
+# configured API key are limited per IP, so everyone behind one NAT (a classroom)
+# shares a bucket; the per-client defaults leave room for that.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_CLIENT_RPS = float(os.getenv("RATE_LIMIT_CLIENT_RPS", "2"))
+RATE_LIMIT_CLIENT_BURST = float(os.getenv("RATE_LIMIT_CLIENT_BURST", "30"))
+RATE_LIMIT_GLOBAL_RPS = float(os.getenv("RATE_LIMIT_GLOBAL_RPS", "10"))
+RATE_LIMIT_GLOBAL_BURST = float(os.getenv("RATE_LIMIT_GLOBAL_BURST", "30"))
+RATE_LIMIT_MAX_CLIENTS = int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "10000"))
+# Only enable behind a proxy that sets X-Forwarded-For; otherwise clients can spoof it.
+# RATE_LIMIT_PROXY_HOPS is the number of proxies that append to it (the client's
+# address is that many entries from the right).
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "0") == "1"
+RATE_LIMIT_PROXY_HOPS = int(os.getenv("RATE_LIMIT_PROXY_HOPS", "1"))
+# Comma-separated X-Api-Key values that get their own bucket; other keys are ignored
+RATE_LIMIT_API_KEYS = frozenset(k.strip() for k in os.getenv("RATE_LIMIT_API_KEYS", "").split(",") if k.strip())
+
+# Admission control for upstream calls from /ask-ai (0 concurrent disables)
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "32"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_MAX_WAIT_S = float(os.getenv("ADMISSION_MAX_WAIT_S", "2"))
+
+# Batch endpoint limits
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "50"))
+BATCH_MAX_PARALLEL = int(os.getenv("BATCH_MAX_PARALLEL", "8"))
+
+# Prometheus /metrics endpoint
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+
+# Server-Timing response header with a per-stage breakdown (off by default)
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "0") == "1"
+
+# Response cache configuration (0 entries disables the cache). The "sqlite"
+# backend keeps answers in RESPONSE_CACHE_PATH, shared by all workers on the
+# host and kept across restarts; "memory" is per process.
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory").strip().lower()
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_TTL_S = float(os.getenv("RESPONSE_CACHE_TTL_S", "600"))
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", os.path.join(_DATA_DIR, "response_cache.sqlite3"))
+# Compressed size limit for the sqlite backend (0 for no limit)
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Reuse cached answers for submissions equivalent up to naming, comments and
+# formatting (see fingerprint.py), and optionally for near duplicates at or
+# above the estimated similarity (0, the default, disables near matching: a
+# near duplicate may have a different bug). Remembered answers have their own
+# store, in DEDUP_CACHE_PATH with the sqlite backend, capped at DEDUP_MAX_ENTRIES.
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1") == "1"
+DEDUP_NEAR_MIN_SIMILARITY = float(os.getenv("DEDUP_NEAR_MIN_SIMILARITY", "0"))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "1024"))
+DEDUP_CACHE_PATH = os.getenv("DEDUP_CACHE_PATH", os.path.join(_DATA_DIR, "dedup_cache.sqlite3"))
+
+# Replay of retried requests by X-Request-Id: duplicates of an in-flight
+# request wait for it, and completed responses are replayed for the TTL
+IDEMPOTENCY_ENABLED = os.getenv("IDEMPOTENCY_ENABLED", "1") == "1"
+IDEMPOTENCY_TTL_S = float(os.getenv("IDEMPOTENCY_TTL_S", "300"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "1024"))
 
 # CORS configuration
 CORS_ORIGINS_RAW = os.getenv("CORS_ORIGINS", "*").strip()
@@ -0,0 +1,124 @@
+"""
+Gemini context caching for the AI Python Teacher backend.
+
+This module keeps one cached-content resource holding the static tutor
+instructions, so requests can reference it by name instead of resending the
+instructions. Creation is done by a caller-supplied function on a
+background thread, so a request waits for it at most as long as it chooses;
+until it finishes, and when it fails (for example because the content is
+below the API's minimum cacheable size), requests fall back to sending
+systemInstruction inline, and a failed creation is not retried until a
+back-off has passed.
+"""
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+
+class ContextCache:
+    """
+    Thread-safe holder of a cached-content resource name with local expiry.
+
+    The resource is renewed refresh_margin_s before its TTL runs out. Only one
+    creation runs at a time, on its own thread; other callers carry on with
+    the current name (or none) meanwhile.
+    """
+
+    def __init__(
+        self,
+        create: Callable[[float], Optional[str]],
+        ttl_s: float,
+        enabled: bool = True,
+        refresh_margin_s: float = 60.0,
+        retry_after_failure_s: float = 300.0,
+    ):
+        self._create = create
+        self.ttl_s = ttl_s
+        self.enabled = enabled
+        self.refresh_margin_s = min(refresh_margin_s, ttl_s / 2)
+        self.retry_after_failure_s = retry_after_failure_s
+
+        self._lock = threading.Lock()
+        self._creating = threading.Lock()
+        self._name: Optional[str] = None
+        self._expires_at = 0.0
+        self._retry_at = 0.0
+        self.created = 0
+        self.failures = 0
+        self.invalidations = 0
+
+    def name(self, create: bool = True, wait_s: Optional[float] = None) -> Optional[str]:
+        """
+        Return the current resource name, creating it if needed.
+
+        Args:
+            create: Whether this call may create or renew the resource; when
+                False only an existing, unexpired name is returned
+            wait_s: Longest time to wait for a creation this call starts
+                (None waits until it finishes); the creation carries on in
+                the background after that
+
+        Returns:
+            The cached-content name, or None when requests should send the
+            instructions inline
+        """
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            name = self._name if now < self._expires_at else None
+            fresh = name is not None and now < self._expires_at - self.refresh_margin_s
+            may_create = create and now >= self._retry_at
+        if fresh or not may_create:
+            return name
+        if not self._creating.acquire(blocking=False):
+            return name  # another thread is creating it
+        done = threading.Event()
+        threading.Thread(target=self._refresh, args=(done,), name="context-cache-create", daemon=True).start()
+        done.wait(wait_s)
+        with self._lock:
+            return self._name if time.monotonic() < self._expires_at else None
+
+    def _refresh(self, done: threading.Event) -> None:
+        """Create the resource and record the outcome; runs on its own thread."""
+        try:
+            new_name = self._create(self.ttl_s)
+        except Exception:
+            new_name = None
+        with self._lock:
+            if new_name:
+                self._name = new_name
+                self._expires_at = time.monotonic() + self.ttl_s
+                self.created += 1
+            else:
+                self.failures += 1
+                self._retry_at = time.monotonic() + self.retry_after_failure_s
+        self._creating.release()
+        done.set()
+
+    def invalidate(self, name: str) -> None:
+        """Forget name after the API reported it missing or expired."""
+        with self._lock:
+            if self._name == name:
+                self._name = None
+                self._expires_at = 0.0
+                self.invalidations += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return the cache state for /health."""
+        with self._lock:
+            active = self._name is not None and time.monotonic() < self._expires_at
+            return {
+                "enabled": self.enabled,
+                "active": active,
+                "created": self.created,
+                "failures": self.failures,
+                "invalidations": self.invalidations,
+            }
+
+    def reset(self) -> None:
+        """Forget the resource and counters."""
+        with self._lock:
+            self._name = None
+            self._expires_at = self._retry_at = 0.0
+            self.created = self.failures = self.invalidations = 0
@@ -0,0 +1,336 @@
+"""
+Offline FAQ retrieval for the AI Python Teacher backend.
+
+Conceptual questions without code ("what is a variable", "difference between
+list and tuple") arrive over and over. This module answers them from a
+curated corpus instead of calling Gemini. Questions are normalized to terms
+and compared by TF-IDF cosine similarity; a match above a threshold returns
+the stored answer. Only phrasings that contain every query term the corpus
+knows can match, so a narrower question ("what is a class variable") is not
+answered with a broader entry ("what is a class") that scores close to it.
+
+The corpus is a JSONL file with one entry per line:
+    {"question": "...", "alternates": ["..."], "level": "beginner", "answer": "..."}
+level is beginner, intermediate, advanced or any. Each phrasing (question and
+alternates) is indexed as its own document pointing at the shared answer.
+
+The index is a single binary file built offline (as a deploy step) and
+memory-mapped when the app starts:
+    python faq.py build data/faq.jsonl data/faq.idx
+
+Without an index file the corpus is indexed in memory at startup instead.
+
+File layout (little-endian): magic, uint32 header length, JSON header (term
+table and section offsets), then, 4-byte aligned, the postings of (uint32
+doc, float32 weight) per term, a (uint32 answer, uint32 level) row per
+document, an (offset, length) row per answer, and the UTF-8 answer texts.
+Only the term table is decoded at load; postings and answers are read from
+the mapping on demand.
+"""
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+import metrics
+from config import FAQ_CORPUS_PATH, FAQ_ENABLED, FAQ_INDEX_PATH, FAQ_MIN_SCORE, logger
+
+_MAGIC = b"FAQIDX01"
+_POSTING = struct.Struct("<If")
+_DOC = struct.Struct("<II")
+_ANSWER = struct.Struct("<II")
+
+LEVELS = ("any", "beginner", "intermediate", "advanced")
+
+_TOKEN_RE = re.compile(r"[a-z0-9_]+")
+_STOPWORDS = frozenset(
+    "a an the is are was were be been am i me my we you your it its this that these those what whats "
+    "how do does did can could should would will to of in on for with and or but if so as at by "
+    "about please tell explain mean means python"
+    .split()
+)
+
+
+def normalize(text: str) -> List[str]:
+    """
+    Turn question text into index terms.
+
+    Lowercases, drops stopwords and strips a plural "s", so "What are
+    variables?" and "what is a variable" give the same terms.
+    """
+    terms = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        if token in _STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith(("ss", "us", "is")):
+            token = token[:-1]
+        terms.append(token)
+    return terms
+
+
+def _idf(doc_count: int, doc_freq: int) -> float:
+    return math.log((doc_count + 1) / (doc_freq + 1)) + 1.0
+
+
+def _term_weights(terms: Iterable[str], idf: Dict[str, float], unknown_idf: float) -> Dict[str, float]:
+    """Log-scaled TF-IDF weights; terms missing from the corpus get unknown_idf."""
+    return {t: (1.0 + math.log(tf)) * idf.get(t, unknown_idf) for t, tf in Counter(terms).items()}
+
+
+def load_corpus(path: str) -> List[Dict[str, Any]]:
+    """
+    Read and check a JSONL corpus.
+
+    Raises:
+        ValueError: If a line is not a valid entry
+    """
+    entries = []
+    with open(path, encoding="utf-8") as fh:
+        for number, line in enumerate(fh, start=1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError as exc:
+                raise ValueError(f"{path}:{number}: invalid JSON: {exc}") from exc
+            if not isinstance(entry, dict) or not entry.get("question") or not entry.get("answer"):
+                raise ValueError(f"{path}:{number}: entries need 'question' and 'answer'")
+            if entry.get("level", "any") not in LEVELS:
+                raise ValueError(f"{path}:{number}: level must be one of {', '.join(LEVELS)}")
+            entries.append(entry)
+    return entries
+
+
+def build_index(entries: List[Dict[str, Any]]) -> bytes:
+    """
+    Build the binary index for corpus entries.
+
+    Args:
+        entries: Corpus entries as returned by load_corpus()
+
+    Returns:
+        The index file contents
+    """
+    docs: List[Tuple[int, int, List[str]]] = []  # (answer id, level code, terms)
+    answers: List[bytes] = []
+    for answer_id, entry in enumerate(entries):
+        answers.append(entry["answer"].encode("utf-8"))
+        level = LEVELS.index(entry.get("level", "any"))
+        for phrasing in [entry["question"]] + list(entry.get("alternates", [])):
+            terms = normalize(phrasing)
+            if terms:
+                docs.append((answer_id, level, terms))
+
+    doc_freq: Counter = Counter()
+    for _, _, terms in docs:
+        doc_freq.update(set(terms))
+    idf = {t: _idf(len(docs), df) for t, df in doc_freq.items()}
+
+    postings: Dict[str, List[Tuple[int, float]]] = defaultdict(list)
+    for doc_id, (_, _, terms) in enumerate(docs):
+        weights = _term_weights(terms, idf, 0.0)
+        norm = math.sqrt(sum(w * w for w in weights.values()))
+        for term, weight in weights.items():
+            postings[term].append((doc_id, weight / norm))
+
+    postings_blob = bytearray()
+    term_table: Dict[str, List[Any]] = {}
+    for term in sorted(postings):
+        term_table[term] = [len(postings_blob), len(postings[term]), idf[term]]
+        for doc_id, weight in postings[term]:
+            postings_blob += _POSTING.pack(doc_id, weight)
+    docs_blob = b"".join(_DOC.pack(answer_id, level) for answer_id, level, _ in docs)
+    answers_table = bytearray()
+    answers_blob = bytearray()
+    for text in answers:
+        answers_table += _ANSWER.pack(len(answers_blob), len(text))
+        answers_blob += text
+
+    sections = [("postings", postings_blob), ("docs", docs_blob), ("answers", answers_table), ("texts", answers_blob)]
+    offsets: Dict[str, int] = {}
+    data = bytearray()
+    for name, blob in sections:
+        offsets[name] = len(data)
+        data += blob
+    header = json.dumps(
+        {"docs": len(docs), "answers": len(answers), "terms": term_table, "sections": offsets},
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+    out = bytearray(_MAGIC + struct.pack("<I", len(header)) + header)
+    out += b"\0" * (-len(out) % 4)  # sections start 4-byte aligned
+    out += data
+    return bytes(out)
+
+
+class FaqIndex:
+    """Read-only view over an index built by build_index(); safe to share between threads."""
+
+    def __init__(self, buf: Union[bytes, mmap.mmap]):
+        if buf[: len(_MAGIC)] != _MAGIC:
+            raise ValueError("Not a FAQ index file")
+        (header_len,) = struct.unpack_from("<I", buf, len(_MAGIC))
+        start = len(_MAGIC) + 4
+        header = json.loads(bytes(buf[start:start + header_len]))
+        data_at = start + header_len
+        data_at += -data_at % 4
+        self._buf = buf
+        self._view = memoryview(buf)
+        self._terms: Dict[str, List[Any]] = header["terms"]
+        self._idf = {t: v[2] for t, v in self._terms.items()}
+        self._unknown_idf = _idf(header["docs"], 0)
+        self._sections = {name: data_at + offset for name, offset in header["sections"].items()}
+        self.doc_count: int = header["docs"]
+        self.answer_count: int = header["answers"]
+
+    @classmethod
+    def open(cls, path: str) -> "FaqIndex":
+        """Memory-map an index file."""
+        with open(path, "rb") as fh:
+            return cls(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def _answer(self, answer_id: int) -> str:
+        offset, length = _ANSWER.unpack_from(self._view, self._sections["answers"] + answer_id * _ANSWER.size)
+        start = self._sections["texts"] + offset
+        return bytes(self._view[start:start + length]).decode("utf-8")
+
+    def lookup(self, question: str, level: str = "any") -> Tuple[Optional[str], float]:
+        """
+        Find the closest corpus question for a level.
+
+        Args:
+            question: The student's question
+            level: beginner, intermediate or advanced; entries for "any"
+                level always qualify
+
+        Returns:
+            A tuple of (answer, score) for the best match among the phrasings
+            containing every query term in the index, where score is the
+            cosine similarity in [0, 1]; answer is None if nothing matched
+        """
+        weights = _term_weights(normalize(question), self._idf, self._unknown_idf)
+        norm = math.sqrt(sum(w * w for w in weights.values()))
+        if not norm:
+            return None, 0.0
+        scores: Dict[int, float] = defaultdict(float)
+        matched: Counter = Counter()
+        known = 0
+        postings_at = self._sections["postings"]
+        for term, weight in weights.items():
+            entry = self._terms.get(term)
+            if entry is None:
+                continue
+            known += 1
+            start = postings_at + entry[0]
+            end = start + entry[1] * _POSTING.size
+            for doc_id, doc_weight in _POSTING.iter_unpack(self._view[start:end]):
+                scores[doc_id] += weight * doc_weight
+                matched[doc_id] += 1
+
+        wanted = (0, LEVELS.index(level)) if level in LEVELS else (0,)
+        docs_at = self._sections["docs"]
+        for doc_id, score in sorted(scores.items(), key=lambda item: -item[1]):
+            if matched[doc_id] < known:
+                continue  # the phrasing lacks a term the question asks about
+            answer_id, doc_level = _DOC.unpack_from(self._view, docs_at + doc_id * _DOC.size)
+            if doc_level in wanted:
+                return self._answer(answer_id), score / norm
+        return None, 0.0
+
+
+_index: Optional[FaqIndex] = None
+_index_loaded = False
+_index_lock = threading.Lock()
+
+
+def _load_index() -> Optional[FaqIndex]:
+    """Map FAQ_INDEX_PATH, or build from FAQ_CORPUS_PATH in memory if there is no index file."""
+    try:
+        if os.path.exists(FAQ_INDEX_PATH):
+            index = FaqIndex.open(FAQ_INDEX_PATH)
+            source = FAQ_INDEX_PATH
+        elif os.path.exists(FAQ_CORPUS_PATH):
+            index = FaqIndex(build_index(load_corpus(FAQ_CORPUS_PATH)))
+            source = FAQ_CORPUS_PATH
+        else:
+            logger.warning("faq_index_missing path=%s", FAQ_INDEX_PATH)
+            return None
+    except (OSError, ValueError) as exc:
+        logger.warning("faq_index_error err=%s", exc)
+        return None
+    logger.info("faq_index_loaded source=%s docs=%s answers=%s", source, index.doc_count, index.answer_count)
+    return index
+
+
+def get_index() -> Optional[FaqIndex]:
+    """Return the process-wide index, loading it on first use."""
+    global _index, _index_loaded
+    if not _index_loaded:
+        with _index_lock:
+            if not _index_loaded:
+                _index = _load_index()
+                _index_loaded = True
+    return _index
+
+
+def faq_answer(fields: Dict[str, str], request_id: str) -> Optional[str]:
+    """
+    Answer a code-less question from the FAQ index when it matches closely.
+
+    Args:
+        fields: Validated topic, code, question and level
+        request_id: Request identifier for logging
+
+    Returns:
+        The stored answer, or None when FAQ answers are off, code was sent,
+        or no entry scores at least FAQ_MIN_SCORE
+    """
+    if not FAQ_ENABLED or fields["code"].strip():
+        return None
+    index = get_index()
+    if index is None:
+        return None
+    level = (fields["level"] or "beginner").strip().lower()
+    answer, score = index.lookup(fields["question"], level)
+    if answer is None or score < FAQ_MIN_SCORE:
+        metrics.faq_lookups.inc("miss")
+        return None
+    metrics.faq_lookups.inc("hit")
+    logger.info("faq_hit request_id=%s score=%.3f", request_id, score)
+    return answer
+
+
+def snapshot() -> Dict[str, Any]:
+    """Return the FAQ state for /health."""
+    index = _index if _index_loaded else None
+    return {
+        "enabled": FAQ_ENABLED,
+        "loaded": index is not None,
+        "entries": index.answer_count if index else 0,
+        "hits": metrics.faq_lookups.value("hit"),
+        "misses": metrics.faq_lookups.value("miss"),
+    }
+
+
+def main(argv: List[str]) -> int:
+    if len(argv) != 4 or argv[1] != "build":
+        print("usage: python faq.py build CORPUS.jsonl OUT.idx", file=sys.stderr)
+        return 2
+    data = build_index(load_corpus(argv[2]))
+    tmp_path = argv[3] + ".tmp"
+    with open(tmp_path, "wb") as fh:
+        fh.write(data)
+    os.replace(tmp_path, argv[3])  # atomic, so running workers never map a partial file
+    index = FaqIndex(data)
+    print(f"wrote {argv[3]}: {index.answer_count} answers, {index.doc_count} phrasings, {len(data)} bytes")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,399 @@
+"""
+Near-duplicate detection of student submissions for the AI Python Teacher backend.
+
+In a classroom many students submit the same program with different variable
+names, formatting or comments, and the exact prompt cache misses all of them.
+fingerprint_fields() parses the code, renames user-defined identifiers to
+canonical names in order of appearance, drops docstrings and unparses it, so
+comments and formatting disappear too. The canonical code, with the topic,
+question and level normalized the same way, is hashed into a cache key.
+
+Answers are remembered in answer_cache, a store of their own (so they do not
+take room from the response cache), under that key together with the
+original identifier names. An equivalent submission gets the answer with the
+names translated inside code spans. If a renamed identifier also appears in
+the prose, the answer is not reused, because words in prose cannot be
+translated safely.
+
+For submissions that are similar but not equivalent, near matching can be
+turned on with DEDUP_NEAR_MIN_SIMILARITY (off by default, since a near
+duplicate can have a different bug). A MinHash signature over token shingles
+of the canonical code is then indexed with LSH, bucketed by question. A
+candidate is reused only when its estimated similarity reaches the threshold
+and every identifier the answer mentions also exists in the new code. The
+LSH index is per process; the answers it points at live in answer_cache.
+"""
+import ast
+import hashlib
+import random
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import metrics
+from cache import build_cache_key
+from config import (
+    DEDUP_CACHE_PATH,
+    DEDUP_ENABLED,
+    DEDUP_MAX_ENTRIES,
+    DEDUP_NEAR_MIN_SIMILARITY,
+    GEMINI_MODEL,
+    logger,
+)
+from gemini_ai import GENERATION_CONFIG, PROMPT_TEMPLATE_VERSION, TUTOR_SYSTEM_INSTRUCTION, build_tutor_prompt
+from persistent_cache import open_response_cache
+
+# MinHash signature length and its split into LSH bands; 8 bands of 4 rows
+# make pairs above about 0.6 similarity likely to share a bucket.
+MINHASH_PERMUTATIONS = 32
+LSH_BANDS = 8
+
+# Token n-gram length for shingles, and the most shingles hashed per
+# submission (the smallest hashes are kept, so the sample is consistent)
+SHINGLE_SIZE = 3
+MAX_SHINGLES = 4000
+
+# Larger submissions are rarely duplicated and not worth canonicalizing
+MAX_CODE_CHARS = 8000
+
+# Near-match candidates checked per lookup
+MAX_CANDIDATES = 8
+
+_KEY_PREFIX = "fp:"
+_MERSENNE_61 = (1 << 61) - 1
+_rng = random.Random(0x5EED)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_61), _rng.randrange(0, _MERSENNE_61)) for _ in range(MINHASH_PERMUTATIONS)
+]
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+_IDENT_RE = re.compile(r"[A-Za-z_]\w*")
+_CODE_SPAN_RE = re.compile(r"(```.*?(?:```|$)|`[^`\n]+`)", re.DOTALL)
+
+_SCOPE_TYPES = (ast.Module, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+
+@dataclass
+class Fingerprint:
+    """
+    Canonical identity of a submission.
+
+    names[i] is the student's identifier that became canonical name _v{i};
+    signature is the MinHash of the canonical code (empty when near matching
+    is off).
+    """
+
+    key: str
+    question_key: str
+    names: List[str]
+    signature: List[int] = field(default_factory=list)
+
+
+def _bound_names(nodes: List[ast.AST]) -> Set[str]:
+    """Names the student defines: assignment targets, functions, classes, parameters."""
+    bound: Set[str] = set()
+    imported: Set[str] = set()
+    attributes: Set[str] = set()
+    for node in nodes:
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            bound.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            bound.add(node.name)
+        elif isinstance(node, ast.alias):
+            imported.add((node.asname or node.name).split(".")[0])
+        elif isinstance(node, ast.Attribute):
+            attributes.add(node.attr)
+    # Imports and dunder protocol names keep their meaning under any renaming.
+    # So do names also used as attributes (obj.name): attribute lookups are
+    # not renamed, so renaming a method defined as "area" would make it look
+    # like one defined as "perimeter" when the code calls r.perimeter().
+    return {
+        n for n in bound - imported - attributes if not (n.startswith("__") and n.endswith("__"))
+    }
+
+
+def canonicalize(code: str) -> Optional[Tuple[str, List[str]]]:
+    """
+    Rewrite code into a canonical form that ignores naming, comments and formatting.
+
+    Args:
+        code: The student's Python code
+
+    Returns:
+        A tuple of (canonical code, original names in canonical order), or
+        None when the code does not parse or is nested too deeply to handle
+    """
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        return None
+
+    # ast.walk visits nodes in a fixed order for a given tree shape, so
+    # equivalent programs get the same numbering whatever their formatting.
+    nodes = list(ast.walk(tree))
+    for node in nodes:
+        if isinstance(node, _SCOPE_TYPES) and node.body:
+            first = node.body[0]
+            if isinstance(first, ast.Expr) and isinstance(first.value, ast.Constant):
+                if isinstance(first.value.value, str):  # docstring
+                    node.body = node.body[1:] or [ast.Pass()]
+
+    bound = _bound_names(nodes)
+    names: List[str] = []
+    mapping: Dict[str, str] = {}
+
+    def rename(name: Optional[str]) -> Optional[str]:
+        if name not in bound:
+            return name
+        if name not in mapping:
+            mapping[name] = f"_v{len(names)}"
+            names.append(name)
+        return mapping[name]
+
+    for node in nodes:
+        if isinstance(node, ast.Name):
+            node.id = rename(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            node.name = rename(node.name)
+        elif isinstance(node, ast.arg):
+            node.arg = rename(node.arg)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            node.name = rename(node.name)
+        elif isinstance(node, ast.keyword) and node.arg:
+            node.arg = rename(node.arg)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            node.names = [rename(n) for n in node.names]
+    try:
+        # unparse recurses deeper than parse, so it can fail on code that parsed
+        return ast.unparse(tree), names
+    except (RecursionError, MemoryError):
+        return None
+
+
+def _normalize_text(text: str, mapping: Dict[str, str]) -> str:
+    """Apply the identifier renaming to free text, then fold case, spacing and end punctuation."""
+    renamed = _IDENT_RE.sub(lambda m: mapping.get(m.group(0), m.group(0)), text)
+    return " ".join(renamed.lower().split()).rstrip("?!. ")
+
+
+def minhash(text: str) -> List[int]:
+    """Return the MinHash signature of the token shingles of text."""
+    tokens = _TOKEN_RE.findall(text)
+    shingles = {" ".join(tokens[i:i + SHINGLE_SIZE]) for i in range(max(1, len(tokens) - SHINGLE_SIZE + 1))}
+    hashes = sorted(
+        int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little") for s in shingles
+    )[:MAX_SHINGLES]
+    return [min((a * h + b) % _MERSENNE_61 for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def similarity(a: List[int], b: List[int]) -> float:
+    """Estimate the Jaccard similarity of two submissions from their signatures."""
+    if not a or len(a) != len(b):
+        return 0.0
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+def _cache_key(material: str) -> str:
+    return _KEY_PREFIX + build_cache_key(
+        material, GEMINI_MODEL, GENERATION_CONFIG, TUTOR_SYSTEM_INSTRUCTION, PROMPT_TEMPLATE_VERSION
+    )
+
+
+def fingerprint_fields(fields: Dict[str, str]) -> Optional[Fingerprint]:
+    """
+    Fingerprint validated request fields.
+
+    Args:
+        fields: Validated topic, code, question and level
+
+    Returns:
+        The fingerprint, or None when deduplication is off, the code is
+        missing or longer than MAX_CODE_CHARS, or it does not parse
+    """
+    if not DEDUP_ENABLED or not fields["code"].strip() or len(fields["code"]) > MAX_CODE_CHARS:
+        return None
+    result = canonicalize(fields["code"])
+    if result is None:
+        return None
+    code, names = result
+    mapping = {name: f"_v{i}" for i, name in enumerate(names)}
+    topic = _normalize_text(fields["topic"], mapping)
+    question = _normalize_text(fields["question"], mapping)
+    level = (fields["level"] or "beginner").strip().lower()
+    return Fingerprint(
+        key=_cache_key(build_tutor_prompt(topic, code, question, level)),
+        question_key=_cache_key(build_tutor_prompt(topic, "", question, level)),
+        names=names,
+        signature=minhash(code) if DEDUP_NEAR_MIN_SIMILARITY > 0 else [],
+    )
+
+
+def _name_pattern(names: Set[str]) -> "re.Pattern[str]":
+    """Match any of names as a whole identifier, not as an attribute."""
+    alternatives = "|".join(re.escape(n) for n in sorted(names, key=len, reverse=True))
+    return re.compile(rf"(?<![\w.])({alternatives})(?!\w)")
+
+
+def translate_answer(answer: str, old_names: List[str], new_names: List[str]) -> Optional[str]:
+    """
+    Rename identifiers in an answer written for an equivalent submission.
+
+    Args:
+        answer: The answer given for the earlier submission
+        old_names: Identifiers of the earlier submission in canonical order
+        new_names: Identifiers of the new submission in canonical order
+
+    Returns:
+        The answer with names replaced inside code spans and blocks, or None
+        when a name that differs also appears in the prose
+    """
+    if len(old_names) != len(new_names):
+        return None
+    changes = {old: new for old, new in zip(old_names, new_names) if old != new}
+    if not changes:
+        return answer
+    pattern = _name_pattern(set(changes))
+    parts = _CODE_SPAN_RE.split(answer)
+    for i, part in enumerate(parts):
+        if i % 2:
+            parts[i] = pattern.sub(lambda m: changes[m.group(1)], part)
+        elif pattern.search(part):
+            return None
+    return "".join(parts)
+
+
+def _mentions_missing_names(answer: str, old_names: List[str], new_names: List[str]) -> bool:
+    missing = set(old_names) - set(new_names)
+    return bool(missing) and _name_pattern(missing).search(answer) is not None
+
+
+class NearDuplicateIndex:
+    """
+    Thread-safe LSH index from MinHash bands to fingerprint keys.
+
+    Holds at most max_entries fingerprints and forgets the least recently
+    added or matched first.
+    """
+
+    def __init__(self, max_entries: int, bands: int = LSH_BANDS):
+        self.max_entries = max(0, int(max_entries))
+        self.bands = bands
+        self._entries: "OrderedDict[str, List[Tuple[str, int, Tuple[int, ...]]]]" = OrderedDict()
+        self._buckets: Dict[Tuple[str, int, Tuple[int, ...]], Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def _band_keys(self, fp: Fingerprint) -> List[Tuple[str, int, Tuple[int, ...]]]:
+        rows = len(fp.signature) // self.bands
+        return [(fp.question_key, b, tuple(fp.signature[b * rows:(b + 1) * rows])) for b in range(self.bands)]
+
+    def add(self, fp: Fingerprint) -> None:
+        """Index fp, evicting the oldest entries beyond max_entries."""
+        if not fp.signature or not self.max_entries:
+            return
+        with self._lock:
+            if fp.key in self._entries:
+                self._entries.move_to_end(fp.key)
+                return
+            band_keys = self._band_keys(fp)
+            self._entries[fp.key] = band_keys
+            for band_key in band_keys:
+                self._buckets.setdefault(band_key, set()).add(fp.key)
+            while len(self._entries) > self.max_entries:
+                old_key, old_bands = self._entries.popitem(last=False)
+                for band_key in old_bands:
+                    bucket = self._buckets.get(band_key)
+                    if bucket is not None:
+                        bucket.discard(old_key)
+                        if not bucket:
+                            del self._buckets[band_key]
+
+    def candidates(self, fp: Fingerprint) -> List[str]:
+        """Return keys sharing a band with fp, most shared bands first."""
+        if not fp.signature:
+            return []
+        shared: Dict[str, int] = {}
+        with self._lock:
+            for band_key in self._band_keys(fp):
+                for key in self._buckets.get(band_key, ()):
+                    if key != fp.key:
+                        shared[key] = shared.get(key, 0) + 1
+        return sorted(shared, key=lambda k: -shared[k])[:MAX_CANDIDATES]
+
+    def clear(self) -> None:
+        """Forget all fingerprints."""
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+# Remembered answers by fingerprint key, with their own entry limit
+answer_cache = open_response_cache(DEDUP_MAX_ENTRIES, DEDUP_CACHE_PATH)
+
+near_index = NearDuplicateIndex(DEDUP_MAX_ENTRIES)
+
+
+def lookup(fp: Optional[Fingerprint], request_id: str, cache: Any = None) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Find a remembered answer for an equivalent or near-duplicate submission.
+
+    Args:
+        fp: The submission's fingerprint, or None
+        request_id: Request identifier for logging
+        cache: The store holding remembered answers (default answer_cache)
+
+    Returns:
+        A tuple of (answer, match) where match is "equivalent" or "near", or
+        (None, None) when nothing can be reused
+    """
+    if fp is None:
+        return None, None
+    if cache is None:
+        cache = answer_cache
+    entry = cache.get(fp.key)
+    if entry is not None:
+        answer = translate_answer(entry["answer"], entry["names"], fp.names)
+        if answer is not None:
+            metrics.dedup_lookups.inc("equivalent")
+            logger.info("dedup_hit request_id=%s match=equivalent", request_id)
+            return answer, "equivalent"
+        metrics.dedup_lookups.inc("unsafe")
+        return None, None
+
+    best: Optional[Tuple[float, Dict[str, Any]]] = None
+    for key in near_index.candidates(fp):
+        candidate = cache.get(key)
+        if candidate is None:
+            continue
+        score = similarity(fp.signature, candidate["signature"])
+        if score >= DEDUP_NEAR_MIN_SIMILARITY and (best is None or score > best[0]):
+            best = (score, candidate)
+    if best is not None:
+        score, candidate = best
+        if not _mentions_missing_names(candidate["answer"], candidate["names"], fp.names):
+            metrics.dedup_lookups.inc("near")
+            logger.info("dedup_hit request_id=%s match=near similarity=%.2f", request_id, score)
+            return candidate["answer"], "near"
+        metrics.dedup_lookups.inc("unsafe")
+        return None, None
+    metrics.dedup_lookups.inc("miss")
+    return None, None
+
+
+def remember(fp: Optional[Fingerprint], answer: str, cache: Any = None) -> None:
+    """Store answer for later equivalent and near-duplicate submissions (in answer_cache by default)."""
+    if fp is None:
+        return
+    if cache is None:
+        cache = answer_cache
+    cache.set(fp.key, {"answer": answer, "names": fp.names, "signature": fp.signature})
+    near_index.add(fp)
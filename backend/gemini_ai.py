@@ -4,45 +4,233 @@ Gemini AI API module for the AI Python Teacher backend.
 This module handles all interactions with the Google Gemini API,
 including request building, error handling, and response parsing.
 """
+import json
 import re
+import socket
 import threading
 import time
-from typing import Any, Dict, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Iterator, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
+import metrics
+import server_timing
 from config import (
+    CIRCUIT_BREAKER_ENABLED,
+    CIRCUIT_FAILURE_RATE,
+    CIRCUIT_HALF_OPEN_PROBES,
+    CIRCUIT_MIN_CALLS,
+    CIRCUIT_OPEN_S,
+    CIRCUIT_TIMEOUT_RATE,
+    CIRCUIT_WINDOW_S,
     GEMINI_API_KEY,
     GEMINI_BASE_URL,
+    GEMINI_CONTEXT_CACHE_ENABLED,
+    GEMINI_CONTEXT_CACHE_MAX_WAIT_S,
+    GEMINI_CONTEXT_CACHE_TTL_S,
     GEMINI_MODEL,
+    HEDGE_ENABLED,
+    HEDGE_MAX_RATIO,
+    HEDGE_MAX_WORKERS,
+    HEDGE_MIN_DELAY_S,
+    HEDGE_MIN_SAMPLES,
+    HEDGE_PERCENTILE,
     REQUEST_TIMEOUT_S,
     RETRY_DELAYS_S,
     logger,
 )
+from context_cache import ContextCache
+from resilience import FAILURE, SUCCESS, TIMEOUT, CircuitBreaker, HedgePolicy
 
-# Pre-compiled regex for code block detection
-_CODEBLOCK_RE = re.compile(r"```(?:[\w+-]+)?\n(.*?)```", re.DOTALL)
+# Optional language tag after an opening ```; the tag must be followed by a newline
+_FENCE_LANG_RE = re.compile(r"[\w+-]*")
+
+# Line boundaries recognised by str.splitlines()
+_LINE_BREAKS = "\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+_LINE_BREAK_RE = re.compile(f"\r\n|[{_LINE_BREAKS}]")
 
 # Constants for output sanitization
 MAX_CODE_BLOCK_LINES = 8  # Maximum lines in a code block before omitting
 SUSPICIOUS_LINE_THRESHOLD = 12  # Number of suspicious lines before truncation
 MAX_OUTPUT_LINES = 120  # Maximum lines to keep when truncating
+_SUSPICIOUS_LINE_STARTS = ("import ", "from ", "def ", "class ", "if __name__")
+# Leading whitespace (as stripped by lstrip()) followed by a suspicious prefix
+_SUSPICIOUS_PREFIX = (
+    f"[^\\S{_LINE_BREAKS}]*(?:"
+    + "|".join(re.escape(p) for p in _SUSPICIOUS_LINE_STARTS)
+    + ")"
+)
+_SUSPICIOUS_FIRST_LINE_RE = re.compile(_SUSPICIOUS_PREFIX)
+_SUSPICIOUS_LINE_RE = re.compile(f"[{_LINE_BREAKS}]{_SUSPICIOUS_PREFIX}")
+_CODE_OMITTED_NOTICE = (
+    "[Code omitted to keep this tutor-focused. "
+    "Ask for a hint about a specific line or error message, and I'll guide you.]"
+)
+_OUTPUT_TRUNCATED_NOTICE = "[Output truncated to avoid full-solution code.]"
+
+# Sampling parameters sent with every request (also part of the response cache key)
+GENERATION_CONFIG: Dict[str, Any] = {
+    "temperature": 0.4,
+    "topP": 0.9,
+    "maxOutputTokens": 900,
+}
+
+# Static tutoring rules and response format, sent as systemInstruction (or
+# through a cached-content resource) instead of with every prompt.
+# Part of every response cache key; bump it when the prompt template, tutor
+# rules or sanitizer change so cached answers from older releases are not served.
+PROMPT_TEMPLATE_VERSION = "1"
+
+TUTOR_SYSTEM_INSTRUCTION = """You are an AI Python Tutor embedded in a learning app.
+
+STRICT TUTOR MODE (must follow):
+- Do NOT provide a complete, ready-to-run corrected program.
+- Do NOT output large code blocks. If you must show code, keep it to <= 5 lines and only as illustrative snippets.
+- Prefer: hints, analogies, line-by-line explanations, and guided questions.
+- When there is an error/bug, explain the *why* (root cause) before suggesting fixes.
+- If the student asks for the answer, refuse politely and provide scaffolding instead.
+- If the student code is unsafe or irrelevant, explain what's wrong and redirect.
+
+Required response format (use these headings):
+1) Diagnosis (1-3 sentences)
+2) Why it happens (conceptual explanation)
+3) Hints (3-7 bullets, ordered from easiest to hardest)
+4) Check yourself (2-4 quick questions the student should answer)
+5) Next small step (one actionable step the student can do now)
+"""
+
+# HTTP statuses worth retrying (rate limits / transient server errors)
+_RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+# Statuses meaning a referenced cached-content resource is gone or unusable;
+# 400 and 403 only count when the error names the cached content
+_STALE_CACHE_STATUSES = (400, 403, 404)
+_CACHE_ERROR_MARKERS = ("cachedcontent", "cached content", "cached_content")
+
+# Shared by every upstream call path in the process (sync, streaming and async)
+upstream_breaker = CircuitBreaker(
+    failure_rate=CIRCUIT_FAILURE_RATE,
+    timeout_rate=CIRCUIT_TIMEOUT_RATE,
+    min_calls=CIRCUIT_MIN_CALLS,
+    window_s=CIRCUIT_WINDOW_S,
+    open_s=CIRCUIT_OPEN_S,
+    half_open_probes=CIRCUIT_HALF_OPEN_PROBES,
+    enabled=CIRCUIT_BREAKER_ENABLED,
+)
+
+# Backup requests for slow generateContent calls (see _post_generate)
+upstream_hedging = HedgePolicy(
+    percentile=HEDGE_PERCENTILE,
+    min_delay_s=HEDGE_MIN_DELAY_S,
+    max_ratio=HEDGE_MAX_RATIO,
+    min_samples=HEDGE_MIN_SAMPLES,
+    enabled=HEDGE_ENABLED,
+)
+
+# Cached-content resource holding TUTOR_SYSTEM_INSTRUCTION (see _create_cached_content)
+tutor_context = ContextCache(
+    create=lambda ttl_s: _create_cached_content(ttl_s),
+    ttl_s=GEMINI_CONTEXT_CACHE_TTL_S,
+    enabled=GEMINI_CONTEXT_CACHE_ENABLED,
+)
 
 # Thread-local storage for HTTP sessions (thread-safe connection pooling)
 _thread_local = threading.local()
 
+# Worker threads for hedged requests; created on first use
+_hedge_pool: Optional[ThreadPoolExecutor] = None
+_hedge_pool_lock = threading.Lock()
+
+
+class _HedgedAttempt:
+    """
+    A primary generateContent request that a winning hedge may abort.
+
+    The connection is recorded by the session's pools while the primary runs
+    on its calling thread; abort() shuts its socket down so the blocked POST
+    fails at once instead of running to completion.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.conn: Any = None
+        self.done = False
+        self.aborted = False
+        self.hedge: Optional[Future] = None
+
+    def abort(self) -> None:
+        with self.lock:
+            if self.done:
+                return
+            self.aborted = True
+            sock = getattr(self.conn, "sock", None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class _TrackingPoolMixin:
+    """Record the connection taken by a thread's in-flight hedged attempt."""
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        attempt = getattr(_thread_local, "attempt", None)
+        if attempt is not None:
+            attempt.conn = conn
+        return conn
+
+
+class _TrackingHTTPConnectionPool(_TrackingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _TrackingHTTPSConnectionPool(_TrackingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class _TrackingAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools let a winning hedge abort the primary request."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TrackingHTTPConnectionPool,
+            "https": _TrackingHTTPSConnectionPool,
+        }
+
 
 def _get_http_session() -> requests.Session:
     """Get or create a thread-local HTTP session for connection pooling."""
     if not hasattr(_thread_local, 'session'):
-        _thread_local.session = requests.Session()
+        session = requests.Session()
+        adapter = _TrackingAdapter()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _thread_local.session = session
     return _thread_local.session
 
 
+def _get_hedge_pool() -> ThreadPoolExecutor:
+    """Get or create the thread pool used for hedged requests."""
+    global _hedge_pool
+    with _hedge_pool_lock:
+        if _hedge_pool is None:
+            _hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="gemini-hedge")
+        return _hedge_pool
+
+
 def build_tutor_prompt(topic: str, code: str, question: str, level: str) -> str:
     """
-    Build a structured prompt for the AI tutor.
-    
+    Build the per-request part of the tutor prompt.
+
+    The fixed tutoring rules and response format live in
+    TUTOR_SYSTEM_INSTRUCTION and are sent separately as systemInstruction.
+
     Args:
         topic: The Python topic being studied
         code: The student's Python code
@@ -56,17 +244,7 @@ def build_tutor_prompt(topic: str, code: str, question: str, level: str) -> str:
     if level_norm not in {"beginner", "intermediate", "advanced"}:
         level_norm = "beginner"
 
-    return f"""You are an AI Python Tutor embedded in a learning app.
-
-STRICT TUTOR MODE (must follow):
-- Do NOT provide a complete, ready-to-run corrected program.
-- Do NOT output large code blocks. If you must show code, keep it to <= 5 lines and only as illustrative snippets.
-- Prefer: hints, analogies, line-by-line explanations, and guided questions.
-- When there is an error/bug, explain the *why* (root cause) before suggesting fixes.
-- If the student asks for the answer, refuse politely and provide scaffolding instead.
-- If the student code is unsafe or irrelevant, explain what's wrong and redirect.
-
-Student context:
+    return f"""Student context:
 - Topic: {topic or "(unspecified)"}
 - Level: {level_norm}
 
@@ -77,13 +255,6 @@ Student code:
 
 Student question:
 {question}
-
-Required response format (use these headings):
-1) Diagnosis (1-3 sentences)
-2) Why it happens (conceptual explanation)
-3) Hints (3-7 bullets, ordered from easiest to hardest)
-4) Check yourself (2-4 quick questions the student should answer)
-5) Next small step (one actionable step the student can do now)
 """
 
 
@@ -101,35 +272,515 @@ def sanitize_tutor_output(text: str) -> str:
     if not text:
         return text
 
-    def _replace_block(match: re.Match) -> str:
-        body = match.group(1) or ""
-        body_lines = body.splitlines()
-        if len(body_lines) > MAX_CODE_BLOCK_LINES:
-            return (
-                "[Code omitted to keep this tutor-focused. "
-                "Ask for a hint about a specific line or error message, and I'll guide you.]"
-            )
-        return match.group(0)
-
-    text2 = _CODEBLOCK_RE.sub(_replace_block, text)
+    t0 = time.perf_counter()
+    text2, suspicious = _scan_fences(text)
+    if text2 is not text:
+        metrics.sanitizer_actions.inc("code_omitted")
 
     # Heuristic: if it looks like a full solution dump without fences, clamp length.
-    suspicious_line_starts = ("import ", "from ", "def ", "class ", "if __name__")
-    lines = text2.splitlines()
-    suspicious = sum(1 for ln in lines if ln.lstrip().startswith(suspicious_line_starts))
     if suspicious >= SUSPICIOUS_LINE_THRESHOLD:
-        text2 = "\n".join(lines[:MAX_OUTPUT_LINES]) + "\n\n[Output truncated to avoid full-solution code.]"
+        lines = text2.splitlines()
+        text2 = "\n".join(lines[:MAX_OUTPUT_LINES]) + "\n\n" + _OUTPUT_TRUNCATED_NOTICE
+        metrics.sanitizer_actions.inc("truncated")
 
+    metrics.sanitizer_seconds.observe(time.perf_counter() - t0)
     return text2
 
 
-def generate_response(prompt: str, request_id: str) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+def _scan_fences(text: str) -> Tuple[str, int]:
+    """
+    Replace over-long fenced code blocks and count suspicious lines in one pass.
+
+    A block is ``` plus an optional [\\w+-] language tag and a newline, up to
+    the next ```. Scanning only moves forward: once an opening fence has no
+    closer, no later fence can have one either, so the scan stops there.
+
+    Args:
+        text: The raw response text from the AI
+
+    Returns:
+        A tuple of (text_with_blocks_replaced, suspicious_line_count)
+    """
+    pieces = []
+    # Later lines are counted through the line break that precedes them.
+    suspicious = 1 if _SUSPICIOUS_FIRST_LINE_RE.match(text) else 0
+    pos = 0  # start of the text copied through unchanged
+    scan = 0
+    while True:
+        start = text.find("```", scan)
+        if start < 0:
+            break
+        lang_end = _FENCE_LANG_RE.match(text, start + 3).end()
+        if text[lang_end:lang_end + 1] != "\n":
+            scan = start + 1
+            continue
+        close = text.find("```", lang_end + 1)
+        if close < 0:
+            break
+        if len(text[lang_end + 1:close].splitlines()) > MAX_CODE_BLOCK_LINES:
+            # The notice has no line breaks, so lines starting in the copied
+            # text are the same before and after the rewrite.
+            suspicious += len(_SUSPICIOUS_LINE_RE.findall(text, pos, start))
+            pieces.append(text[pos:start])
+            pieces.append(_CODE_OMITTED_NOTICE)
+            pos = close + 3
+        scan = close + 3
+
+    suspicious += len(_SUSPICIOUS_LINE_RE.findall(text, pos))
+    if not pieces:
+        return text, suspicious
+    pieces.append(text[pos:])
+    return "".join(pieces), suspicious
+
+
+class _FenceFilter:
+    """
+    Incremental form of the fence rewriting done by _scan_fences().
+
+    Text outside code fences is released as soon as it cannot start a fence;
+    an opened fence is held until its closing ``` arrives, then emitted
+    as-is or replaced by the omission notice.
+    """
+
+    def __init__(self):
+        self._buf = ""
+        self._body_start = -1  # >= 0 while a fence is open
+        self._scan = 0  # where to resume searching for ```
+
+    def feed(self, chunk: str, final: bool = False) -> str:
+        buf = self._buf + chunk
+        out = []
+        pos = 0
+        scan = self._scan
+
+        while True:
+            if self._body_start >= 0:
+                close = buf.find("```", scan)
+                if close < 0:
+                    scan = max(self._body_start, len(buf) - 2)
+                    break
+                body = buf[self._body_start:close]
+                if len(body.splitlines()) > MAX_CODE_BLOCK_LINES:
+                    out.append(_CODE_OMITTED_NOTICE)
+                else:
+                    out.append(buf[pos:close + 3])
+                pos = scan = close + 3
+                self._body_start = -1
+                continue
+
+            start = buf.find("```", scan)
+            if start < 0:
+                # A trailing ` or `` may still become a fence with the next chunk.
+                end = len(buf)
+                while not final and end > max(pos, len(buf) - 2) and buf[end - 1] == "`":
+                    end -= 1
+                out.append(buf[pos:end])
+                pos = scan = end
+                break
+
+            i = _FENCE_LANG_RE.match(buf, start + 3).end()
+            if i == len(buf) and not final:
+                # The language tag may continue in the next chunk.
+                out.append(buf[pos:start])
+                pos = scan = start
+                break
+            if i < len(buf) and buf[i] == "\n":
+                out.append(buf[pos:start])
+                pos = start
+                self._body_start = scan = i + 1
+            else:
+                # Not an opening fence; like the regex, retry one character later.
+                scan = start + 1
+
+        if final:
+            # An unterminated fence has no closer, so nothing after it can match.
+            out.append(buf[pos:])
+            pos = scan = len(buf)
+            self._body_start = -1
+
+        self._buf = buf[pos:]
+        self._scan = scan - pos
+        if self._body_start >= 0:
+            self._body_start -= pos
+        return "".join(out)
+
+
+class StreamingSanitizer:
+    """
+    Incremental version of sanitize_tutor_output() for token streams.
+
+    Feed chunks as they arrive and send whatever feed() returns; call close()
+    once at the end for the remainder. The concatenated output is identical
+    to sanitize_tutor_output() on the full text. Text is released as soon as
+    it is the same whether or not the answer is later truncated; only open
+    code fences and text that the truncation rule could still rewrite are
+    held back.
+    """
+
+    def __init__(self):
+        self._fences = _FenceFilter()
+        self._carry = ""  # current line, not yet terminated
+        self._lines = 0
+        self._suspicious = 0
+        self._sent_chars = 0  # chars of the current line already emitted
+        self._holding = False
+        self._held = []  # raw text withheld until the truncation decision
+        self._unsent_head = []  # lines within MAX_OUTPUT_LINES not yet emitted
+        self._truncated = False
+
+    def feed(self, chunk: str) -> str:
+        """Consume a chunk of model output and return the text now safe to send."""
+        if not chunk:
+            return ""
+        return self._clamp(self._fences.feed(chunk), final=False)
+
+    def close(self) -> str:
+        """Flush the stream and return the remaining sanitized text."""
+        out = self._clamp(self._fences.feed("", final=True), final=True)
+        if self._truncated:
+            if self._lines < MAX_OUTPUT_LINES:
+                out += "\n" + _OUTPUT_TRUNCATED_NOTICE
+        else:
+            out += "".join(self._held)
+            self._held = []
+        return out
+
+    def _clamp(self, text: str, final: bool) -> str:
+        out = []
+        data = self._carry + text
+        start = 0
+        for match in _LINE_BREAK_RE.finditer(data):
+            if match.group() == "\r" and match.end() == len(data) and not final:
+                break  # may be the first half of \r\n
+            self._end_line(data[start:match.start()], match.group(), out)
+            start = match.end()
+        self._carry = data[start:]
+
+        if final:
+            if self._carry:
+                self._end_line(self._carry, "", out)
+                self._carry = ""
+        elif self._lines < MAX_OUTPUT_LINES and (self._truncated or not self._holding):
+            visible = self._carry[:-1] if self._carry.endswith("\r") else self._carry
+            out.append(visible[self._sent_chars:])
+            self._sent_chars = len(visible)
+        return "".join(out)
+
+    def _end_line(self, content: str, terminator: str, out: list) -> None:
+        index = self._lines
+        self._lines += 1
+        if content.lstrip().startswith(_SUSPICIOUS_LINE_STARTS):
+            self._suspicious += 1
+
+        if self._truncated:
+            # Truncated output is the first MAX_OUTPUT_LINES lines joined by \n.
+            if index < MAX_OUTPUT_LINES:
+                out.append(content[self._sent_chars:] + "\n")
+                self._sent_chars = 0
+                if self._lines == MAX_OUTPUT_LINES:
+                    out.append("\n" + _OUTPUT_TRUNCATED_NOTICE)
+            return
+
+        if not self._holding and index < MAX_OUTPUT_LINES and terminator == "\n":
+            # Identical in the truncated and untouched output: send it now.
+            out.append(content[self._sent_chars:] + "\n")
+            self._sent_chars = 0
+        else:
+            self._held.append((content if self._holding else content[self._sent_chars:]) + terminator)
+            if index < MAX_OUTPUT_LINES:
+                self._unsent_head.append(content)
+            self._holding = True
+
+        if self._suspicious >= SUSPICIOUS_LINE_THRESHOLD:
+            self._truncated = True
+            self._held = []
+            for line in self._unsent_head:
+                out.append(line[self._sent_chars:] + "\n")
+                self._sent_chars = 0
+            self._unsent_head = []
+            if self._lines >= MAX_OUTPUT_LINES:
+                out.append("\n" + _OUTPUT_TRUNCATED_NOTICE)
+
+
+def _system_instruction() -> Dict[str, Any]:
+    return {"parts": [{"text": TUTOR_SYSTEM_INSTRUCTION}]}
+
+
+def _build_payload(prompt: str, cached_content: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Build the generateContent request body for a prompt.
+
+    The tutor instructions are referenced through cached_content when given,
+    otherwise sent inline as systemInstruction.
+    """
+    payload: Dict[str, Any] = {
+        "contents": [
+            {
+                "role": "user",
+                "parts": [{"text": prompt}],
+            }
+        ],
+        "generationConfig": dict(GENERATION_CONFIG),
+    }
+    if cached_content:
+        payload["cachedContent"] = cached_content
+    else:
+        payload["systemInstruction"] = _system_instruction()
+    return payload
+
+
+def _create_cached_content(ttl_s: float) -> Optional[str]:
+    """Register TUTOR_SYSTEM_INSTRUCTION as a cached-content resource and return its name."""
+    if not GEMINI_API_KEY:
+        return None
+    try:
+        resp = _get_http_session().post(
+            f"{GEMINI_BASE_URL}/v1beta/cachedContents",
+            params={"key": GEMINI_API_KEY},
+            json={
+                "model": f"models/{GEMINI_MODEL}",
+                "systemInstruction": _system_instruction(),
+                "ttl": f"{int(ttl_s)}s",
+            },
+            timeout=REQUEST_TIMEOUT_S,
+        )
+    except requests.RequestException as exc:
+        logger.warning("gemini_context_cache_error err=%s", exc)
+        return None
+    if resp.status_code != 200:
+        logger.warning("gemini_context_cache_rejected status=%s body=%s", resp.status_code, resp.text[:500])
+        return None
+    name = resp.json().get("name")
+    logger.info("gemini_context_cache_created name=%s ttl_s=%s", name, int(ttl_s))
+    return name
+
+
+def _stale_cached_content(
+    cached_content: Optional[str],
+    status_code: int,
+    error: Optional[Dict[str, Any]],
+    request_id: str,
+) -> bool:
+    """
+    Check whether a failed call referenced a cached-content resource that is gone.
+
+    A 404 always counts. A 400 or 403 counts only when the error body names
+    the cached content, so a bad prompt does not throw away a good cache for
+    every request. The resource is forgotten so the caller can retry at once
+    with inline instructions; that retry does not use up a retry slot.
+    """
+    if not cached_content or status_code not in _STALE_CACHE_STATUSES:
+        return False
+    if status_code != 404:
+        detail = json.dumps((error or {}).get("body"), ensure_ascii=False).lower()
+        if cached_content.lower() not in detail and not any(m in detail for m in _CACHE_ERROR_MARKERS):
+            return False
+    logger.warning("gemini_context_cache_stale request_id=%s status=%s", request_id, status_code)
+    tutor_context.invalidate(cached_content)
+    return True
+
+
+def _extract_text(data: Dict[str, Any]) -> str:
+    """Join the text parts of the first candidate in a Gemini response."""
+    # Typical structure: candidates[0].content.parts[0].text
+    cand0 = (data.get("candidates") or [])[0]
+    content = (cand0.get("content") or {})
+    parts = content.get("parts") or []
+    return "".join(p.get("text", "") for p in parts if isinstance(p, dict))
+
+
+def _http_error(resp: Any) -> Dict[str, Any]:
+    """Build the error dict for a non-200 Gemini response (requests or httpx)."""
+    try:
+        body = resp.json()
+    except Exception:
+        body = {"text": resp.text[:2000]}
+    return {
+        "message": "Gemini HTTP error",
+        "status": resp.status_code,
+        "body": body,
+    }
+
+
+def _context_cache_wait(deadline: Optional[float]) -> float:
+    """Return how long to wait for context-cache creation, leaving most of the deadline for generation."""
+    if deadline is None:
+        return GEMINI_CONTEXT_CACHE_MAX_WAIT_S
+    return max(0.0, min(GEMINI_CONTEXT_CACHE_MAX_WAIT_S, (deadline - time.monotonic()) / 2))
+
+
+def _attempt_timeout(deadline: Optional[float]) -> float:
+    """Return the timeout for the next attempt, shrunk to the remaining budget."""
+    if deadline is None:
+        return REQUEST_TIMEOUT_S
+    return min(REQUEST_TIMEOUT_S, deadline - time.monotonic())
+
+
+def _sleep_overruns(delay_s: float, deadline: Optional[float]) -> bool:
+    """Whether backing off for delay_s would leave no time for another attempt."""
+    return deadline is not None and time.monotonic() + delay_s >= deadline
+
+
+def _deadline_exceeded(
+    request_id: str,
+    attempt: int,
+    last_err: Optional[Dict[str, Any]],
+) -> Tuple[None, Dict[str, Any]]:
+    """Log and build the result for a request that ran out of time."""
+    logger.warning("gemini_deadline_exceeded request_id=%s attempt=%s", request_id, attempt)
+    err: Dict[str, Any] = {"message": "Gemini deadline exceeded.", "deadline_exceeded": True}
+    if last_err:
+        err["last_error"] = last_err
+    return None, err
+
+
+def _circuit_open(
+    request_id: str,
+    attempt: int,
+    last_err: Optional[Dict[str, Any]],
+) -> Tuple[None, Dict[str, Any]]:
+    """Log and build the result for a call rejected by the circuit breaker."""
+    logger.warning("gemini_circuit_open request_id=%s attempt=%s", request_id, attempt)
+    err: Dict[str, Any] = {
+        "message": "Gemini is unavailable; not retrying while the circuit is open.",
+        "circuit_open": True,
+        "retry_after_s": round(upstream_breaker.retry_after_s(), 1),
+    }
+    if last_err:
+        err["last_error"] = last_err
+    return None, err
+
+
+def _timed_post(url: str, params: Dict[str, Any], payload: Dict[str, Any], timeout_s: float) -> requests.Response:
+    """POST to Gemini, feeding successful latencies to the hedging policy."""
+    t0 = time.monotonic()
+    resp = _get_http_session().post(url, params=params, json=payload, timeout=timeout_s)
+    if resp.status_code == 200:
+        upstream_hedging.record_latency(time.monotonic() - t0)
+    return resp
+
+
+def _close_response(future: Future) -> None:
+    """Release the connection held by a losing hedged request."""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def _send_hedge(
+    attempt: _HedgedAttempt,
+    url: str,
+    params: Dict[str, Any],
+    payload: Dict[str, Any],
+    timeout_s: float,
+    request_id: str,
+) -> None:
+    """Submit the hedge for attempt to the pool unless the primary already finished."""
+    with attempt.lock:
+        if attempt.done:
+            return
+        if upstream_breaker.state != CircuitBreaker.CLOSED or not upstream_hedging.try_acquire():
+            return
+        logger.info("gemini_hedge request_id=%s", request_id)
+        metrics.upstream_hedges.inc("sent")
+        attempt.hedge = _get_hedge_pool().submit(_run_hedge, attempt, url, params, payload, timeout_s)
+
+
+def _run_hedge(
+    attempt: _HedgedAttempt,
+    url: str,
+    params: Dict[str, Any],
+    payload: Dict[str, Any],
+    timeout_s: float,
+) -> requests.Response:
+    """Send the hedge request; a 200 aborts the primary if it is still running."""
+    resp = _timed_post(url, params, payload, timeout_s)
+    if resp.status_code == 200:
+        attempt.abort()
+    return resp
+
+
+def _post_generate(
+    url: str,
+    params: Dict[str, Any],
+    payload: Dict[str, Any],
+    timeout_s: float,
+    request_id: str,
+) -> requests.Response:
+    """
+    Send one generateContent attempt, hedging it when the primary is slow.
+
+    Without a hedge delay (hedging off or too few latency samples) this is a
+    plain POST. Otherwise the primary is sent from the calling thread and a
+    timer started at the same moment submits an identical request to the
+    hedge pool if the primary has not answered within the delay, the breaker
+    is closed and the hedge budget allows. The first 200 wins: a winning
+    hedge aborts the primary's connection, and a winning primary cancels or
+    closes the hedge. Raises like requests.Session.post when no call succeeds.
+    """
+    upstream_hedging.note_primary()
+    delay_s = upstream_hedging.hedge_delay()
+    if delay_s is None or delay_s >= timeout_s:
+        return _timed_post(url, params, payload, timeout_s)
+
+    attempt = _HedgedAttempt()
+    timer = threading.Timer(
+        delay_s, _send_hedge,
+        args=(attempt, url, params, payload, max(0.001, timeout_s - delay_s), request_id),
+    )
+    timer.daemon = True
+    _thread_local.attempt = attempt
+    timer.start()
+    resp: Optional[requests.Response] = None
+    error: Optional[requests.RequestException] = None
+    try:
+        resp = _timed_post(url, params, payload, timeout_s)
+    except requests.RequestException as exc:
+        error = exc
+    finally:
+        _thread_local.attempt = None
+        timer.cancel()
+        with attempt.lock:
+            attempt.done = True
+
+    hedge = attempt.hedge
+    if hedge is None:
+        if error is not None:
+            raise error
+        return resp
+    if resp is not None and resp.status_code == 200 and not attempt.aborted:
+        if not hedge.cancel():
+            hedge.add_done_callback(_close_response)
+        return resp
+
+    try:
+        hedged: Optional[requests.Response] = hedge.result()
+    except requests.RequestException:
+        hedged = None
+    if hedged is not None and hedged.status_code == 200:
+        upstream_hedging.note_win()
+        logger.info("gemini_hedge_won request_id=%s", request_id)
+        metrics.upstream_hedges.inc("won")
+        if resp is not None:
+            resp.close()
+        return hedged
+    # Neither call succeeded: report the primary's outcome, like a single request.
+    if hedged is not None:
+        hedged.close()
+    if error is not None:
+        raise error
+    return resp
+
+
+def generate_response(prompt: str, request_id: str, deadline: Optional[float] = None) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
     """
     Generate a response from the Gemini API with retry logic.
     
     Args:
         prompt: The formatted prompt to send to Gemini
         request_id: A unique identifier for logging/tracking
+        deadline: Optional time.monotonic() value by which to give up; attempt
+            timeouts shrink to the remaining budget and retries that cannot
+            finish in time are skipped
     
     Returns:
         A tuple of (response_text, error_dict). On success, error_dict is None.
@@ -140,82 +791,217 @@ def generate_response(prompt: str, request_id: str) -> Tuple[Optional[str], Opti
 
     url = f"{GEMINI_BASE_URL}/v1beta/models/{GEMINI_MODEL}:generateContent"
     params = {"key": GEMINI_API_KEY}
+    cached_content = tutor_context.name(wait_s=_context_cache_wait(deadline))
+    payload = _build_payload(prompt, cached_content)
 
-    payload: Dict[str, Any] = {
-        "contents": [
-            {
-                "role": "user",
-                "parts": [{"text": prompt}],
-            }
-        ],
-        "generationConfig": {
-            "temperature": 0.4,
-            "topP": 0.9,
-            "maxOutputTokens": 900,
-        },
-    }
+    last_err: Optional[Dict[str, Any]] = None
+    last_status = ""  # status label of the last failed attempt
+    attempts = 0
+    t_start = time.monotonic()
+
+    try:
+        delays = [0] + RETRY_DELAYS_S
+        attempt = 0
+        while attempt < len(delays):
+            delay_s = delays[attempt]
+            attempt += 1
+            if delay_s:
+                if _sleep_overruns(delay_s, deadline):
+                    return _deadline_exceeded(request_id, attempt, last_err)
+                time.sleep(delay_s)
+                server_timing.record(f"backoff-{attempt - 1}", delay_s)
+
+            timeout_s = _attempt_timeout(deadline)
+            if timeout_s <= 0:
+                return _deadline_exceeded(request_id, attempt, last_err)
+            if not upstream_breaker.allow():
+                return _circuit_open(request_id, attempt, last_err)
+
+            if attempts:
+                metrics.upstream_retries.inc(last_status)
+            attempts = attempt
+            resp = None
+            try:
+                t0 = time.time()
+                resp = _post_generate(url, params, payload, timeout_s, request_id)
+                dt_ms = int((time.time() - t0) * 1000)
+                upstream_breaker.record(FAILURE if resp.status_code in _RETRYABLE_STATUSES else SUCCESS)
+
+                if resp.status_code == 200:
+                    data = resp.json()
+                    try:
+                        text = _extract_text(data)
+                        if not text:
+                            last_err = {"message": "Empty response from Gemini.", "raw": data}
+                            last_status = "200"
+                            logger.error("gemini_empty request_id=%s dt_ms=%s", request_id, dt_ms)
+                        else:
+                            logger.info("gemini_ok request_id=%s dt_ms=%s", request_id, dt_ms)
+                            return text, None
+                    except Exception as parse_exc:
+                        last_err = {"message": "Failed to parse Gemini response.", "exception": str(parse_exc)}
+                        last_status = "200"
+                        logger.exception("gemini_parse_error request_id=%s dt_ms=%s", request_id, dt_ms)
+                else:
+                    # Retry on rate limits / transient server errors
+                    should_retry = resp.status_code in _RETRYABLE_STATUSES
+                    last_err = _http_error(resp)
+                    last_status = str(resp.status_code)
+                    logger.warning(
+                        "gemini_http_error request_id=%s attempt=%s status=%s retry=%s",
+                        request_id,
+                        attempt,
+                        resp.status_code,
+                        should_retry,
+                    )
+                    if _stale_cached_content(cached_content, resp.status_code, last_err, request_id):
+                        cached_content = None
+                        payload = _build_payload(prompt)
+                        # Retry now, without backoff and on top of the normal retries
+                        delays = delays[:attempt] + [0] + delays[attempt:]
+                        continue
+                    if not should_retry:
+                        break
+
+            except requests.Timeout:
+                upstream_breaker.record(TIMEOUT)
+                last_err = {"message": "Gemini request timed out."}
+                last_status = "timeout"
+                logger.warning("gemini_timeout request_id=%s attempt=%s", request_id, attempt)
+                if _attempt_timeout(deadline) <= 0:
+                    return _deadline_exceeded(request_id, attempt, last_err)
+            except requests.RequestException as req_exc:
+                if resp is None:  # failed before a response was recorded above
+                    upstream_breaker.record(FAILURE)
+                last_err = {"message": "Gemini request failed.", "exception": str(req_exc)}
+                last_status = "error"
+                logger.warning("gemini_request_exception request_id=%s attempt=%s err=%s", request_id, attempt, req_exc)
+            finally:
+                server_timing.record(f"upstream-{attempt}", time.time() - t0)
+
+        return None, last_err or {"message": "Unknown Gemini failure."}
+    finally:
+        metrics.upstream_seconds.observe(time.monotonic() - t_start)
+        metrics.upstream_attempts.observe(attempts)
+
+
+def _iter_sse_text(resp: requests.Response, request_id: str) -> Iterator[str]:
+    """Yield text deltas from a streamGenerateContent?alt=sse response."""
+    chunks = 0
+    t0 = time.time()
+    try:
+        # Iterate bytes so only \n / \r split events; decode each line as UTF-8.
+        for raw_line in resp.iter_lines():
+            line = raw_line.decode("utf-8")
+            if not line.startswith("data:"):
+                continue
+            data = json.loads(line[5:].strip())
+            if not data.get("candidates"):
+                continue
+            text = _extract_text(data)
+            if text:
+                chunks += 1
+                yield text
+        logger.info(
+            "gemini_stream_ok request_id=%s chunks=%s dt_ms=%s",
+            request_id,
+            chunks,
+            int((time.time() - t0) * 1000),
+        )
+    finally:
+        resp.close()
+
+
+def stream_response(prompt: str, request_id: str, deadline: Optional[float] = None) -> Tuple[Optional[Iterator[str]], Optional[Dict[str, Any]]]:
+    """
+    Open a streaming response from the Gemini API with retry logic.
+
+    Retries only cover establishing the stream; once the first byte has been
+    accepted, failures surface as exceptions from the returned iterator.
+
+    Args:
+        prompt: The formatted prompt to send to Gemini
+        request_id: A unique identifier for logging/tracking
+        deadline: Optional time.monotonic() value by which to give up; attempt
+            timeouts shrink to the remaining budget and retries that cannot
+            finish in time are skipped
+
+    Returns:
+        A tuple of (text_iterator, error_dict). On success, error_dict is None
+        and the iterator yields text chunks as Gemini produces them.
+    """
+    if not GEMINI_API_KEY:
+        return None, {"message": "Missing GEMINI_API_KEY in environment."}
+
+    url = f"{GEMINI_BASE_URL}/v1beta/models/{GEMINI_MODEL}:streamGenerateContent"
+    params = {"key": GEMINI_API_KEY, "alt": "sse"}
+    cached_content = tutor_context.name(wait_s=_context_cache_wait(deadline))
+    payload = _build_payload(prompt, cached_content)
 
     last_err: Optional[Dict[str, Any]] = None
     session = _get_http_session()
 
-    for attempt, delay_s in enumerate([0] + RETRY_DELAYS_S, start=1):
+    delays = [0] + RETRY_DELAYS_S
+    attempt = 0
+    while attempt < len(delays):
+        delay_s = delays[attempt]
+        attempt += 1
         if delay_s:
+            if _sleep_overruns(delay_s, deadline):
+                return _deadline_exceeded(request_id, attempt, last_err)
             time.sleep(delay_s)
 
+        timeout_s = _attempt_timeout(deadline)
+        if timeout_s <= 0:
+            return _deadline_exceeded(request_id, attempt, last_err)
+        if not upstream_breaker.allow():
+            return _circuit_open(request_id, attempt, last_err)
+
+        resp = None
         try:
             t0 = time.time()
             resp = session.post(
                 url,
                 params=params,
                 json=payload,
-                timeout=REQUEST_TIMEOUT_S,
+                timeout=timeout_s,
+                stream=True,
             )
             dt_ms = int((time.time() - t0) * 1000)
+            upstream_breaker.record(FAILURE if resp.status_code in _RETRYABLE_STATUSES else SUCCESS)
 
             if resp.status_code == 200:
-                data = resp.json()
-                # Typical structure: candidates[0].content.parts[0].text
-                try:
-                    cand0 = (data.get("candidates") or [])[0]
-                    content = (cand0.get("content") or {})
-                    parts = content.get("parts") or []
-                    text = "".join(p.get("text", "") for p in parts if isinstance(p, dict))
-                    if not text:
-                        last_err = {"message": "Empty response from Gemini.", "raw": data}
-                        logger.error("gemini_empty request_id=%s dt_ms=%s", request_id, dt_ms)
-                    else:
-                        logger.info("gemini_ok request_id=%s dt_ms=%s", request_id, dt_ms)
-                        return text, None
-                except Exception as parse_exc:
-                    last_err = {"message": "Failed to parse Gemini response.", "exception": str(parse_exc)}
-                    logger.exception("gemini_parse_error request_id=%s dt_ms=%s", request_id, dt_ms)
-            else:
-                # Retry on rate limits / transient server errors
-                should_retry = resp.status_code in (429, 500, 502, 503, 504)
-                try:
-                    body = resp.json()
-                except Exception:
-                    body = {"text": resp.text[:2000]}
-
-                last_err = {
-                    "message": "Gemini HTTP error",
-                    "status": resp.status_code,
-                    "body": body,
-                }
-                logger.warning(
-                    "gemini_http_error request_id=%s attempt=%s status=%s retry=%s",
-                    request_id,
-                    attempt,
-                    resp.status_code,
-                    should_retry,
-                )
-                if not should_retry:
-                    break
+                logger.info("gemini_stream_open request_id=%s dt_ms=%s", request_id, dt_ms)
+                return _iter_sse_text(resp, request_id), None
+
+            should_retry = resp.status_code in _RETRYABLE_STATUSES
+            last_err = _http_error(resp)
+            resp.close()
+            logger.warning(
+                "gemini_http_error request_id=%s attempt=%s status=%s retry=%s",
+                request_id,
+                attempt,
+                resp.status_code,
+                should_retry,
+            )
+            if _stale_cached_content(cached_content, resp.status_code, last_err, request_id):
+                cached_content = None
+                payload = _build_payload(prompt)
+                # Retry now, without backoff and on top of the normal retries
+                delays = delays[:attempt] + [0] + delays[attempt:]
+                continue
+            if not should_retry:
+                break
 
         except requests.Timeout:
+            upstream_breaker.record(TIMEOUT)
             last_err = {"message": "Gemini request timed out."}
             logger.warning("gemini_timeout request_id=%s attempt=%s", request_id, attempt)
+            if _attempt_timeout(deadline) <= 0:
+                return _deadline_exceeded(request_id, attempt, last_err)
         except requests.RequestException as req_exc:
+            if resp is None:  # failed before a response was recorded above
+                upstream_breaker.record(FAILURE)
             last_err = {"message": "Gemini request failed.", "exception": str(req_exc)}
             logger.warning("gemini_request_exception request_id=%s attempt=%s err=%s", request_id, attempt, req_exc)
 
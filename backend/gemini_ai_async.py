@@ -0,0 +1,160 @@
+"""
+Async Gemini AI API module for the ASGI backend.
+
+Coroutine counterpart of gemini_ai.generate_response(): it uses a shared
+httpx.AsyncClient and asyncio.sleep() backoff, so waiting on Gemini never
+blocks a worker thread.
+"""
+import asyncio
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+
+from config import (
+    GEMINI_API_KEY,
+    GEMINI_BASE_URL,
+    GEMINI_MODEL,
+    REQUEST_TIMEOUT_S,
+    RETRY_DELAYS_S,
+    logger,
+)
+from gemini_ai import (
+    _RETRYABLE_STATUSES,
+    _attempt_timeout,
+    _build_payload,
+    _circuit_open,
+    _deadline_exceeded,
+    _extract_text,
+    _http_error,
+    _sleep_overruns,
+    _stale_cached_content,
+    tutor_context,
+    upstream_breaker,
+)
+from resilience import FAILURE, SUCCESS, TIMEOUT
+
+# Shared client (connection pooling); created lazily, closed on app shutdown
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Get or create the shared async HTTP client."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=REQUEST_TIMEOUT_S,
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=100),
+        )
+    return _client
+
+
+async def close_async_client() -> None:
+    """Close the shared async HTTP client, if one was created."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def generate_response_async(prompt: str, request_id: str, deadline: Optional[float] = None) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """
+    Generate a response from the Gemini API with retry logic, without blocking.
+
+    Args:
+        prompt: The formatted prompt to send to Gemini
+        request_id: A unique identifier for logging/tracking
+        deadline: Optional time.monotonic() value by which to give up; attempt
+            timeouts shrink to the remaining budget and retries that cannot
+            finish in time are skipped
+
+    Returns:
+        A tuple of (response_text, error_dict). On success, error_dict is None.
+        On failure, response_text is None and error_dict contains error details.
+    """
+    if not GEMINI_API_KEY:
+        return None, {"message": "Missing GEMINI_API_KEY in environment."}
+
+    url = f"{GEMINI_BASE_URL}/v1beta/models/{GEMINI_MODEL}:generateContent"
+    params = {"key": GEMINI_API_KEY}
+    # Creating the cached content is a blocking call, so only reuse one made
+    # by the threaded code paths.
+    cached_content = tutor_context.name(create=False)
+    payload = _build_payload(prompt, cached_content)
+
+    last_err: Optional[Dict[str, Any]] = None
+    client = get_async_client()
+
+    delays = [0] + RETRY_DELAYS_S
+    attempt = 0
+    while attempt < len(delays):
+        delay_s = delays[attempt]
+        attempt += 1
+        if delay_s:
+            if _sleep_overruns(delay_s, deadline):
+                return _deadline_exceeded(request_id, attempt, last_err)
+            await asyncio.sleep(delay_s)
+
+        timeout_s = _attempt_timeout(deadline)
+        if timeout_s <= 0:
+            return _deadline_exceeded(request_id, attempt, last_err)
+        if not upstream_breaker.allow():
+            return _circuit_open(request_id, attempt, last_err)
+
+        resp = None
+        try:
+            t0 = time.time()
+            resp = await client.post(
+                url,
+                params=params,
+                json=payload,
+                timeout=timeout_s,
+            )
+            dt_ms = int((time.time() - t0) * 1000)
+            upstream_breaker.record(FAILURE if resp.status_code in _RETRYABLE_STATUSES else SUCCESS)
+
+            if resp.status_code == 200:
+                data = resp.json()
+                try:
+                    text = _extract_text(data)
+                    if not text:
+                        last_err = {"message": "Empty response from Gemini.", "raw": data}
+                        logger.error("gemini_empty request_id=%s dt_ms=%s", request_id, dt_ms)
+                    else:
+                        logger.info("gemini_ok request_id=%s dt_ms=%s", request_id, dt_ms)
+                        return text, None
+                except Exception as parse_exc:
+                    last_err = {"message": "Failed to parse Gemini response.", "exception": str(parse_exc)}
+                    logger.exception("gemini_parse_error request_id=%s dt_ms=%s", request_id, dt_ms)
+            else:
+                should_retry = resp.status_code in _RETRYABLE_STATUSES
+                last_err = _http_error(resp)
+                logger.warning(
+                    "gemini_http_error request_id=%s attempt=%s status=%s retry=%s",
+                    request_id,
+                    attempt,
+                    resp.status_code,
+                    should_retry,
+                )
+                if _stale_cached_content(cached_content, resp.status_code, last_err, request_id):
+                    cached_content = None
+                    payload = _build_payload(prompt)
+                    # Retry now, without backoff and on top of the normal retries
+                    delays = delays[:attempt] + [0] + delays[attempt:]
+                    continue
+                if not should_retry:
+                    break
+
+        except httpx.TimeoutException:
+            upstream_breaker.record(TIMEOUT)
+            last_err = {"message": "Gemini request timed out."}
+            logger.warning("gemini_timeout request_id=%s attempt=%s", request_id, attempt)
+            if _attempt_timeout(deadline) <= 0:
+                return _deadline_exceeded(request_id, attempt, last_err)
+        except (httpx.HTTPError, ValueError) as req_exc:
+            if resp is None:  # failed before a response was recorded above
+                upstream_breaker.record(FAILURE)
+            last_err = {"message": "Gemini request failed.", "exception": str(req_exc)}
+            logger.warning("gemini_request_exception request_id=%s attempt=%s err=%s", request_id, attempt, req_exc)
+
+    return None, last_err or {"message": "Unknown Gemini failure."}
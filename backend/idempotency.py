@@ -0,0 +1,111 @@
+"""
+Idempotent handling of retried requests for the AI Python Teacher backend.
+
+Clients retry a request after a network error with the same X-Request-Id.
+IdempotencyStore makes such retries cheap: a duplicate that arrives while the
+original is still running waits for it and gets the same response, and one
+that arrives after it finished gets the stored response replayed, for
+IDEMPOTENCY_TTL_S. The key covers the request path and body as well as the
+id, so reusing an id for a different request does not replay the wrong
+answer.
+
+Only final responses are kept for replay: 5xx and 429 responses are shared
+with duplicates already waiting but not stored, so a later retry tries again.
+"""
+import hashlib
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+import metrics
+from cache import SingleFlight, TTLCache
+
+# Longest X-Request-Id accepted as an idempotency key
+MAX_REQUEST_ID_LENGTH = 128
+
+
+class StoredResponse(NamedTuple):
+    """A response reduced to what is needed to send it again."""
+
+    status: int
+    body: bytes
+    headers: Tuple[Tuple[str, str], ...]
+
+
+def request_key(request_id: Optional[str], path: str, body: bytes) -> Optional[str]:
+    """
+    Build the idempotency key for a request.
+
+    Args:
+        request_id: The client's X-Request-Id header, if any
+        path: The request path
+        body: The raw request body
+
+    Returns:
+        A hex digest, or None when the client sent no usable request id
+    """
+    if not request_id or len(request_id) > MAX_REQUEST_ID_LENGTH:
+        return None
+    digest = hashlib.sha256()
+    for part in (request_id.encode("utf-8"), path.encode("utf-8"), body):
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def _replayable(response: StoredResponse) -> bool:
+    return response.status < 500 and response.status != 429
+
+
+class IdempotencyStore:
+    """
+    In-flight and recently completed responses by idempotency key.
+
+    A max_entries or ttl_s of 0 turns off replay of completed responses;
+    concurrent duplicates are still attached to the running request.
+    """
+
+    def __init__(self, max_entries: int, ttl_s: float):
+        self._completed = TTLCache(max_entries, ttl_s)
+        self._in_flight = SingleFlight()
+
+    def do(self, key: str, handle: Callable[[], StoredResponse]) -> Tuple[StoredResponse, Optional[str]]:
+        """
+        Run handle once per key, sharing its response with duplicates.
+
+        Args:
+            key: The request's idempotency key
+            handle: Produces the response for the first request with key
+
+        Returns:
+            A tuple of (response, outcome) where outcome is None when handle
+            ran for this call, "attached" when it waited for an in-flight
+            duplicate, or "replayed" when a stored response was used
+        """
+        stored = self._completed.get(key)
+        if stored is not None:
+            metrics.idempotent_requests.inc("replayed")
+            return stored, "replayed"
+        response, shared = self._in_flight.do(key, lambda: self._run(key, handle))
+        if shared:
+            metrics.idempotent_requests.inc("attached")
+            return response, "attached"
+        return response, None
+
+    def _run(self, key: str, handle: Callable[[], StoredResponse]) -> StoredResponse:
+        response = handle()
+        if _replayable(response):
+            self._completed.set(key, response)
+        return response
+
+    def snapshot(self) -> Dict[str, int]:
+        """Return the store state for /health."""
+        return {
+            "stored": len(self._completed),
+            "in_flight": self._in_flight.in_flight(),
+            "replayed": metrics.idempotent_requests.value("replayed"),
+            "attached": metrics.idempotent_requests.value("attached"),
+        }
+
+    def clear(self) -> None:
+        """Forget stored responses and reset counters."""
+        self._completed.clear()
+        self._in_flight.coalesced = 0
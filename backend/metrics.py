@@ -0,0 +1,294 @@
+"""
+In-process metrics for the AI Python Teacher backend.
+
+This module provides counters, gauges and histograms rendered in the Prometheus
+text exposition format by the /metrics endpoint. Each metric has its own
+lock held only for a few integer updates, so recording is cheap and
+unrelated metrics never contend with each other.
+"""
+import bisect
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+# Default buckets, in seconds, for request latency
+LATENCY_BUCKETS_S = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for n, v in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter, optionally split by label values."""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        """Add amount to the series identified by labelvalues."""
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues: str) -> float:
+        """Current value of one series (0 if it was never incremented)."""
+        with self._lock:
+            return self._values.get(labelvalues, 0)
+
+    def render(self) -> List[str]:
+        """Return the exposition lines for this counter."""
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labelvalues, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}")
+        return lines
+
+    def reset(self) -> None:
+        """Drop all series."""
+        with self._lock:
+            self._values.clear()
+
+
+class Gauge:
+    """
+    Value that can go up and down, optionally split by label values.
+
+    Gauges mirroring state kept elsewhere are set when /metrics is scraped.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, *labelvalues: str) -> None:
+        """Set the series identified by labelvalues to value."""
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def value(self, *labelvalues: str) -> float:
+        """Current value of one series (0 if it was never set)."""
+        with self._lock:
+            return self._values.get(labelvalues, 0)
+
+    def render(self) -> List[str]:
+        """Return the exposition lines for this gauge."""
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for labelvalues, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}")
+        return lines
+
+    def reset(self) -> None:
+        """Drop all series."""
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram, optionally split by label values.
+
+    Observations are stored per bucket and made cumulative only when rendered.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Sequence[float] = LATENCY_BUCKETS_S,
+        labelnames: Sequence[str] = (),
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        """Record one observation in the series identified by labelvalues."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def count(self, *labelvalues: str) -> int:
+        """Number of observations in one series."""
+        with self._lock:
+            series = self._series.get(labelvalues)
+            return int(sum(series[:-1])) if series else 0
+
+    def render(self) -> List[str]:
+        """Return the exposition lines for this histogram."""
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labelvalues, series in items:
+            cumulative = 0
+            for bound, hits in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += hits
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labelvalues, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+    def reset(self) -> None:
+        """Drop all series."""
+        with self._lock:
+            self._series.clear()
+
+
+class Registry:
+    """Ordered collection of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics: List = []
+
+    def register(self, metric):
+        """Add a metric and return it."""
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text format (version 0.0.4)."""
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        """Drop all series of every metric."""
+        for metric in self._metrics:
+            metric.reset()
+
+
+# Content type of Registry.render() output
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    "tutor_http_requests_total",
+    "HTTP requests by route and status code.",
+    ("route", "status"),
+))
+http_request_seconds = registry.register(Histogram(
+    "tutor_http_request_duration_seconds",
+    "HTTP request latency by route and status code.",
+    labelnames=("route", "status"),
+))
+upstream_seconds = registry.register(Histogram(
+    "tutor_upstream_duration_seconds",
+    "Time spent in generate_response(), including retries and backoff.",
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64),
+))
+upstream_attempts = registry.register(Histogram(
+    "tutor_upstream_attempts",
+    "Upstream attempts made per generate_response() call.",
+    buckets=(1, 2, 3, 4, 5, 6),
+))
+upstream_retries = registry.register(Counter(
+    "tutor_upstream_retries_total",
+    "Upstream retries by the status of the failed attempt (HTTP code, timeout or error).",
+    ("status",),
+))
+upstream_hedges = registry.register(Counter(
+    "tutor_upstream_hedges_total",
+    "Hedged upstream requests, by outcome (sent, won).",
+    ("outcome",),
+))
+upstream_breaker_state = registry.register(Gauge(
+    "tutor_upstream_breaker_state",
+    "1 for the current upstream circuit breaker state (closed, open, half_open), 0 otherwise.",
+    ("state",),
+))
+admission_in_flight = registry.register(Gauge(
+    "tutor_admission_in_flight",
+    "Upstream calls currently admitted.",
+))
+admission_queue_depth = registry.register(Gauge(
+    "tutor_admission_queue_depth",
+    "Calls waiting in the admission queue for an upstream slot.",
+))
+admission_wait_seconds = registry.register(Histogram(
+    "tutor_admission_wait_seconds",
+    "Time spent waiting for an upstream slot, by outcome (admitted, shed).",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    labelnames=("outcome",),
+))
+prompt_chars = registry.register(Histogram(
+    "tutor_prompt_chars",
+    "Size of prompts sent to Gemini, in characters.",
+    buckets=(1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000),
+))
+code_chars = registry.register(Histogram(
+    "tutor_code_chars",
+    "Size of the student code field, in characters.",
+    buckets=(0, 100, 500, 1000, 2500, 5000, 10000, 20000, 40000, 80000),
+))
+code_chars_removed = registry.register(Histogram(
+    "tutor_code_chars_removed",
+    "Characters removed from the student code by compaction before prompting.",
+    buckets=(0, 100, 500, 1000, 2500, 5000, 10000, 20000, 40000, 80000),
+))
+code_compactions = registry.register(Counter(
+    "tutor_code_compactions_total",
+    "Student code changed by compaction, by step (whitespace, comments, slice, budget).",
+    ("step",),
+))
+syntax_fast_path = registry.register(Counter(
+    "tutor_syntax_fast_path_total",
+    "Requests answered locally because the code did not parse, by error category.",
+    ("category",),
+))
+faq_lookups = registry.register(Counter(
+    "tutor_faq_lookups_total",
+    "FAQ index lookups for questions without code, by result (hit, miss).",
+    ("result",),
+))
+idempotent_requests = registry.register(Counter(
+    "tutor_idempotent_requests_total",
+    "Duplicate requests by X-Request-Id answered without running again, by outcome (attached, replayed).",
+    ("outcome",),
+))
+dedup_lookups = registry.register(Counter(
+    "tutor_dedup_lookups_total",
+    "Lookups of answers for equivalent or near-duplicate code, by result (equivalent, near, unsafe, miss).",
+    ("result",),
+))
+sanitizer_seconds = registry.register(Histogram(
+    "tutor_sanitizer_duration_seconds",
+    "Time spent in sanitize_tutor_output().",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05),
+))
+sanitizer_actions = registry.register(Counter(
+    "tutor_sanitizer_actions_total",
+    "Answers changed by sanitize_tutor_output(), by action (code_omitted, truncated).",
+    ("action",),
+))
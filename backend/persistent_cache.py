@@ -0,0 +1,250 @@
+"""
+Persistent response cache for the AI Python Teacher backend.
+
+The in-process TTLCache is lost on every deploy and each worker process has
+its own. SQLiteCache keeps answers in a SQLite database in WAL mode instead,
+so every worker on a host shares hits and they survive restarts. It has the
+same get/set/clear/stats interface as TTLCache.
+
+Values are JSON-encoded and zlib-compressed. Entries expire after a TTL, and
+when the cache holds more than max_entries entries or max_bytes compressed
+bytes the least recently used are evicted. Recency is refreshed at most once
+per TOUCH_INTERVAL_S per entry, so hot entries do not turn every hit into a
+write. Database errors (for example a lock held past BUSY_TIMEOUT_S) are
+logged and treated as misses, and a row that cannot be decoded is deleted
+and treated as a miss; the cache never fails a request.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Dict, Optional, Union
+
+from cache import TTLCache
+from config import (
+    RESPONSE_CACHE_BACKEND,
+    RESPONSE_CACHE_MAX_BYTES,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_PATH,
+    RESPONSE_CACHE_TTL_S,
+    logger,
+)
+
+# Longest a cache call waits for another process's write lock
+BUSY_TIMEOUT_S = 0.5
+
+# Minimum time between recency updates of one entry
+TOUCH_INTERVAL_S = 60.0
+
+ZLIB_LEVEL = 6
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_expires_at ON responses (expires_at);
+CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+"""
+
+
+class SQLiteCache:
+    """
+    Process-safe LRU cache with per-entry expiry, stored in a SQLite file.
+
+    Times are wall-clock so that all processes agree on expiry. A max_entries
+    of 0 disables the cache, like TTLCache; a max_bytes of 0 means no size
+    limit. Counters in stats() are per process; size and bytes are shared.
+    """
+
+    def __init__(self, path: str, max_entries: int, ttl_s: float, max_bytes: int = 0):
+        self.path = path
+        self.max_entries = max(0, int(max_entries))
+        self.ttl_s = float(ttl_s)
+        self.max_bytes = max(0, int(max_bytes))
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.errors = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the cache stores anything at all."""
+        return self.max_entries > 0 and self.ttl_s > 0
+
+    def _conn(self) -> sqlite3.Connection:
+        """Return this thread's connection, reopening it after a fork."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            # Autocommit; writes use explicit BEGIN IMMEDIATE transactions
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_S, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, counter: str, amount: int = 1) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def _error(self, op: str, exc: Exception) -> None:
+        self._count("errors")
+        logger.warning("response_cache_error op=%s path=%s err=%s", op, self.path, exc)
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value for key, or None on a miss, expiry or error."""
+        now = time.time()
+        try:
+            conn = self._conn()
+            row = conn.execute(
+                "SELECT value, expires_at, accessed_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[1] <= now:
+                conn.execute("DELETE FROM responses WHERE key = ? AND expires_at <= ?", (key, now))
+                self._count("expirations")
+                row = None
+            if row is None:
+                self._count("misses")
+                return None
+            if now - row[2] >= TOUCH_INTERVAL_S:
+                conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            try:
+                value = json.loads(zlib.decompress(row[0]))
+            except (zlib.error, UnicodeDecodeError, ValueError) as exc:
+                # Corrupt or truncated row: drop it so the next set() replaces it
+                self._error("decode", exc)
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._count("misses")
+                return None
+        except sqlite3.Error as exc:
+            self._error("get", exc)
+            self._count("misses")
+            return None
+        self._count("hits")
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        """Store value under key, then drop expired entries and evict down to the limits."""
+        if not self.enabled:
+            return
+        blob = zlib.compress(json.dumps(value, ensure_ascii=False).encode("utf-8"), ZLIB_LEVEL)
+        if self.max_bytes and len(blob) > self.max_bytes:
+            return
+        now = time.time()
+        try:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, size, expires_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, blob, len(blob), now + self.ttl_s, now),
+                )
+                expired = conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,)).rowcount
+                evicted = self._evict(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as exc:
+            self._error("set", exc)
+            return
+        if expired:
+            self._count("expirations", expired)
+        if evicted:
+            self._count("evictions", evicted)
+
+    def _evict(self, conn: sqlite3.Connection) -> int:
+        """Delete least recently used entries until both limits hold; returns the count."""
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        excess_entries = count - self.max_entries
+        excess_bytes = total - self.max_bytes if self.max_bytes else 0
+        if excess_entries <= 0 and excess_bytes <= 0:
+            return 0
+        victims = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            if excess_entries <= 0 and excess_bytes <= 0:
+                break
+            victims.append((key,))
+            excess_entries -= 1
+            excess_bytes -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+        return len(victims)
+
+    def clear(self) -> None:
+        """Drop all entries and reset counters."""
+        try:
+            self._conn().execute("DELETE FROM responses")
+        except sqlite3.Error as exc:
+            self._error("clear", exc)
+        with self._lock:
+            self.hits = self.misses = self.evictions = self.expirations = self.errors = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Return a snapshot of cache counters."""
+        try:
+            size, total = self._conn().execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        except sqlite3.Error as exc:
+            self._error("stats", exc)
+            size = total = 0
+        with self._lock:
+            return {
+                "backend": "sqlite",
+                "size": size,
+                "max_entries": self.max_entries,
+                "bytes": total,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "errors": self.errors,
+            }
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+def open_response_cache(
+    max_entries: Optional[int] = None,
+    path: Optional[str] = None,
+) -> Union[TTLCache, SQLiteCache]:
+    """
+    Create the response cache selected by RESPONSE_CACHE_BACKEND.
+
+    Args:
+        max_entries: Entry limit (default RESPONSE_CACHE_MAX_ENTRIES)
+        path: Database file for the sqlite backend (default RESPONSE_CACHE_PATH)
+
+    Returns:
+        A SQLiteCache at path for "sqlite", otherwise (or if the database
+        cannot be opened) an in-process TTLCache
+    """
+    if max_entries is None:
+        max_entries = RESPONSE_CACHE_MAX_ENTRIES
+    if path is None:
+        path = RESPONSE_CACHE_PATH
+    if RESPONSE_CACHE_BACKEND == "sqlite":
+        try:
+            return SQLiteCache(path, max_entries, RESPONSE_CACHE_TTL_S, RESPONSE_CACHE_MAX_BYTES)
+        except (OSError, sqlite3.Error) as exc:
+            logger.warning("response_cache_open_failed path=%s err=%s; using memory", path, exc)
+    elif RESPONSE_CACHE_BACKEND != "memory":
+        logger.warning("response_cache_backend_unknown backend=%s; using memory", RESPONSE_CACHE_BACKEND)
+    return TTLCache(max_entries, RESPONSE_CACHE_TTL_S)
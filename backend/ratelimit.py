@@ -0,0 +1,194 @@
+"""
+Request rate limiting for the AI Python Teacher backend.
+
+This module provides token buckets applied per client and globally, so that
+one client (or a runaway retry loop) cannot exhaust the shared Gemini quota.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import AbstractSet, Any, Dict, Optional, Tuple
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at rate_per_s up to burst tokens.
+
+    Not thread-safe on its own; RateLimiter serializes access.
+    """
+
+    __slots__ = ("rate_per_s", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate_per_s: float, burst: float, now: float):
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now
+
+    def refill(self, now: float) -> None:
+        """Add the tokens earned since the last update."""
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate_per_s)
+            self.updated_at = now
+
+    def wait_s(self) -> float:
+        """Seconds until one token is available (0.0 when it already is)."""
+        if self.tokens >= 1:
+            return 0.0
+        if self.rate_per_s <= 0:
+            return float("inf")
+        return (1 - self.tokens) / self.rate_per_s
+
+
+class RateLimiter:
+    """
+    Thread-safe per-client and global token-bucket limiter.
+
+    A request is admitted only when both its client bucket and the global
+    bucket hold a token; tokens are taken from both or from neither. Batch
+    requests take one token per item. A rate of 0 disables that bucket.
+    Client buckets are kept in an LRU map capped at max_clients so idle
+    clients do not grow memory without bound.
+    """
+
+    def __init__(
+        self,
+        client_rate_per_s: float,
+        client_burst: float,
+        global_rate_per_s: float,
+        global_burst: float,
+        max_clients: int = 10_000,
+        enabled: bool = True,
+    ):
+        self.client_rate_per_s = client_rate_per_s
+        self.client_burst = max(1.0, float(client_burst))
+        self.global_rate_per_s = global_rate_per_s
+        self.global_burst = max(1.0, float(global_burst))
+        self.max_clients = max(1, int(max_clients))
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._clients: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._global = TokenBucket(global_rate_per_s, self.global_burst, time.monotonic())
+        self.allowed = 0
+        self.limited_client = 0
+        self.limited_global = 0
+
+    def acquire(self, client_id: str) -> float:
+        """
+        Try to admit one request from client_id.
+
+        Returns:
+            0.0 when the request is admitted, otherwise the number of
+            seconds the client should wait before retrying
+        """
+        granted, wait = self.acquire_many(client_id, 1)
+        return 0.0 if granted else wait
+
+    def acquire_many(self, client_id: str, count: int) -> Tuple[int, float]:
+        """
+        Try to admit up to count requests from client_id at once.
+
+        Takes as many tokens as both buckets can give, up to count, so a
+        batch is charged per item. Requests that are not admitted are
+        counted as limited.
+
+        Returns:
+            A tuple of (admitted, wait_s) where wait_s is 0.0 when all count
+            were admitted, otherwise the seconds until another token is free
+        """
+        if not self.enabled or count <= 0:
+            return max(0, count), 0.0
+        now = time.monotonic()
+        with self._lock:
+            granted = count
+            bucket = self._client_bucket(client_id, now)
+            if bucket is not None:
+                bucket.refill(now)
+                granted = min(granted, int(bucket.tokens))
+            client_granted = granted
+            if self.global_rate_per_s > 0:
+                self._global.refill(now)
+                granted = min(granted, int(self._global.tokens))
+                self._global.tokens -= granted
+            if bucket is not None:
+                bucket.tokens -= granted
+            self.allowed += granted
+            self.limited_client += count - client_granted
+            self.limited_global += client_granted - granted
+            if granted == count:
+                return granted, 0.0
+            if client_granted < count:
+                return granted, bucket.wait_s()
+            return granted, self._global.wait_s()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return limiter counters for /health."""
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "clients": len(self._clients),
+                "allowed": self.allowed,
+                "limited_client": self.limited_client,
+                "limited_global": self.limited_global,
+            }
+
+    def reset(self) -> None:
+        """Refill every bucket and reset counters."""
+        with self._lock:
+            self._clients.clear()
+            self._global = TokenBucket(self.global_rate_per_s, self.global_burst, time.monotonic())
+            self.allowed = self.limited_client = self.limited_global = 0
+
+    def _client_bucket(self, client_id: str, now: float) -> Optional[TokenBucket]:
+        if self.client_rate_per_s <= 0:
+            return None
+        bucket = self._clients.get(client_id)
+        if bucket is None:
+            bucket = TokenBucket(self.client_rate_per_s, self.client_burst, now)
+            self._clients[client_id] = bucket
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        else:
+            self._clients.move_to_end(client_id)
+        return bucket
+
+
+def client_identity(
+    api_key: Optional[str],
+    forwarded_for: Optional[str],
+    remote_addr: Optional[str],
+    trust_proxy: bool,
+    known_keys: AbstractSet[str] = frozenset(),
+    proxy_hops: int = 1,
+) -> str:
+    """
+    Identify the client a request should be rate limited as.
+
+    X-Api-Key is not authenticated, so only configured keys are honoured;
+    otherwise a client could send a fresh key with every request and get a
+    fresh bucket each time. For the same reason X-Forwarded-For is read from
+    the right: a client can write any entries on the left, and each trusted
+    proxy appends the address it received the request from, so the client's
+    address is the proxy_hops-th entry from the right.
+
+    Args:
+        api_key: Value of the X-Api-Key header, if any
+        forwarded_for: Value of the X-Forwarded-For header, if any
+        remote_addr: Peer address of the connection
+        trust_proxy: Whether X-Forwarded-For is set by a trusted proxy
+        known_keys: API keys that may be used as an identity
+        proxy_hops: Number of trusted proxies in front of the app
+
+    Returns:
+        "key:<api key>" when a known key is sent, otherwise "ip:<address>"
+    """
+    key = (api_key or "").strip()
+    if key and key in known_keys:
+        return "key:" + key
+    if trust_proxy and forwarded_for and proxy_hops > 0:
+        entries = [e.strip() for e in forwarded_for.split(",")]
+        if len(entries) >= proxy_hops and entries[-proxy_hops]:
+            return "ip:" + entries[-proxy_hops]
+    return "ip:" + (remote_addr or "unknown")
@@ -0,0 +1,378 @@
+"""
+Upstream resilience helpers for the AI Python Teacher backend.
+
+This module provides a circuit breaker that stops sending requests to Gemini
+while it is failing, so requests fail fast instead of running the full retry
+ladder against an upstream that is down, a hedging policy that sends a
+capped number of backup requests when the primary is slower than usual, and
+admission control that bounds concurrent upstream calls and sheds load once
+a short wait queue is full.
+"""
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+# Outcomes recorded for each upstream attempt
+SUCCESS = "success"
+FAILURE = "failure"
+TIMEOUT = "timeout"
+
+
+class CircuitBreaker:
+    """
+    Thread-safe circuit breaker driven by rolling failure and timeout rates.
+
+    closed:    calls flow; outcomes within the last window_s seconds are kept.
+               Once at least min_calls are recorded and the failure rate
+               (failures and timeouts) or the timeout rate reaches its
+               threshold, the breaker opens.
+    open:      calls are rejected until open_s seconds have passed.
+    half_open: up to half_open_probes calls are let through; if they all
+               succeed the breaker closes, any failure reopens it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_rate: float,
+        timeout_rate: float,
+        min_calls: int,
+        window_s: float,
+        open_s: float,
+        half_open_probes: int,
+        enabled: bool = True,
+    ):
+        self.failure_rate = failure_rate
+        self.timeout_rate = timeout_rate
+        self.min_calls = max(1, int(min_calls))
+        self.window_s = window_s
+        self.open_s = open_s
+        self.half_open_probes = max(1, int(half_open_probes))
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._outcomes: Deque[Tuple[float, str]] = deque()
+        self._failures = 0  # failures and timeouts in the window
+        self._timeouts = 0
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        """Current state, moving from open to half_open once the cooldown ends."""
+        with self._lock:
+            self._maybe_half_open(time.monotonic())
+            return self._state
+
+    def allow(self) -> bool:
+        """
+        Ask permission for one upstream call.
+
+        Every True must be followed by exactly one record() for that call.
+        """
+        if not self.enabled:
+            return True
+        with self._lock:
+            self._maybe_half_open(time.monotonic())
+            if self._state == self.OPEN:
+                self.rejected += 1
+                return False
+            if self._state == self.HALF_OPEN:
+                if self._probes_in_flight >= self.half_open_probes:
+                    self.rejected += 1
+                    return False
+                self._probes_in_flight += 1
+            return True
+
+    def record(self, outcome: str) -> None:
+        """Record the outcome (SUCCESS, FAILURE or TIMEOUT) of an allowed call."""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if outcome != SUCCESS:
+                    self._trip(now)
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_probes:
+                    self._state = self.CLOSED
+                    self._clear_window()
+                return
+            if self._state == self.OPEN:
+                return  # a call admitted before the breaker opened
+
+            self._outcomes.append((now, outcome))
+            self._count(outcome, 1)
+            self._prune(now)
+            total, failures, timeouts = self._counts()
+            if total >= self.min_calls and (
+                failures / total >= self.failure_rate or timeouts / total >= self.timeout_rate
+            ):
+                self._trip(now)
+
+    def retry_after_s(self) -> float:
+        """Seconds until the breaker will let a probe through."""
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0.0
+            return max(0.0, self._opened_at + self.open_s - time.monotonic())
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return the breaker state and rolling rates for /health."""
+        now = time.monotonic()
+        with self._lock:
+            self._maybe_half_open(now)
+            self._prune(now)
+            total, failures, timeouts = self._counts()
+            return {
+                "state": self._state,
+                "window_calls": total,
+                "failure_rate": round(failures / total, 3) if total else 0.0,
+                "timeout_rate": round(timeouts / total, 3) if total else 0.0,
+                "trips": self.trips,
+                "rejected": self.rejected,
+            }
+
+    def reset(self) -> None:
+        """Close the breaker and forget all recorded outcomes."""
+        with self._lock:
+            self._state = self.CLOSED
+            self._clear_window()
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+            self.rejected = 0
+            self.trips = 0
+
+    def _trip(self, now: float) -> None:
+        self._state = self.OPEN
+        self._opened_at = now
+        self._clear_window()
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self.trips += 1
+
+    def _maybe_half_open(self, now: float) -> None:
+        if self._state == self.OPEN and now - self._opened_at >= self.open_s:
+            self._state = self.HALF_OPEN
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+
+    def _count(self, outcome: str, delta: int) -> None:
+        if outcome != SUCCESS:
+            self._failures += delta
+        if outcome == TIMEOUT:
+            self._timeouts += delta
+
+    def _clear_window(self) -> None:
+        self._outcomes.clear()
+        self._failures = self._timeouts = 0
+
+    def _prune(self, now: float) -> None:
+        cutoff = now - self.window_s
+        while self._outcomes and self._outcomes[0][0] < cutoff:
+            self._count(self._outcomes.popleft()[1], -1)
+
+    def _counts(self) -> Tuple[int, int, int]:
+        return len(self._outcomes), self._failures, self._timeouts
+
+
+class HedgePolicy:
+    """
+    Decide when to send a backup ("hedged") upstream request.
+
+    A hedge fires once the primary request has been outstanding longer than
+    the given percentile of recent successful latencies. Hedges are capped at
+    max_ratio of primary requests so they cannot multiply upstream load.
+    """
+
+    def __init__(
+        self,
+        percentile: float,
+        min_delay_s: float,
+        max_ratio: float,
+        min_samples: int,
+        window: int = 200,
+        enabled: bool = True,
+    ):
+        self.percentile = percentile
+        self.min_delay_s = min_delay_s
+        self.max_ratio = max_ratio
+        self.min_samples = max(1, int(min_samples))
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self.primaries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def record_latency(self, seconds: float) -> None:
+        """Record the latency of a successful upstream call."""
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def note_primary(self) -> None:
+        """Count one primary upstream request."""
+        with self._lock:
+            self.primaries += 1
+
+    def note_win(self) -> None:
+        """Count a hedge that answered before its primary."""
+        with self._lock:
+            self.hedge_wins += 1
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds to wait before hedging, or None when hedging does not apply."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay_s, ordered[index])
+
+    def try_acquire(self) -> bool:
+        """Take one hedge from the budget; False when the cap is reached."""
+        with self._lock:
+            if self.hedges + 1 > self.max_ratio * self.primaries:
+                return False
+            self.hedges += 1
+            return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return hedging counters and the current hedge delay."""
+        delay = self.hedge_delay()
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "primaries": self.primaries,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "hedge_rate": round(self.hedges / self.primaries, 4) if self.primaries else 0.0,
+                "hedge_delay_ms": None if delay is None else int(delay * 1000),
+            }
+
+    def reset(self) -> None:
+        """Forget latencies and counters."""
+        with self._lock:
+            self._latencies.clear()
+            self.primaries = self.hedges = self.hedge_wins = 0
+
+
+class AdmissionController:
+    """
+    Bound concurrent upstream calls with a short, bounded wait queue.
+
+    Up to max_concurrent callers run at once. Further callers wait, at most
+    max_queue of them and for at most max_wait_s each; anything beyond that
+    is shed immediately so admitted requests keep their latency. A
+    max_concurrent of 0 disables admission control.
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int, max_wait_s: float):
+        self.max_concurrent = max(0, int(max_concurrent))
+        self.max_queue = max(0, int(max_queue))
+        self.max_wait_s = max(0.0, float(max_wait_s))
+
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        self.admitted = 0
+        self.shed_queue_full = 0
+        self.shed_timeout = 0
+        self.queued = 0
+        self._wait_total_s = 0.0
+        self._wait_max_s = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        """Whether calls are limited at all."""
+        return self.max_concurrent > 0
+
+    def acquire(self, deadline: Optional[float] = None) -> bool:
+        """
+        Wait for a slot; False means the call was shed.
+
+        Every True must be followed by exactly one release().
+
+        Args:
+            deadline: Optional time.monotonic() deadline that shortens the wait
+        """
+        if not self.enabled:
+            return True
+        start = time.monotonic()
+        wait_until = start + self.max_wait_s
+        if deadline is not None:
+            wait_until = min(wait_until, deadline)
+        with self._cond:
+            if self._in_flight < self.max_concurrent and self._waiting == 0:
+                self._in_flight += 1
+                self.admitted += 1
+                return True
+            if self._waiting >= self.max_queue:
+                self.shed_queue_full += 1
+                return False
+
+            self._waiting += 1
+            self.queued += 1
+            try:
+                while self._in_flight >= self.max_concurrent:
+                    remaining = wait_until - time.monotonic()
+                    if remaining <= 0:
+                        self.shed_timeout += 1
+                        return False
+                    self._cond.wait(remaining)
+                self._in_flight += 1
+                self.admitted += 1
+            finally:
+                self._waiting -= 1
+                waited = time.monotonic() - start
+                self._wait_total_s += waited
+                self._wait_max_s = max(self._wait_max_s, waited)
+            return True
+
+    def release(self) -> None:
+        """Give back the slot taken by a successful acquire()."""
+        if not self.enabled:
+            return
+        with self._cond:
+            self._in_flight = max(0, self._in_flight - 1)
+            self._cond.notify()
+
+    def retry_after_s(self) -> float:
+        """Suggested client back-off after being shed."""
+        return max(1.0, self.max_wait_s)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return concurrency, queue depth and wait-time counters."""
+        with self._cond:
+            return {
+                "enabled": self.enabled,
+                "max_concurrent": self.max_concurrent,
+                "in_flight": self._in_flight,
+                "queue_depth": self._waiting,
+                "max_queue": self.max_queue,
+                "admitted": self.admitted,
+                "shed_queue_full": self.shed_queue_full,
+                "shed_timeout": self.shed_timeout,
+                "queued": self.queued,
+                "queue_wait_avg_ms": int(self._wait_total_s / self.queued * 1000) if self.queued else 0,
+                "queue_wait_max_ms": int(self._wait_max_s * 1000),
+            }
+
+    def reset(self) -> None:
+        """Reset counters; slots held by running calls are kept."""
+        with self._cond:
+            self.admitted = self.shed_queue_full = self.shed_timeout = self.queued = 0
+            self._wait_total_s = self._wait_max_s = 0.0
@@ -0,0 +1,71 @@
+"""
+Server-Timing support for the AI Python Teacher backend.
+
+The app starts a ServerTiming recorder per request when SERVER_TIMING_ENABLED
+is set; code deeper in the call stack adds stages through record() and
+stage(), which do nothing when no recorder is active.
+"""
+import contextlib
+import time
+from contextvars import ContextVar, Token
+from typing import Iterator, List, Optional, Tuple
+
+_current: ContextVar[Optional["ServerTiming"]] = ContextVar("server_timing", default=None)
+
+# Returned by stage() when timing is off, so the disabled path allocates nothing
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class ServerTiming:
+    """Durations of the stages of one request, rendered as a Server-Timing header."""
+
+    def __init__(self):
+        self._started = time.perf_counter()
+        self._entries: List[Tuple[str, float, Optional[str]]] = []
+
+    def add(self, name: str, duration_s: float, desc: Optional[str] = None) -> None:
+        """Add one stage; name must be an HTTP token (letters, digits, '-', '_')."""
+        self._entries.append((name, duration_s, desc))
+
+    @contextlib.contextmanager
+    def measure(self, name: str, desc: Optional[str] = None) -> Iterator[None]:
+        """Time the body of a with-block as one stage."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0, desc)
+
+    def header_value(self) -> str:
+        """Return the header value, ending with the total time so far."""
+        parts = []
+        for name, duration_s, desc in self._entries + [("total", time.perf_counter() - self._started, None)]:
+            part = f"{name};dur={duration_s * 1000:.1f}"
+            if desc:
+                part += ';desc="{}"'.format(desc.replace("\\", "\\\\").replace('"', '\\"'))
+            parts.append(part)
+        return ", ".join(parts)
+
+
+def start() -> Tuple[ServerTiming, Token]:
+    """Activate a new recorder for the current context; pass the token to stop()."""
+    recorder = ServerTiming()
+    return recorder, _current.set(recorder)
+
+
+def stop(token: Token) -> None:
+    """Deactivate the recorder activated by start()."""
+    _current.reset(token)
+
+
+def record(name: str, duration_s: float, desc: Optional[str] = None) -> None:
+    """Add a stage to the active recorder, if any."""
+    recorder = _current.get()
+    if recorder is not None:
+        recorder.add(name, duration_s, desc)
+
+
+def stage(name: str):
+    """Context manager timing a stage on the active recorder, if any."""
+    recorder = _current.get()
+    return _NULL_STAGE if recorder is None else recorder.measure(name)
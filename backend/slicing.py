@@ -0,0 +1,179 @@
+"""
+AST-based slicing of student code for the AI Python Teacher backend.
+
+In a large multi-function submission only a few definitions matter to the
+question. slice_code() parses the code and picks the functions, classes and
+statements the question refers to, by name or by a line number from a pasted
+traceback. It adds their direct dependencies (the module-level definitions
+and sibling methods they use, and the constants any of those read) and
+reduces every other function and class to its signature.
+compaction.compact_code() applies the slice when the code is over its token
+budget.
+"""
+import ast
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+_TRACEBACK_LINE_RE = re.compile(r"\bline (\d+)")
+_IDENT_RE = re.compile(r"[A-Za-z_]\w*")
+
+_FUNC_TYPES = (ast.FunctionDef, ast.AsyncFunctionDef)
+_DEF_TYPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+_Def = Union[ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef]
+
+
+@dataclass
+class CodeSlice:
+    """
+    The parts of a submission to send.
+
+    keep holds original line numbers sent verbatim; summaries maps the first
+    line of each reduced function or class to (last line, signature text).
+    """
+
+    keep: Set[int] = field(default_factory=set)
+    summaries: Dict[int, Tuple[int, str]] = field(default_factory=dict)
+
+
+def question_hints(question: str) -> Tuple[List[int], Set[str]]:
+    """
+    Extract what a question points at in the code.
+
+    Returns:
+        A tuple of (line numbers from a pasted traceback, identifiers)
+    """
+    return [int(n) for n in _TRACEBACK_LINE_RE.findall(question)], set(_IDENT_RE.findall(question))
+
+
+def _span(node: ast.stmt) -> Tuple[int, int]:
+    """Return the first and last line of a statement, including decorators."""
+    decorators = getattr(node, "decorator_list", [])
+    return min([node.lineno] + [d.lineno for d in decorators]), node.end_lineno or node.lineno
+
+
+def _signature(node: _Def) -> str:
+    """Render a definition as a one-line signature noting the lines it replaces."""
+    if isinstance(node, ast.ClassDef):
+        keyword = "class"
+    else:
+        keyword = "async def" if isinstance(node, ast.AsyncFunctionDef) else "def"
+    try:
+        if isinstance(node, ast.ClassDef):
+            bases = [ast.unparse(b) for b in node.bases] + [ast.unparse(k) for k in node.keywords]
+            head = f"class {node.name}({', '.join(bases)})" if bases else f"class {node.name}"
+        else:
+            head = f"{keyword} {node.name}({ast.unparse(node.args)})"
+            if node.returns is not None:
+                head += f" -> {ast.unparse(node.returns)}"
+    except (RecursionError, MemoryError):
+        head = f"{keyword} {node.name}(...)"  # defaults or bases nested too deeply to unparse
+    first, last = _span(node)
+    return f"{' ' * node.col_offset}{head}: ...  # lines {first}-{last}"
+
+
+def _used_names(node: ast.AST) -> Set[str]:
+    """Names and attribute names read anywhere inside node."""
+    names: Set[str] = set()
+    for sub in ast.walk(node):
+        if isinstance(sub, ast.Name):
+            names.add(sub.id)
+        elif isinstance(sub, ast.Attribute):
+            names.add(sub.attr)
+    return names
+
+
+def _assigned_names(stmt: ast.stmt) -> Set[str]:
+    """Names bound by a module-level assignment statement."""
+    if isinstance(stmt, ast.Assign):
+        targets: List[ast.expr] = stmt.targets
+    elif isinstance(stmt, (ast.AnnAssign, ast.AugAssign)):
+        targets = [stmt.target]
+    else:
+        return set()
+    return {n.id for t in targets for n in ast.walk(t) if isinstance(n, ast.Name)}
+
+
+def _refers_to(node: ast.stmt, linenos: List[int], names: Set[str]) -> bool:
+    first, last = _span(node)
+    if isinstance(node, _DEF_TYPES) and node.name in names:
+        return True
+    return any(first <= n <= last for n in linenos)
+
+
+def _is_docstring(stmt: ast.stmt) -> bool:
+    return isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Constant) and isinstance(stmt.value.value, str)
+
+
+def slice_code(code: str, question: str) -> Optional[CodeSlice]:
+    """
+    Pick the parts of code that matter to question.
+
+    Args:
+        code: The student's Python code
+        question: The student's question, possibly with a pasted traceback
+
+    Returns:
+        The slice, or None when the code does not parse (including code
+        nested too deeply to parse) or the question refers to nothing in it
+    """
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        return None
+    linenos, names = question_hints(question)
+
+    # Targets are what the question refers to; for a class, the innermost
+    # referenced method is targeted unless the class itself is named.
+    targets: List[ast.stmt] = []
+    owners: Dict[int, ast.ClassDef] = {}
+    for stmt in tree.body:
+        if isinstance(stmt, ast.ClassDef) and stmt.name not in names:
+            methods = [m for m in stmt.body if isinstance(m, _FUNC_TYPES) and _refers_to(m, linenos, names)]
+            for method in methods:
+                targets.append(method)
+                owners[id(method)] = stmt
+            if methods:
+                continue
+        if _refers_to(stmt, linenos, names):
+            targets.append(stmt)
+    if not targets:
+        return None
+
+    target_names = {t.name for t in targets if isinstance(t, _DEF_TYPES)}
+    used: Set[str] = set()
+    for target in targets:
+        used |= _used_names(target)
+
+    kept: Set[int] = {id(t) for t in targets}
+    for owner in owners.values():
+        # Direct dependencies inside the class: __init__ and sibling methods used
+        for member in owner.body:
+            if isinstance(member, _FUNC_TYPES) and (member.name == "__init__" or member.name in used):
+                kept.add(id(member))
+    deps = [s for s in tree.body if isinstance(s, _DEF_TYPES) and s.name in used and id(s) not in kept]
+    for dep in deps:
+        kept.add(id(dep))
+        used |= _used_names(dep)
+    for stmt in tree.body:
+        if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+            kept.add(id(stmt))
+        elif not isinstance(stmt, _DEF_TYPES) and (_assigned_names(stmt) & used or _used_names(stmt) & target_names):
+            kept.add(id(stmt))  # constants read by what is kept, or module-level callers
+
+    result = CodeSlice()
+    for stmt in tree.body:
+        first, last = _span(stmt)
+        if id(stmt) in kept:
+            result.keep.update(range(first, last + 1))
+        elif isinstance(stmt, ast.ClassDef) and any(id(m) in kept for m in stmt.body):
+            result.keep.update(range(first, _span(stmt.body[0])[0]))
+            for member in stmt.body:
+                m_first, m_last = _span(member)
+                if id(member) in kept or not (isinstance(member, _DEF_TYPES) or _is_docstring(member)):
+                    result.keep.update(range(m_first, m_last + 1))
+                elif isinstance(member, _DEF_TYPES):
+                    result.summaries[m_first] = (m_last, _signature(member))
+        elif isinstance(stmt, _DEF_TYPES):
+            result.summaries[first] = (last, _signature(stmt))
+    return result
@@ -0,0 +1,291 @@
+"""
+Local answers for code that does not parse.
+
+Many beginner questions come with code that has a syntax error, which Python
+reports precisely. fast_path_answer() parses the code with ast.parse() and,
+if that fails, builds a tutor answer in the usual five-heading format from
+the SyntaxError, so the request is answered without calling Gemini.
+"""
+import ast
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import metrics
+from config import SYNTAX_FAST_PATH_ENABLED, logger
+
+# Longest source line quoted in an answer
+_MAX_QUOTED_LINE = 160
+
+
+class _Advice(NamedTuple):
+    why: str
+    hints: Tuple[str, ...]
+    questions: Tuple[str, ...]
+    step: str
+
+
+# SyntaxError message fragments and their category, checked in order
+_MESSAGE_CATEGORIES: List[Tuple[str, str]] = [
+    ("expected ':'", "missing_colon"),
+    ("was never closed", "unclosed_bracket"),
+    ("does not match opening parenthesis", "unclosed_bracket"),
+    ("unmatched", "unclosed_bracket"),
+    ("unterminated string", "unterminated_string"),
+    ("unterminated triple-quoted string", "unterminated_string"),
+    ("Missing parentheses in call to 'print'", "print_statement"),
+    ("Maybe you meant '==' or ':='", "assignment_vs_comparison"),
+    ("cannot assign", "assignment_vs_comparison"),
+    ("Perhaps you forgot a comma", "missing_comma"),
+    ("invalid character", "invalid_character"),
+    ("invalid non-printable character", "invalid_character"),
+]
+
+_ADVICE: Dict[str, _Advice] = {
+    "indentation": _Advice(
+        why=(
+            "Python uses indentation to decide which lines belong to a block (the body of an if, "
+            "for, while, def or class). The indentation here does not match the block structure "
+            "Python expects."
+        ),
+        hints=(
+            "A line ending in ':' must be followed by at least one line indented further.",
+            "All lines in the same block need exactly the same indentation.",
+            "Mixing tabs and spaces can look fine on screen but confuse Python; use 4 spaces everywhere.",
+        ),
+        questions=(
+            "Which line starts the block this line should belong to?",
+            "Does every line in that block start at the same column?",
+        ),
+        step="Line up this line with the other lines of its block, using spaces only.",
+    ),
+    "missing_colon": _Advice(
+        why=(
+            "Statements that start a block (if, elif, else, for, while, def, class, try, except, "
+            "with) must end with a colon."
+        ),
+        hints=(
+            "Read the end of the line Python points at: what character should come last?",
+            "Check the other block-starting lines too; the same slip often appears more than once.",
+        ),
+        questions=(
+            "Which statements in Python start a new indented block?",
+            "What character ends the first line of every such statement?",
+        ),
+        step="Add the missing character at the end of the line Python reported.",
+    ),
+    "unclosed_bracket": _Advice(
+        why=(
+            "Every (, [ and { needs a matching ), ] or }. When one is missing or extra, Python "
+            "cannot tell where the expression ends, and it often reports the problem at the "
+            "opening bracket or on a later line."
+        ),
+        hints=(
+            "Count the opening and closing brackets on the reported line and the lines around it.",
+            "Check that each bracket closes with the same kind it opened with: ( with ), [ with ].",
+            "Many editors highlight the matching bracket when the cursor is next to one.",
+        ),
+        questions=(
+            "Which bracket on this line does not have a partner?",
+            "Does the expression end where you intended?",
+        ),
+        step="Find the bracket without a partner and add or remove one so they pair up.",
+    ),
+    "unterminated_string": _Advice(
+        why=(
+            "A string starts with a quote and must end with the same kind of quote. If the closing "
+            "quote is missing, Python reads the rest of the line (or file) as part of the string."
+        ),
+        hints=(
+            "Look for a string on the reported line that opens with ' or \" but never closes.",
+            "If the text contains a quote, use the other kind of quote around it, or escape it with a backslash.",
+        ),
+        questions=(
+            "Where does the string on this line begin, and where should it end?",
+            "Does the text inside the string contain the same quote character?",
+        ),
+        step="Close the string with the same quote character it starts with.",
+    ),
+    "print_statement": _Advice(
+        why=(
+            "In Python 3, print is a function, so its arguments go inside parentheses. Code "
+            "written for Python 2 used print without them."
+        ),
+        hints=(
+            "Compare this line with how you call other functions, such as len(x).",
+            "Everything you want printed goes between the parentheses.",
+        ),
+        questions=(
+            "How do you call a function in Python?",
+            "Is print a statement or a function in Python 3?",
+        ),
+        step="Put the value you are printing inside parentheses after print.",
+    ),
+    "assignment_vs_comparison": _Advice(
+        why=(
+            "A single = stores a value in a variable; == compares two values. Python only allows = "
+            "where a name (or item) is being assigned, not inside a condition or on an expression."
+        ),
+        hints=(
+            "In an if or while condition you usually want to compare, not assign.",
+            "The left side of = must be a variable name, not a calculation or a function call.",
+        ),
+        questions=(
+            "What is the difference between = and == in Python?",
+            "Is this line trying to store a value or test one?",
+        ),
+        step="Decide whether the line should store or compare, and use = or == to match.",
+    ),
+    "missing_comma": _Advice(
+        why=(
+            "Items in a list, tuple, dictionary or function call are separated by commas. Without "
+            "one, Python sees two values side by side and cannot combine them."
+        ),
+        hints=(
+            "Read the items on the reported line one by one and check what separates them.",
+            "Look near the column Python points at.",
+        ),
+        questions=(
+            "What separates the items in a list or the arguments of a call?",
+            "Where does one item end and the next begin on this line?",
+        ),
+        step="Add the missing separator between the two items Python points at.",
+    ),
+    "invalid_character": _Advice(
+        why=(
+            "The code contains a character Python does not accept, often a curly quote, a long "
+            "dash or an invisible character copied from a document or web page."
+        ),
+        hints=(
+            "Retype the quotes and dashes on the reported line by hand in your editor.",
+            "Code copied from a word processor or slides often picks up these characters.",
+        ),
+        questions=(
+            "Did this line come from a document or web page rather than your editor?",
+            "Which characters on this line look slightly different from the rest?",
+        ),
+        step="Retype the reported line in your editor instead of pasting it.",
+    ),
+    "other": _Advice(
+        why=(
+            "Python reads the whole file and checks its grammar before running any of it. "
+            "Something on this line does not follow Python's grammar, so none of your program ran."
+        ),
+        hints=(
+            "Look for missing colons, brackets, quotes or commas near the column Python points at.",
+            "Compare the line with a similar line that works.",
+        ),
+        questions=(
+            "What is this line meant to do, in plain words?",
+            "Which part of the line does the caret point at?",
+        ),
+        step="Fix the part of the line the caret points at.",
+    ),
+}
+
+
+def _categorize(exc: SyntaxError) -> str:
+    if isinstance(exc, IndentationError):  # includes TabError
+        return "indentation"
+    message = exc.msg or ""
+    for fragment, category in _MESSAGE_CATEGORIES:
+        if fragment in message:
+            return category
+    return "other"
+
+
+def _quote_line(code: str, exc: SyntaxError) -> Optional[str]:
+    """Return the offending line with a caret under the error, if it is short enough."""
+    lines = code.splitlines()
+    if not exc.lineno or exc.lineno > len(lines):
+        return None
+    text = lines[exc.lineno - 1].rstrip()
+    if not text.strip() or len(text) > _MAX_QUOTED_LINE:
+        return None
+    offset = max(1, min(exc.offset or 1, len(text) + 1))
+    width = 1
+    if exc.end_offset and exc.end_lineno == exc.lineno and exc.end_offset > offset:
+        width = min(exc.end_offset, len(text) + 1) - offset
+    # Keep tabs in the padding so the caret lines up however tabs are shown
+    pad = "".join(c if c == "\t" else " " for c in text[: offset - 1])
+    return f"{text}\n{pad}{'^' * max(1, width)}"
+
+
+def build_syntax_answer(code: str, exc: SyntaxError) -> Tuple[str, str]:
+    """
+    Build a five-heading tutor answer for a syntax error.
+
+    Args:
+        code: The student's code
+        exc: The SyntaxError raised when parsing it
+
+    Returns:
+        A tuple of (answer, category)
+    """
+    category = _categorize(exc)
+    advice = _ADVICE[category]
+    where = f"line {exc.lineno}" if exc.lineno else "your code"
+    if exc.lineno and exc.offset:
+        where += f", column {exc.offset}"
+    kind = type(exc).__name__
+    parts = [
+        "1) Diagnosis",
+        f"Before looking at your question: Python cannot run this code yet. It stops with {kind}: "
+        f"{exc.msg} ({where}).",
+    ]
+    quoted = _quote_line(code, exc)
+    if quoted:
+        parts.append(f"```python\n{quoted}\n```")
+    parts += [
+        "",
+        "2) Why it happens",
+        advice.why,
+        "",
+        "3) Hints",
+        f"- Start at {where}; Python sometimes notices a mistake one line after it happens.",
+    ]
+    parts += [f"- {hint}" for hint in advice.hints]
+    parts += ["", "4) Check yourself"]
+    parts += [f"- {question}" for question in advice.questions]
+    parts += [
+        "",
+        "5) Next small step",
+        f"{advice.step} Then run the code again: if Python reports a different line, this error is fixed "
+        "and you can ask your question again with the new code.",
+    ]
+    return "\n".join(parts) + "\n", category
+
+
+def fast_path_answer(fields: Dict[str, str], request_id: str) -> Optional[str]:
+    """
+    Answer locally when the request's code does not parse.
+
+    Args:
+        fields: Validated topic, code, question and level
+        request_id: Request identifier for logging
+
+    Returns:
+        The tutor answer, or None when the fast path is off, there is no
+        code, or the code parses (or is nested too deeply to parse)
+    """
+    code = fields["code"]
+    if not SYNTAX_FAST_PATH_ENABLED or not code.strip():
+        return None
+    try:
+        ast.parse(code)
+        return None
+    except SyntaxError as exc:
+        error = exc
+    except ValueError:
+        return None  # e.g. null bytes; let the model deal with it
+    except (RecursionError, MemoryError):
+        return None  # nested too deeply for the parser; let the model deal with it
+
+    answer, category = build_syntax_answer(code, error)
+    metrics.syntax_fast_path.inc(category)
+    logger.info(
+        "syntax_fast_path request_id=%s category=%s line=%s msg=%s",
+        request_id,
+        category,
+        error.lineno,
+        error.msg,
+    )
+    return answer
@@ -1,18 +1,62 @@
 """
 Unit tests for the AI Python Teacher backend.
 """
+import ast
+import asyncio
 import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import patch, MagicMock
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import AsyncMock, patch, MagicMock
+
+import httpx
+import metrics
+import server_timing
+from starlette.testclient import TestClient
 
 # Import the Flask app
-from app import app
+from app import app, idempotency_store, rate_limiter, response_cache, upstream_calls
+import asgi_app
+import faq
+import fingerprint
+import requests
+import gemini_ai_async
+from benchmarks.bench_micro import compare as compare_benchmarks
+from benchmarks.gemini_stub import StubConfig, parse_latency, start_in_thread
+from benchmarks.load_test import Recorder, build_report, make_ask_body, percentile
+from cache import AsyncSingleFlight, SingleFlight, TTLCache, build_cache_key
+from compaction import compact_code, estimate_tokens
+from context_cache import ContextCache
+from idempotency import request_key
+from persistent_cache import SQLiteCache, open_response_cache
+from ratelimit import RateLimiter, client_identity
+from slicing import slice_code
+from syntax_check import build_syntax_answer, fast_path_answer
+from resilience import FAILURE, SUCCESS, TIMEOUT, AdmissionController, CircuitBreaker, HedgePolicy
+from validation import resolve_deadline
 from gemini_ai import (
+    TUTOR_SYSTEM_INSTRUCTION,
+    _build_payload,
+    _context_cache_wait,
     build_tutor_prompt,
+    generate_response,
     sanitize_tutor_output,
     MAX_CODE_BLOCK_LINES,
     SUSPICIOUS_LINE_THRESHOLD,
     MAX_OUTPUT_LINES,
+    StreamingSanitizer,
+    _CODE_OMITTED_NOTICE,
+    stream_response,
+    tutor_context,
+    upstream_breaker,
 )
 
 
@@ -23,6 +67,8 @@ class TestHealthEndpoint(unittest.TestCase):
         """Set up test client."""
         app.testing = True
         self.client = app.test_client()
+        upstream_breaker.reset()
+        self.addCleanup(upstream_breaker.reset)
 
     def test_health_returns_ok(self):
         """Health endpoint should return status ok."""
@@ -31,6 +77,15 @@ class TestHealthEndpoint(unittest.TestCase):
         data = json.loads(response.data)
         self.assertEqual(data['status'], 'ok')
 
+    def test_health_reports_open_breaker(self):
+        """Health should show the breaker state and report degraded when open."""
+        for _ in range(upstream_breaker.min_calls):
+            upstream_breaker.allow()
+            upstream_breaker.record(FAILURE)
+        data = json.loads(self.client.get('/health').data)
+        self.assertEqual(data['status'], 'degraded')
+        self.assertEqual(data['upstream']['breaker']['state'], 'open')
+
 
 class TestAskAiEndpoint(unittest.TestCase):
     """Tests for the /ask-ai endpoint."""
@@ -39,6 +94,214 @@ class TestAskAiEndpoint(unittest.TestCase):
         """Set up test client."""
         app.testing = True
         self.client = app.test_client()
+        response_cache.clear()
+        fingerprint.answer_cache.clear()
+        upstream_calls.coalesced = 0
+        rate_limiter.reset()
+        idempotency_store.clear()
+
+    @patch('app.generate_response')
+    def test_rate_limited_before_upstream(self, mock_generate):
+        """Over-limit requests should get 429 with Retry-After and never reach Gemini."""
+        limiter = RateLimiter(client_rate_per_s=0.01, client_burst=1, global_rate_per_s=0, global_burst=1)
+        with patch('app.rate_limiter', limiter), patch('app.RATE_LIMIT_API_KEYS', frozenset({'k'})):
+            mock_generate.return_value = ('answer', None)
+            first = self.client.post('/ask-ai', json={'question': 'q1'})
+            second = self.client.post('/ask-ai', json={'question': 'q2'})
+            unknown = self.client.post('/ask-ai', json={'question': 'q3'}, headers={'X-Api-Key': 'random'})
+            other = self.client.post('/ask-ai', json={'question': 'q4'}, headers={'X-Api-Key': 'k'})
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 429)
+        self.assertGreaterEqual(int(second.headers['Retry-After']), 1)
+        self.assertIn('request_id', json.loads(second.data))
+        self.assertEqual(unknown.status_code, 429)
+        self.assertEqual(other.status_code, 200)
+        self.assertEqual(mock_generate.call_count, 2)
+
+    @patch('app.generate_response')
+    def test_ask_ai_sheds_load_when_saturated(self, mock_generate):
+        """A full upstream pool and queue should give 503 with Retry-After at once."""
+        saturated = AdmissionController(max_concurrent=1, max_queue=0, max_wait_s=5)
+        self.assertTrue(saturated.acquire())
+        with patch('app.admission', saturated):
+            response = self.client.post('/ask-ai', json={'question': 'busy?'})
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '5')
+        self.assertTrue(json.loads(response.data)['details']['overloaded'])
+        mock_generate.assert_not_called()
+        self.assertEqual(saturated.snapshot()['shed_queue_full'], 1)
+
+    @patch('app.generate_response')
+    def test_large_code_is_compacted_before_prompting(self, mock_generate):
+        """Code over the token budget should reach Gemini cut down to the relevant part."""
+        mock_generate.return_value = ('answer', None)
+        code = ''.join(f'def f{i}(v):\n    return v * {i}\n\n' for i in range(2000))
+        code += 'def average(values):\n    return sum(values) / len(values)\n'
+        with patch('compaction.CODE_TOKEN_BUDGET', 200):
+            response = self.client.post('/ask-ai', json={'question': 'Why does average fail?', 'code': code})
+
+        self.assertEqual(response.status_code, 200)
+        prompt = mock_generate.call_args[0][0]
+        self.assertIn('def average(values):', prompt)
+        self.assertIn('omitted ...', prompt)
+        self.assertLess(len(prompt), len(code) // 10)
+
+    @patch('app.generate_response')
+    def test_syntax_error_answered_locally(self, mock_generate):
+        """Code that does not parse should be answered without calling Gemini."""
+        before = metrics.syntax_fast_path.value('missing_colon')
+        response = self.client.post('/ask-ai', json={'question': 'Why?', 'code': 'if x == 1\n    print(x)\n'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Answer-Source'], 'syntax-check')
+        self.assertNotIn('X-Cache', response.headers)
+        answer = json.loads(response.data)['answer']
+        for heading in ('1) Diagnosis', '2) Why it happens', '3) Hints', '4) Check yourself', '5) Next small step'):
+            self.assertIn(heading, answer)
+        self.assertIn("expected ':' (line 1, column 10)", answer)
+        mock_generate.assert_not_called()
+        self.assertEqual(metrics.syntax_fast_path.value('missing_colon'), before + 1)
+
+    @patch('app.generate_response')
+    def test_syntax_fast_path_can_be_disabled(self, mock_generate):
+        """With the switch off, code that does not parse should still go to Gemini."""
+        mock_generate.return_value = ('answer', None)
+        with patch('syntax_check.SYNTAX_FAST_PATH_ENABLED', False):
+            response = self.client.post('/ask-ai', json={'question': 'Why?', 'code': 'if x == 1\n'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        mock_generate.assert_called_once()
+
+    @patch('app.generate_response')
+    def test_common_question_answered_from_faq(self, mock_generate):
+        """A code-less question matching the FAQ should be answered without calling Gemini."""
+        before = metrics.faq_lookups.value('hit')
+        response = self.client.post('/ask-ai', json={'question': 'What are variables?', 'level': 'beginner'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Answer-Source'], 'faq')
+        self.assertNotIn('X-Cache', response.headers)
+        self.assertIn('1) Diagnosis\nA variable is a name', json.loads(response.data)['answer'])
+        mock_generate.assert_not_called()
+        self.assertEqual(metrics.faq_lookups.value('hit'), before + 1)
+
+    @patch('app.generate_response')
+    def test_faq_skipped_with_code_or_when_disabled(self, mock_generate):
+        """Questions about the student's code, or with FAQ answers off, should go to Gemini."""
+        mock_generate.return_value = ('answer', None)
+        with_code = self.client.post('/ask-ai', json={'question': 'What is a variable?', 'code': 'x = 1\n'})
+        with patch('faq.FAQ_ENABLED', False):
+            disabled = self.client.post('/ask-ai', json={'question': 'What is a variable?'})
+
+        self.assertEqual(with_code.headers['X-Cache'], 'MISS')
+        self.assertEqual(disabled.headers['X-Cache'], 'MISS')
+        self.assertEqual(mock_generate.call_count, 2)
+
+    @patch('app.generate_response')
+    def test_equivalent_code_reuses_answer_with_renamed_identifiers(self, mock_generate):
+        """Code differing only in names and formatting should get the cached answer, translated."""
+        fingerprint.near_index.clear()
+        mock_generate.return_value = ('Check what `total` holds after the loop.', None)
+        first = self.client.post('/ask-ai', json={
+            'question': 'Why is total wrong?',
+            'code': 'total = 0\nfor v in [1, 2]:\n    total = v  # add\nprint(total)\n',
+        })
+        second = self.client.post('/ask-ai', json={
+            'question': 'why is s wrong',
+            'code': 's=0\nfor n in [1,2]:\n  s = n\nprint(s)\n',
+        })
+
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(second.headers['X-Cache-Match'], 'equivalent')
+        self.assertEqual(json.loads(second.data)['answer'], 'Check what `s` holds after the loop.')
+        mock_generate.assert_called_once()
+
+    @patch('app.generate_response')
+    def test_retry_with_same_request_id_is_replayed(self, mock_generate):
+        """A completed request retried with the same X-Request-Id and body should not run again."""
+        mock_generate.return_value = ('answer', None)
+        body = {'question': 'How do I reverse a list?'}
+        first = self.client.post('/ask-ai', json=body, headers={'X-Request-Id': 'retry-1'})
+        response_cache.clear()
+        fingerprint.answer_cache.clear()
+        retry = self.client.post('/ask-ai', json=body, headers={'X-Request-Id': 'retry-1'})
+        other_body = self.client.post('/ask-ai', json={'question': 'q2'}, headers={'X-Request-Id': 'retry-1'})
+        no_id = self.client.post('/ask-ai', json=body)
+
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry.headers['X-Idempotent-Replay'], 'true')
+        self.assertEqual(retry.headers['X-Cache'], 'MISS')
+        self.assertNotIn('X-Idempotent-Replay', other_body.headers)
+        self.assertNotIn('X-Idempotent-Replay', no_id.headers)
+        self.assertEqual(mock_generate.call_count, 3)
+        self.assertGreaterEqual(idempotency_store.snapshot()['replayed'], 1)
+
+    @patch('app.generate_response')
+    def test_concurrent_duplicate_attaches_to_in_flight_request(self, mock_generate):
+        """A duplicate arriving while the original runs should wait for it instead of calling Gemini."""
+        started, release = threading.Event(), threading.Event()
+
+        def slow(prompt, request_id=None, deadline=None):
+            started.set()
+            release.wait(5)
+            return 'answer', None
+
+        mock_generate.side_effect = slow
+        responses = {}
+
+        def post(name):
+            responses[name] = app.test_client().post(
+                '/ask-ai', json={'question': 'How do I reverse a list?'}, headers={'X-Request-Id': 'dup-1'}
+            )
+
+        leader = threading.Thread(target=post, args=('leader',))
+        leader.start()
+        self.assertTrue(started.wait(5))
+        follower = threading.Thread(target=post, args=('follower',))
+        follower.start()
+        deadline = time.monotonic() + 5
+        while idempotency_store._in_flight.coalesced == 0:
+            self.assertLess(time.monotonic(), deadline, 'duplicate never attached')
+            time.sleep(0.001)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+
+        self.assertEqual(mock_generate.call_count, 1)
+        self.assertEqual(responses['follower'].data, responses['leader'].data)
+        self.assertEqual(responses['follower'].headers['X-Idempotent-Replay'], 'true')
+
+    @patch('app.generate_response')
+    def test_failed_request_is_not_replayed(self, mock_generate):
+        """A retry after an upstream failure should try again rather than replay the error."""
+        mock_generate.side_effect = [(None, {'message': 'boom'}), ('answer', None)]
+        body = {'question': 'How do I reverse a list?'}
+        first = self.client.post('/ask-ai', json=body, headers={'X-Request-Id': 'fail-1'})
+        retry = self.client.post('/ask-ai', json=body, headers={'X-Request-Id': 'fail-1'})
+        self.assertEqual(first.status_code, 502)
+        self.assertEqual(retry.status_code, 200)
+        self.assertNotIn('X-Idempotent-Replay', retry.headers)
+
+    def test_request_key(self):
+        """Keys should need a usable request id and depend on the path and body."""
+        key = request_key('id-1', '/ask-ai', b'{}')
+        self.assertEqual(key, request_key('id-1', '/ask-ai', b'{}'))
+        self.assertNotEqual(key, request_key('id-1', '/ask-ai/batch', b'{}'))
+        self.assertNotEqual(key, request_key('id-1', '/ask-ai', b'{"a": 1}'))
+        self.assertIsNone(request_key('', '/ask-ai', b'{}'))
+        self.assertIsNone(request_key('x' * 200, '/ask-ai', b'{}'))
+
+    def test_rate_limit_ignores_preflight(self):
+        """CORS preflight requests should not consume tokens."""
+        limiter = RateLimiter(client_rate_per_s=0.01, client_burst=1, global_rate_per_s=0, global_burst=1)
+        with patch('app.rate_limiter', limiter):
+            for _ in range(3):
+                self.client.options('/ask-ai')
+        self.assertEqual(limiter.snapshot()['allowed'], 0)
 
     def test_ask_ai_requires_json(self):
         """Should return 400 when Content-Type is not JSON."""
@@ -78,7 +341,7 @@ class TestAskAiEndpoint(unittest.TestCase):
         
         response = self.client.post(
             '/ask-ai',
-            data=json.dumps({'question': 'How do I use loops?', 'level': 'beginner'}),
+            data=json.dumps({'question': 'How do I reverse a list?', 'level': 'beginner'}),
             content_type='application/json'
         )
         self.assertEqual(response.status_code, 200)
@@ -102,6 +365,1694 @@ class TestAskAiEndpoint(unittest.TestCase):
         self.assertIn('AI provider error', data['error'])
 
 
+    @patch('app.generate_response')
+    def test_ask_ai_serves_repeat_from_cache(self, mock_generate):
+        """Identical requests should hit the cache instead of the API."""
+        mock_generate.return_value = ('Cached tutor response', None)
+        payload = json.dumps({'question': 'What is a loop?', 'code': 'for i in x:  \n    pass'})
+
+        first = self.client.post('/ask-ai', data=payload, content_type='application/json')
+        second = self.client.post('/ask-ai', data=payload, content_type='application/json')
+
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(json.loads(second.data)['answer'], 'Cached tutor response')
+        self.assertEqual(mock_generate.call_count, 1)
+
+    @patch('app.generate_response')
+    def test_ask_ai_does_not_cache_errors(self, mock_generate):
+        """Failed upstream calls should not be cached."""
+        mock_generate.return_value = (None, {'message': 'boom'})
+        payload = json.dumps({'question': 'What is a loop?'})
+
+        self.client.post('/ask-ai', data=payload, content_type='application/json')
+        self.client.post('/ask-ai', data=payload, content_type='application/json')
+
+        self.assertEqual(mock_generate.call_count, 2)
+
+    @patch('app.generate_response')
+    def test_ask_ai_coalesces_concurrent_identical_requests(self, mock_generate):
+        """Concurrent identical requests should share one upstream error."""
+        release = threading.Event()
+
+        def slow_failure(prompt, request_id, deadline=None):
+            release.wait(5)
+            return None, {'message': 'rate limited', 'status': 429}
+
+        mock_generate.side_effect = slow_failure
+        payload = json.dumps({'question': 'Why is my loop infinite?'})
+        statuses = []
+
+        def post():
+            resp = app.test_client().post('/ask-ai', data=payload, content_type='application/json')
+            statuses.append(resp.status_code)
+
+        threads = [threading.Thread(target=post) for _ in range(3)]
+        for t in threads:
+            t.start()
+        deadline = time.monotonic() + 5
+        while upstream_calls.coalesced < 2 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(statuses, [502, 502, 502])
+        self.assertEqual(mock_generate.call_count, 1)
+
+    @patch('app.generate_response')
+    def test_ask_ai_maps_open_circuit_to_503(self, mock_generate):
+        """Should fail fast with 503 and Retry-After while the circuit is open."""
+        mock_generate.return_value = (None, {'message': 'open', 'circuit_open': True, 'retry_after_s': 4.2})
+        response = self.client.post(
+            '/ask-ai',
+            data=json.dumps({'question': 'test question'}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '5')
+
+    @patch('app.generate_response')
+    def test_ask_ai_maps_deadline_to_504(self, mock_generate):
+        """Should return 504 and pass the header deadline upstream."""
+        mock_generate.return_value = (None, {'message': 'Gemini deadline exceeded.', 'deadline_exceeded': True})
+        before = time.monotonic()
+        response = self.client.post(
+            '/ask-ai',
+            data=json.dumps({'question': 'test question'}),
+            content_type='application/json',
+            headers={'X-Deadline-Ms': '1500'},
+        )
+        self.assertEqual(response.status_code, 504)
+        deadline = mock_generate.call_args.kwargs['deadline']
+        self.assertGreater(deadline, before)
+        self.assertLessEqual(deadline, time.monotonic() + 1.5)
+
+
+class TestAskAiBatchEndpoint(unittest.TestCase):
+    """Tests for the /ask-ai/batch endpoint."""
+
+    def setUp(self):
+        """Set up test client."""
+        app.testing = True
+        self.client = app.test_client()
+        response_cache.clear()
+        fingerprint.answer_cache.clear()
+        rate_limiter.reset()
+        idempotency_store.clear()
+
+    @patch('app.generate_response')
+    def test_results_keep_input_order_with_item_errors(self, mock_generate):
+        """Each item should get its own result or error, in input order."""
+        def fake(prompt, request_id=None, deadline=None):
+            if 'broken' in prompt:
+                return None, {'message': 'boom'}
+            return 'answer for ' + prompt.split('Student question:')[-1].strip().splitlines()[0], None
+        mock_generate.side_effect = fake
+
+        response = self.client.post('/ask-ai/batch', json={'items': [
+            {'question': 'first'},
+            {'topic': 'no question'},
+            {'question': 'broken'},
+            {'question': 'last', 'level': 'advanced'},
+        ]})
+
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.data)['results']
+        self.assertEqual([r['status'] for r in results], [200, 400, 502, 200])
+        self.assertIn('first', results[0]['answer'])
+        self.assertIn('question', results[1]['error'])
+        self.assertEqual(results[2]['details'], {'message': 'boom'})
+        self.assertIn('last', results[3]['answer'])
+
+    @patch('app.generate_response')
+    def test_syntax_errors_answered_locally(self, mock_generate):
+        """Items whose code does not parse should be answered without Gemini."""
+        mock_generate.return_value = ('answer', None)
+        response = self.client.post('/ask-ai/batch', json=[
+            {'question': 'q1', 'code': 'def f(:\n'},
+            {'question': 'q2', 'code': 'x = 1\n'},
+        ])
+        results = json.loads(response.data)['results']
+        self.assertEqual(results[0]['source'], 'syntax-check')
+        self.assertNotIn('cache', results[0])
+        self.assertEqual(results[1]['cache'], 'MISS')
+        self.assertEqual(mock_generate.call_count, 1)
+
+    @patch('app.generate_response')
+    def test_items_run_concurrently(self, mock_generate):
+        """Upstream calls should overlap instead of running one after another."""
+        def slow(prompt, request_id=None, deadline=None):
+            time.sleep(0.2)
+            return 'ok', None
+        mock_generate.side_effect = slow
+
+        start = time.monotonic()
+        response = self.client.post('/ask-ai/batch', json=[{'question': f'q{i}'} for i in range(8)])
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data)['results']), 8)
+        self.assertLess(elapsed, 0.2 * 8 / 2)
+
+    @patch('app.generate_response')
+    def test_cached_items_skip_upstream(self, mock_generate):
+        """Items answered before should come from the response cache."""
+        mock_generate.return_value = ('cached answer', None)
+        self.client.post('/ask-ai', json={'question': 'seen'})
+        response = self.client.post('/ask-ai/batch', json=[{'question': 'seen'}])
+        self.assertEqual(json.loads(response.data)['results'][0]['cache'], 'HIT')
+        self.assertEqual(mock_generate.call_count, 1)
+
+    def test_rejects_bad_batches(self):
+        """Empty, non-array and oversized batches should be rejected as a whole."""
+        self.assertEqual(self.client.post('/ask-ai/batch', json={'items': []}).status_code, 400)
+        self.assertEqual(self.client.post('/ask-ai/batch', json={'question': 'q'}).status_code, 400)
+        self.assertEqual(self.client.post('/ask-ai/batch', data='x').status_code, 400)
+        with patch('app.BATCH_MAX_ITEMS', 2):
+            response = self.client.post('/ask-ai/batch', json=[{'question': 'q'}] * 3)
+        self.assertEqual(response.status_code, 413)
+
+    @patch('app.generate_response')
+    def test_rate_limit_charges_each_valid_item(self, mock_generate):
+        """Valid items should take one token each; items past the limit get 429 results."""
+        mock_generate.return_value = ('answer', None)
+        limiter = RateLimiter(client_rate_per_s=0.01, client_burst=3, global_rate_per_s=0, global_burst=1)
+        with patch('app.rate_limiter', limiter):
+            response = self.client.post('/ask-ai/batch', json=[
+                {'question': 'a'}, {'topic': 'no question'}, {'question': 'b'},
+                {'question': 'c'}, {'question': 'd'},
+            ])
+            exhausted = self.client.post('/ask-ai/batch', json=[{'question': 'e'}])
+
+        results = json.loads(response.data)['results']
+        self.assertEqual([r['status'] for r in results], [200, 400, 200, 200, 429])
+        self.assertGreaterEqual(results[4]['retry_after_s'], 1)
+        self.assertEqual(mock_generate.call_count, 3)
+        self.assertEqual(exhausted.status_code, 429)
+        self.assertGreaterEqual(int(exhausted.headers['Retry-After']), 1)
+
+
+class TestAskAiStreamEndpoint(unittest.TestCase):
+    """Tests for the /ask-ai/stream SSE endpoint."""
+
+    def setUp(self):
+        """Set up test client."""
+        app.testing = True
+        self.client = app.test_client()
+        response_cache.clear()
+        fingerprint.answer_cache.clear()
+
+    @staticmethod
+    def _events(response):
+        events = []
+        for block in response.get_data(as_text=True).strip().split('\n\n'):
+            lines = block.split('\n')
+            events.append((lines[0][len('event: '):], json.loads(lines[1][len('data: '):])))
+        return events
+
+    def test_stream_validates_like_ask_ai(self):
+        """Should apply the same validation as /ask-ai."""
+        response = self.client.post('/ask-ai/stream', data='not json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(
+            '/ask-ai/stream',
+            data=json.dumps({'topic': 'test'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('question', json.loads(response.data)['error'])
+
+    @patch('app.stream_response')
+    def test_stream_answers_syntax_errors_locally(self, mock_stream):
+        """Code that does not parse should be streamed from the local answer."""
+        response = self.client.post(
+            '/ask-ai/stream',
+            data=json.dumps({'question': 'Why?', 'code': "print('hi)\n"}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Answer-Source'], 'syntax-check')
+        events = self._events(response)
+        self.assertEqual([e[0] for e in events], ['chunk', 'done'])
+        self.assertIn('unterminated string literal', events[0][1]['text'])
+        mock_stream.assert_not_called()
+
+    @patch('app.stream_response')
+    def test_stream_emits_chunks_and_done(self, mock_stream):
+        """Should forward chunks and finish with a done event."""
+        mock_stream.return_value = (iter(['Diagnosis: ', 'off by one.']), None)
+
+        response = self.client.post(
+            '/ask-ai/stream',
+            data=json.dumps({'question': 'Why?'}),
+            content_type='application/json',
+            headers={'X-Request-Id': 'req-1'},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.mimetype.startswith('text/event-stream'))
+        events = self._events(response)
+        self.assertEqual(events[0], ('chunk', {'text': 'Diagnosis: '}))
+        self.assertEqual(events[1], ('chunk', {'text': 'off by one.'}))
+        self.assertEqual(events[2][0], 'done')
+        self.assertEqual(events[2][1]['request_id'], 'req-1')
+        self.assertIn('total_ms', events[2][1])
+
+    @patch('app.stream_response')
+    def test_stream_sanitizes_long_code(self, mock_stream):
+        """Streamed answers should keep the code-dump guardrail."""
+        long_code = '\n'.join(f'line{i} = {i}' for i in range(20))
+        text = f"Solution:\n```python\n{long_code}\n```\nDone!"
+        mock_stream.return_value = (iter([text[i:i + 5] for i in range(0, len(text), 5)]), None)
+
+        response = self.client.post(
+            '/ask-ai/stream',
+            data=json.dumps({'question': 'Why?'}),
+            content_type='application/json'
+        )
+        streamed = ''.join(e[1]['text'] for e in self._events(response) if e[0] == 'chunk')
+        self.assertEqual(streamed, sanitize_tutor_output(text))
+        self.assertNotIn('line10', streamed)
+
+    @patch('app.stream_response')
+    def test_stream_returns_502_when_upstream_fails(self, mock_stream):
+        """Should return a JSON 502 when the stream cannot be opened."""
+        mock_stream.return_value = (None, {'message': 'API key invalid'})
+        response = self.client.post(
+            '/ask-ai/stream',
+            data=json.dumps({'question': 'Why?'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 502)
+
+    @patch('app.stream_response')
+    def test_stream_reports_broken_stream(self, mock_stream):
+        """Should emit an error event when the upstream stream breaks."""
+        def broken():
+            yield 'partial'
+            raise ConnectionError('reset')
+
+        mock_stream.return_value = (broken(), None)
+        response = self.client.post(
+            '/ask-ai/stream',
+            data=json.dumps({'question': 'Why?'}),
+            content_type='application/json'
+        )
+        events = self._events(response)
+        self.assertEqual([e[0] for e in events], ['chunk', 'error'])
+
+
+class TestStreamResponse(unittest.TestCase):
+    """Tests for parsing Gemini's streamGenerateContent SSE output."""
+
+    def setUp(self):
+        upstream_breaker.reset()
+
+    @patch('gemini_ai.GEMINI_API_KEY', 'test-key')
+    @patch('gemini_ai._get_http_session')
+    def test_yields_text_from_sse_lines(self, mock_session):
+        """Should yield candidate text from each data line."""
+        def sse(text):
+            return ('data: ' + json.dumps({'candidates': [{'content': {'parts': [{'text': text}]}}]})).encode('utf-8')
+
+        resp = MagicMock(status_code=200)
+        resp.iter_lines.return_value = [sse('Hello'), b'', sse(' w\u00f6rld'), b'data: {"usageMetadata": {}}']
+        mock_session.return_value.post.return_value = resp
+
+        chunks, err = stream_response('prompt', request_id='r1')
+        self.assertIsNone(err)
+        self.assertEqual(list(chunks), ['Hello', ' w\u00f6rld'])
+        resp.close.assert_called()
+        _, kwargs = mock_session.return_value.post.call_args
+        self.assertEqual(kwargs['params']['alt'], 'sse')
+        self.assertTrue(kwargs['stream'])
+
+    @patch('gemini_ai.GEMINI_API_KEY', 'test-key')
+    @patch('gemini_ai._get_http_session')
+    def test_non_retryable_error_is_returned(self, mock_session):
+        """Should return an error dict for non-retryable HTTP errors."""
+        resp = MagicMock(status_code=400)
+        resp.json.return_value = {'error': 'bad request'}
+        mock_session.return_value.post.return_value = resp
+
+        chunks, err = stream_response('prompt', request_id='r1')
+        self.assertIsNone(chunks)
+        self.assertEqual(err['status'], 400)
+
+class TestResponseCache(unittest.TestCase):
+    """Tests for the TTLCache class and cache keys."""
+
+    def test_get_and_set(self):
+        """Stored values should be returned and counted as hits."""
+        cache = TTLCache(max_entries=2, ttl_s=60)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 'answer')
+        self.assertEqual(cache.get('a'), 'answer')
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_evicts_least_recently_used(self):
+        """The least recently used entry should be evicted first."""
+        cache = TTLCache(max_entries=2, ttl_s=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    @patch('cache.time.monotonic')
+    def test_entries_expire(self, mock_monotonic):
+        """Entries older than the TTL should be treated as misses."""
+        mock_monotonic.return_value = 100.0
+        cache = TTLCache(max_entries=2, ttl_s=10)
+        cache.set('a', 1)
+        mock_monotonic.return_value = 111.0
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_zero_size_disables_cache(self):
+        """A cache with no capacity should never store anything."""
+        cache = TTLCache(max_entries=0, ttl_s=60)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_key_ignores_trailing_whitespace(self):
+        """Keys should be stable across cosmetic whitespace differences."""
+        config = {'temperature': 0.4}
+        self.assertEqual(
+            build_cache_key('line one  \r\nline two\n', 'm', config),
+            build_cache_key('line one\nline two', 'm', config),
+        )
+
+    def test_key_depends_on_model_and_config(self):
+        """Keys should change when the model or generation config changes."""
+        base = build_cache_key('prompt', 'model-a', {'temperature': 0.4})
+        self.assertNotEqual(base, build_cache_key('prompt', 'model-b', {'temperature': 0.4}))
+        self.assertNotEqual(base, build_cache_key('prompt', 'model-a', {'temperature': 0.9}))
+        self.assertNotEqual(base, build_cache_key('prompt', 'model-a', {'temperature': 0.4}, 'new rules'))
+        self.assertNotEqual(base, build_cache_key('prompt', 'model-a', {'temperature': 0.4}, '', '2'))
+
+
+class TestSQLiteCache(unittest.TestCase):
+    """Tests for the persistent SQLite response cache."""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self.path = os.path.join(self._tmp.name, 'cache', 'responses.sqlite3')
+
+    def test_round_trip_compressed_in_wal_mode(self):
+        """Values should come back intact and be stored zlib-compressed in a WAL database."""
+        cache = SQLiteCache(self.path, max_entries=10, ttl_s=60)
+        answer = '1) Diagnosis\n' + 'Loops repeat code. ' * 200
+        cache.set('k', answer)
+        self.assertEqual(cache.get('k'), answer)
+        self.assertIsNone(cache.get('missing'))
+
+        conn = sqlite3.connect(self.path)
+        self.addCleanup(conn.close)
+        self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        size = conn.execute('SELECT size FROM responses').fetchone()[0]
+        self.assertLess(size, len(answer) // 10)
+        stats = cache.stats()
+        self.assertEqual((stats['size'], stats['bytes'], stats['hits'], stats['misses']), (1, size, 1, 1))
+
+    def test_corrupt_rows_are_dropped_as_misses(self):
+        """Rows that fail to decompress or decode should be deleted and count as misses."""
+        cache = SQLiteCache(self.path, max_entries=10, ttl_s=60)
+        cache.set('truncated', 'answer')
+        cache.set('not_utf8', 'answer')
+        cache.set('not_json', 'answer')
+        conn = sqlite3.connect(self.path)
+        self.addCleanup(conn.close)
+        with conn:
+            blob = conn.execute("SELECT value FROM responses WHERE key = 'truncated'").fetchone()[0]
+            for key, value in (
+                ('truncated', blob[:-4]),
+                ('not_utf8', zlib.compress(b'"\xff"')),
+                ('not_json', zlib.compress(b'{not json')),
+            ):
+                conn.execute('UPDATE responses SET value = ? WHERE key = ?', (value, key))
+
+        for key in ('truncated', 'not_utf8', 'not_json'):
+            self.assertIsNone(cache.get(key))
+        stats = cache.stats()
+        self.assertEqual((stats['size'], stats['misses'], stats['errors']), (0, 3, 3))
+
+    def test_shared_between_instances_and_processes(self):
+        """Workers opening the same file should see each other's entries."""
+        SQLiteCache(self.path, max_entries=10, ttl_s=60).set('k', 'from worker 1')
+        self.assertEqual(SQLiteCache(self.path, max_entries=10, ttl_s=60).get('k'), 'from worker 1')
+
+        script = (
+            'import sys; from persistent_cache import SQLiteCache; '
+            'c = SQLiteCache(sys.argv[1], 10, 60); print(c.get("k")); c.set("k2", "from worker 2")'
+        )
+        out = subprocess.run(
+            [sys.executable, '-c', script, self.path],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        )
+        self.assertEqual(out.stdout.strip(), 'from worker 1')
+        self.assertEqual(SQLiteCache(self.path, max_entries=10, ttl_s=60).get('k2'), 'from worker 2')
+
+    def test_entries_expire(self):
+        """Entries should be missed and removed once their TTL has passed."""
+        cache = SQLiteCache(self.path, max_entries=10, ttl_s=60)
+        with patch('persistent_cache.time.time', return_value=1000.0):
+            cache.set('k', 'v')
+        with patch('persistent_cache.time.time', return_value=1059.0):
+            self.assertEqual(cache.get('k'), 'v')
+        with patch('persistent_cache.time.time', return_value=1061.0):
+            self.assertIsNone(cache.get('k'))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_evicts_least_recently_used(self):
+        """Over max_entries, the least recently used entries should go first."""
+        cache = SQLiteCache(self.path, max_entries=2, ttl_s=600)
+        with patch('persistent_cache.TOUCH_INTERVAL_S', 0), patch('persistent_cache.time.time') as clock:
+            for now, key in enumerate(['a', 'b']):
+                clock.return_value = 1000.0 + now
+                cache.set(key, key)
+            clock.return_value = 1002.0
+            cache.get('a')
+            clock.return_value = 1003.0
+            cache.set('c', 'c')
+            self.assertEqual([cache.get(k) for k in 'abc'], ['a', None, 'c'])
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_evicts_down_to_byte_limit(self):
+        """Compressed bytes over max_bytes should evict the oldest entries."""
+        cache = SQLiteCache(self.path, max_entries=100, ttl_s=600, max_bytes=300)
+        values = {f'k{i}': os.urandom(64).hex() for i in range(5)}  # incompressible
+        with patch('persistent_cache.time.time') as clock:
+            for now, (key, value) in enumerate(values.items()):
+                clock.return_value = 1000.0 + now
+                cache.set(key, value)
+            stats = cache.stats()
+            self.assertLessEqual(stats['bytes'], 300)
+            self.assertEqual(cache.get('k4'), values['k4'])
+            self.assertIsNone(cache.get('k0'))
+        cache.set('huge', os.urandom(400).hex())
+        self.assertIsNone(cache.get('huge'))
+
+    def test_disabled_and_errors_are_misses(self):
+        """A zero-size cache stores nothing, and database errors should be misses, not failures."""
+        disabled = SQLiteCache(self.path, max_entries=0, ttl_s=60)
+        disabled.set('k', 'v')
+        self.assertEqual(len(disabled), 0)
+
+        cache = SQLiteCache(self.path, max_entries=10, ttl_s=60)
+        cache._conn().execute('DROP TABLE responses')
+        cache.set('k', 'v')
+        self.assertIsNone(cache.get('k'))
+        self.assertEqual(cache.stats()['errors'], 3)
+
+    def test_open_response_cache_selects_backend(self):
+        """The sqlite backend should be used when configured, else the in-memory cache."""
+        with patch('persistent_cache.RESPONSE_CACHE_BACKEND', 'sqlite'), \
+                patch('persistent_cache.RESPONSE_CACHE_PATH', self.path):
+            self.assertIsInstance(open_response_cache(), SQLiteCache)
+        with patch('persistent_cache.RESPONSE_CACHE_BACKEND', 'redis'):
+            self.assertIsInstance(open_response_cache(), TTLCache)
+        with patch('persistent_cache.RESPONSE_CACHE_BACKEND', 'sqlite'), \
+                patch('persistent_cache.RESPONSE_CACHE_PATH', os.path.join(self.path, 'x', 'y')):
+            open(self.path, 'w').close()  # a file where a directory is needed
+            self.assertIsInstance(open_response_cache(), TTLCache)
+
+
+class TestFingerprint(unittest.TestCase):
+    """Tests for near-duplicate detection of submissions."""
+
+    PROGRAM = (
+        'def average(values):\n'
+        '    """Return the mean."""\n'
+        '    total = 0\n'
+        '    for v in values:  # add them up\n'
+        '        total += v\n'
+        '    return total / len(values)\n'
+        '\n'
+        'print(average([1, 2, 3]))\n'
+    )
+    # Extra code so a one-value edit leaves the program mostly the same
+    HELPERS = (
+        'def read_scores(lines):\n'
+        '    scores = []\n'
+        '    for line in lines:\n'
+        '        name, score = line.split(",")\n'
+        '        scores.append(int(score))\n'
+        '    return scores\n'
+        '\n'
+        'def best(scores):\n'
+        '    top = scores[0]\n'
+        '    for score in scores:\n'
+        '        if score > top:\n'
+        '            top = score\n'
+        '    return top\n'
+    )
+    RENAMED = (
+        'def mean(nums):\n'
+        '    s=0\n'
+        '    for n in nums: s += n\n'
+        '    return s/len(nums)\n'
+        'print(mean([1,2,3]))\n'
+    )
+
+    def setUp(self):
+        fingerprint.near_index.clear()
+        self.cache = TTLCache(100, 60)
+
+    @staticmethod
+    def _fields(code, question='Why is the result wrong?', level='beginner'):
+        return {'topic': 'loops', 'code': code, 'question': question, 'level': level}
+
+    def test_canonical_form_ignores_names_comments_and_formatting(self):
+        """Renamed, reformatted and commented copies should canonicalize identically."""
+        code, names = fingerprint.canonicalize(self.PROGRAM)
+        self.assertEqual(fingerprint.canonicalize(self.RENAMED)[0], code)
+        self.assertEqual(names, ['average', 'values', 'total', 'v'])
+        self.assertNotIn('Return the mean', code)
+        self.assertIn('len(_v1)', code)  # builtins keep their names
+        self.assertNotEqual(fingerprint.canonicalize(self.PROGRAM.replace('total += v', 'total -= v'))[0], code)
+        self.assertIn('import math', fingerprint.canonicalize('import math\nx = math.pi\n')[0])
+        self.assertIsNone(fingerprint.canonicalize('def f(:\n'))
+
+    def test_code_nested_too_deeply_skips_dedup(self):
+        """Code that parse or unparse cannot handle should get no fingerprint instead of failing."""
+        for code in ('x = ' + '1 + ' * 500 + '1\n', 'x=' + '1+' * 20000 + '1'):
+            with self.subTest(size=len(code)):
+                self.assertIsNone(fingerprint.canonicalize(code))
+                self.assertIsNone(fingerprint.fingerprint_fields(self._fields(code)))
+
+    def test_names_used_as_attributes_are_not_renamed(self):
+        """Defining the method the code calls should not canonicalize like defining another one."""
+        template = (
+            'class Rect:\n'
+            '    def __init__(self, w, h):\n'
+            '        self.w, self.h = w, h\n'
+            '    def {name}(self):\n'
+            '        return 2 * (self.w + self.h)\n'
+            'r = Rect(2, 3)\n'
+            'print(r.perimeter())\n'
+        )
+        buggy = fingerprint.fingerprint_fields(self._fields(template.format(name='area')))
+        fixed = fingerprint.fingerprint_fields(self._fields(template.format(name='perimeter')))
+        self.assertNotEqual(buggy.key, fixed.key)
+        self.assertNotIn('perimeter', fixed.names)
+
+    def test_key_covers_question_and_level(self):
+        """Questions naming the same variable should match; other questions or levels should not."""
+        base = fingerprint.fingerprint_fields(self._fields(self.PROGRAM, 'Why is total wrong?'))
+        same = fingerprint.fingerprint_fields(self._fields(self.RENAMED, 'why is  s wrong'))
+        self.assertEqual(base.key, same.key)
+        self.assertEqual(same.names, ['mean', 'nums', 's', 'n'])
+        other_var = fingerprint.fingerprint_fields(self._fields(self.RENAMED, 'Why is n wrong?'))
+        advanced = fingerprint.fingerprint_fields(self._fields(self.RENAMED, 'why is s wrong', 'advanced'))
+        self.assertNotEqual(base.key, other_var.key)
+        self.assertNotEqual(base.key, advanced.key)
+        self.assertIsNone(fingerprint.fingerprint_fields(self._fields('')))
+        with patch('fingerprint.DEDUP_ENABLED', False):
+            self.assertIsNone(fingerprint.fingerprint_fields(self._fields(self.PROGRAM)))
+
+    def test_translate_answer(self):
+        """Names should be translated in code spans only, and prose mentions should block reuse."""
+        old, new = ['total', 'v'], ['s', 'n']
+        answer = 'Look at `total += v`:\n```python\nfor v in data:\n    total += v.size\n```\nThen check obj.total.'
+        self.assertEqual(
+            fingerprint.translate_answer(answer, old, new),
+            'Look at `s += n`:\n```python\nfor n in data:\n    s += n.size\n```\nThen check obj.total.',
+        )
+        self.assertIsNone(fingerprint.translate_answer('Print total before returning.', old, new))
+        self.assertEqual(fingerprint.translate_answer('Print total.', old, old), 'Print total.')
+        self.assertIsNone(fingerprint.translate_answer('x', old, ['s']))
+
+    @patch('fingerprint.DEDUP_NEAR_MIN_SIMILARITY', 0.9)
+    def test_lookup_equivalent_near_and_miss(self):
+        """Remembered answers should serve equivalent and near-duplicate code, and nothing else."""
+        stored = fingerprint.fingerprint_fields(self._fields(self.HELPERS + self.PROGRAM))
+        fingerprint.remember(stored, 'Trace `total` on paper.', self.cache)
+
+        renamed = fingerprint.fingerprint_fields(self._fields(self.HELPERS + self.RENAMED))
+        self.assertEqual(fingerprint.lookup(renamed, 'r1', self.cache), ('Trace `s` on paper.', 'equivalent'))
+
+        edited = fingerprint.fingerprint_fields(
+            self._fields(self.HELPERS + self.PROGRAM.replace('[1, 2, 3]', '[1, 2, 3, 4]'))
+        )
+        self.assertGreaterEqual(fingerprint.similarity(stored.signature, edited.signature), 0.9)
+        self.assertEqual(fingerprint.lookup(edited, 'r2', self.cache), ('Trace `total` on paper.', 'near'))
+
+        # A near duplicate without the names the answer mentions cannot reuse it
+        edited_renamed = fingerprint.fingerprint_fields(
+            self._fields(self.HELPERS + self.RENAMED.replace('[1,2,3]', '[1,2,3,4]'))
+        )
+        before = metrics.dedup_lookups.value('unsafe')
+        self.assertEqual(fingerprint.lookup(edited_renamed, 'r3', self.cache), (None, None))
+        self.assertEqual(metrics.dedup_lookups.value('unsafe'), before + 1)
+
+        unrelated = fingerprint.fingerprint_fields(self._fields('x = input()\nprint(int(x) * 2)\n'))
+        self.assertEqual(fingerprint.lookup(unrelated, 'r4', self.cache), (None, None))
+        with patch('fingerprint.DEDUP_NEAR_MIN_SIMILARITY', 1.0):
+            self.assertEqual(fingerprint.lookup(edited, 'r5', self.cache), (None, None))
+
+    def test_near_matching_is_off_by_default(self):
+        """Without a similarity threshold only equivalent code should reuse an answer."""
+        stored = fingerprint.fingerprint_fields(self._fields(self.PROGRAM))
+        fingerprint.remember(stored, 'Trace `total` on paper.', self.cache)
+        edited = fingerprint.fingerprint_fields(self._fields(self.PROGRAM.replace('[1, 2, 3]', '[0, 2, 3]')))
+        self.assertEqual(fingerprint.lookup(edited, 'r1', self.cache), (None, None))
+        self.assertEqual(len(fingerprint.near_index), 0)
+
+    @patch('fingerprint.DEDUP_NEAR_MIN_SIMILARITY', 0.9)
+    def test_near_index_is_bounded(self):
+        """The LSH index should forget the oldest fingerprints beyond its capacity."""
+        index = fingerprint.NearDuplicateIndex(max_entries=2)
+        fps = [
+            fingerprint.fingerprint_fields(self._fields(self.PROGRAM.replace('[1, 2, 3]', f'[{i}]')))
+            for i in range(3)
+        ]
+        for fp in fps:
+            index.add(fp)
+        self.assertEqual(len(index), 2)
+        self.assertNotIn(fps[0].key, index.candidates(fps[1]))
+        self.assertIn(fps[2].key, index.candidates(fps[1]))
+
+
+class TestSingleFlight(unittest.TestCase):
+    """Tests for coalescing identical in-flight calls."""
+
+    def _wait_for(self, predicate):
+        deadline = time.monotonic() + 5
+        while not predicate():
+            if time.monotonic() > deadline:
+                self.fail('condition not reached')
+            time.sleep(0.001)
+
+    def test_concurrent_callers_share_one_call(self):
+        """Concurrent callers with the same key should run the function once."""
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def work():
+            calls.append(1)
+            release.wait(5)
+            return 'answer'
+
+        threads = [threading.Thread(target=lambda: results.append(flight.do('k', work))) for _ in range(5)]
+        for t in threads:
+            t.start()
+        self._wait_for(lambda: flight.coalesced == 4)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(r[1] for r in results), [False, True, True, True, True])
+        self.assertTrue(all(r[0] == 'answer' for r in results))
+        self.assertEqual(flight.in_flight(), 0)
+
+    def test_waiters_receive_leader_exception(self):
+        """An exception in the shared call should reach every waiter."""
+        flight = SingleFlight()
+        release = threading.Event()
+        errors = []
+
+        def work():
+            release.wait(5)
+            raise RuntimeError('upstream down')
+
+        def call():
+            try:
+                flight.do('k', work)
+            except RuntimeError as exc:
+                errors.append(str(exc))
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        for t in threads:
+            t.start()
+        self._wait_for(lambda: flight.coalesced == 2)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, ['upstream down'] * 3)
+
+    def test_sequential_calls_are_not_coalesced(self):
+        """Calls that do not overlap should each execute."""
+        flight = SingleFlight()
+        self.assertEqual(flight.do('k', lambda: 1), (1, False))
+        self.assertEqual(flight.do('k', lambda: 2), (2, False))
+
+
+class TestAsyncSingleFlight(unittest.TestCase):
+    """Tests for coalescing identical in-flight coroutines."""
+
+    def test_concurrent_callers_share_one_call(self):
+        """Concurrent awaiters with the same key should run the coroutine once."""
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'answer'
+
+        async def main():
+            return await asyncio.gather(*(flight.do('k', work) for _ in range(5)))
+
+        results = asyncio.run(main())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(r[1] for r in results), [False, True, True, True, True])
+        self.assertEqual(flight.in_flight(), 0)
+
+    def test_waiters_receive_leader_exception(self):
+        """An exception in the shared coroutine should reach every waiter."""
+        flight = AsyncSingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.01)
+            raise RuntimeError('upstream down')
+
+        async def main():
+            return await asyncio.gather(*(flight.do('k', work) for _ in range(3)), return_exceptions=True)
+
+        results = asyncio.run(main())
+        self.assertTrue(all(isinstance(r, RuntimeError) for r in results))
+
+    def test_cancelled_leader_does_not_cancel_waiters(self):
+        """Cancelling the first caller should leave the shared call running for the rest."""
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.02)
+            return 'answer'
+
+        async def main():
+            leader = asyncio.ensure_future(flight.do('k', work))
+            await asyncio.sleep(0)
+            waiters = [asyncio.ensure_future(flight.do('k', work)) for _ in range(3)]
+            await asyncio.sleep(0)
+            leader.cancel()
+            return await asyncio.gather(*waiters), leader.cancelled()
+
+        results, leader_cancelled = asyncio.run(main())
+        self.assertTrue(leader_cancelled)
+        self.assertEqual(results, [('answer', True)] * 3)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.in_flight(), 0)
+
+
+class _FakeClock:
+    """Monotonic clock that only advances when the code under test sleeps."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@patch('gemini_ai.GEMINI_API_KEY', 'test-key')
+class TestGenerateResponseDeadline(unittest.TestCase):
+    """Tests for the deadline-aware retry loop in generate_response()."""
+
+    def setUp(self):
+        upstream_breaker.reset()
+        self.clock = _FakeClock()
+        patches = [
+            patch('gemini_ai.time.monotonic', self.clock.monotonic),
+            patch('gemini_ai.time.sleep', side_effect=self.clock.sleep),
+            patch('gemini_ai._get_http_session'),
+        ]
+        mocks = [p.start() for p in patches]
+        for p in patches:
+            self.addCleanup(p.stop)
+        self.mock_sleep, self.session = mocks[1], mocks[2].return_value
+        self.session.post.return_value = MagicMock(status_code=503, json=MagicMock(return_value={}))
+
+    def test_without_deadline_runs_full_ladder(self):
+        """Without a deadline every retry should be attempted."""
+        text, err = generate_response('prompt', request_id='r1')
+        self.assertIsNone(text)
+        self.assertEqual(self.session.post.call_count, 6)
+        self.assertEqual(err['status'], 503)
+
+    def test_skips_backoff_that_would_overrun(self):
+        """Retries whose backoff would pass the deadline should be skipped."""
+        text, err = generate_response('prompt', request_id='r1', deadline=self.clock.now + 5)
+        self.assertIsNone(text)
+        self.assertTrue(err['deadline_exceeded'])
+        self.assertEqual(err['last_error']['status'], 503)
+        # Attempts at t=0, 1 and 3; the 4 s backoff would end at t=7.
+        self.assertEqual(self.session.post.call_count, 3)
+        self.assertEqual([c.args[0] for c in self.mock_sleep.call_args_list], [1, 2])
+
+    def test_attempt_timeout_shrinks_to_remaining_budget(self):
+        """Each attempt's timeout should not exceed the time left."""
+        self.session.post.return_value = MagicMock(
+            status_code=200,
+            json=MagicMock(return_value={'candidates': [{'content': {'parts': [{'text': 'ok'}]}}]}),
+        )
+        text, err = generate_response('prompt', request_id='r1', deadline=self.clock.now + 3.5)
+        self.assertEqual(text, 'ok')
+        self.assertEqual(self.session.post.call_args.kwargs['timeout'], 3.5)
+
+    def test_open_breaker_fails_fast(self):
+        """Once the breaker opens, the retry ladder should stop immediately."""
+        for _ in range(upstream_breaker.min_calls - 1):
+            upstream_breaker.allow()
+            upstream_breaker.record(FAILURE)
+        text, err = generate_response('prompt', request_id='r1')
+        self.assertIsNone(text)
+        self.assertTrue(err['circuit_open'])
+        self.assertEqual(self.session.post.call_count, 1)
+        self.assertEqual(err['last_error']['status'], 503)
+        self.mock_sleep.assert_called_once_with(1)
+
+    def test_timeout_at_deadline_reports_deadline_exceeded(self):
+        """A timeout that exhausts the budget should return a deadline error."""
+        def timed_out(*args, **kwargs):
+            self.clock.now += kwargs['timeout']
+            raise requests.Timeout()
+
+        self.session.post.side_effect = timed_out
+        text, err = generate_response('prompt', request_id='r1', deadline=self.clock.now + 2)
+        self.assertIsNone(text)
+        self.assertTrue(err['deadline_exceeded'])
+        self.assertEqual(self.session.post.call_count, 1)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """Tests for the CircuitBreaker state machine."""
+
+    def setUp(self):
+        self.clock = _FakeClock()
+        patcher = patch('resilience.time.monotonic', self.clock.monotonic)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(
+            failure_rate=0.5, timeout_rate=0.3, min_calls=4,
+            window_s=10, open_s=5, half_open_probes=2,
+        )
+
+    def _call(self, outcome):
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(outcome)
+
+    def test_stays_closed_below_min_calls(self):
+        """Failures below min_calls should not open the breaker."""
+        for _ in range(3):
+            self._call(FAILURE)
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_opens_on_failure_rate(self):
+        """Reaching the failure rate should open the breaker and reject calls."""
+        for outcome in (SUCCESS, FAILURE, SUCCESS, FAILURE):
+            self._call(outcome)
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.snapshot()['rejected'], 1)
+        self.assertAlmostEqual(self.breaker.retry_after_s(), 5)
+
+    def test_opens_on_timeout_rate(self):
+        """Timeouts should trip the breaker at their own, lower threshold."""
+        for outcome in (SUCCESS, SUCCESS, TIMEOUT, SUCCESS, SUCCESS, SUCCESS, TIMEOUT):
+            self._call(outcome)
+        self.assertEqual(self.breaker.state, 'closed')
+        self._call(TIMEOUT)
+        self.assertEqual(self.breaker.state, 'open')
+
+    def test_old_outcomes_leave_the_window(self):
+        """Outcomes older than window_s should not count."""
+        for _ in range(3):
+            self._call(FAILURE)
+        self.clock.now += 11
+        self._call(FAILURE)
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_half_open_probes_close_breaker(self):
+        """After the cooldown, successful probes should close the breaker."""
+        for _ in range(4):
+            self._call(FAILURE)
+        self.clock.now += 5
+        self.assertEqual(self.breaker.state, 'half_open')
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())  # probe limit reached
+        self.breaker.record(SUCCESS)
+        self.breaker.record(SUCCESS)
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_failed_probe_reopens_breaker(self):
+        """A failed probe should open the breaker again."""
+        for _ in range(4):
+            self._call(FAILURE)
+        self.clock.now += 5
+        self._call(TIMEOUT)
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertEqual(self.breaker.snapshot()['trips'], 2)
+
+
+class TestHedgePolicy(unittest.TestCase):
+    """Tests for the hedging policy."""
+
+    def test_no_delay_until_enough_samples(self):
+        """Hedging should not start before min_samples latencies are known."""
+        policy = HedgePolicy(percentile=90, min_delay_s=0.1, max_ratio=0.5, min_samples=3)
+        policy.record_latency(1.0)
+        self.assertIsNone(policy.hedge_delay())
+        policy.record_latency(2.0)
+        policy.record_latency(3.0)
+        self.assertEqual(policy.hedge_delay(), 3.0)
+
+    def test_delay_uses_percentile_with_floor(self):
+        """The delay should follow the percentile but respect min_delay_s."""
+        policy = HedgePolicy(percentile=50, min_delay_s=0.5, max_ratio=0.5, min_samples=1)
+        for latency in (0.1, 0.2, 0.3, 2.0):
+            policy.record_latency(latency)
+        self.assertEqual(policy.hedge_delay(), 0.5)
+        policy.min_delay_s = 0.0
+        self.assertEqual(policy.hedge_delay(), 0.3)
+
+    def test_budget_caps_extra_load(self):
+        """Hedges should be capped at max_ratio of primary requests."""
+        policy = HedgePolicy(percentile=95, min_delay_s=0, max_ratio=0.25, min_samples=1)
+        for _ in range(4):
+            policy.note_primary()
+        self.assertTrue(policy.try_acquire())
+        self.assertFalse(policy.try_acquire())
+        self.assertEqual(policy.snapshot()['hedge_rate'], 0.25)
+
+    def test_disabled_policy_never_hedges(self):
+        """A disabled policy should never produce a hedge delay."""
+        policy = HedgePolicy(percentile=95, min_delay_s=0, max_ratio=1, min_samples=1, enabled=False)
+        policy.record_latency(0.1)
+        self.assertIsNone(policy.hedge_delay())
+
+
+@patch('gemini_ai.GEMINI_API_KEY', 'test-key')
+class TestHedgedGenerateResponse(unittest.TestCase):
+    """Tests for hedged upstream requests in generate_response()."""
+
+    def setUp(self):
+        upstream_breaker.reset()
+        self.policy = HedgePolicy(percentile=95, min_delay_s=0.05, max_ratio=1.0, min_samples=1)
+        self.policy.record_latency(0.01)
+        patchers = [patch('gemini_ai.upstream_hedging', self.policy), patch('gemini_ai._get_http_session')]
+        mocks = [p.start() for p in patchers]
+        for p in patchers:
+            self.addCleanup(p.stop)
+        self.session = mocks[1].return_value
+
+    @staticmethod
+    def _ok(text):
+        return MagicMock(status_code=200, json=MagicMock(
+            return_value={'candidates': [{'content': {'parts': [{'text': text}]}}]}))
+
+    def test_hedge_wins_when_primary_is_slow(self):
+        """A slow primary should be raced by a hedge whose answer is used."""
+        calls = []
+        lock = threading.Lock()
+
+        def post(*args, **kwargs):
+            with lock:
+                calls.append(1)
+                first = len(calls) == 1
+            if first:
+                time.sleep(0.5)
+                return self._ok('slow')
+            return self._ok('fast')
+
+        self.session.post.side_effect = post
+        text, err = generate_response('prompt', request_id='r1')
+        self.assertEqual(text, 'fast')
+        self.assertEqual(len(calls), 2)
+        stats = self.policy.snapshot()
+        self.assertEqual((stats['hedges'], stats['hedge_wins']), (1, 1))
+
+    def test_no_hedge_when_primary_is_fast(self):
+        """A primary that answers within the delay should not be hedged."""
+        self.session.post.return_value = self._ok('quick')
+        text, err = generate_response('prompt', request_id='r1')
+        self.assertEqual(text, 'quick')
+        self.assertEqual(self.session.post.call_count, 1)
+        self.assertEqual(self.policy.snapshot()['hedges'], 0)
+
+    def test_budget_exhausted_skips_hedge(self):
+        """No hedge should be sent once the budget is used up."""
+        self.policy.max_ratio = 0.0
+
+        def post(*args, **kwargs):
+            time.sleep(0.1)
+            return self._ok('primary')
+
+        self.session.post.side_effect = post
+        text, err = generate_response('prompt', request_id='r1')
+        self.assertEqual(text, 'primary')
+        self.assertEqual(self.session.post.call_count, 1)
+
+
+@patch('gemini_ai.GEMINI_API_KEY', 'test-key')
+class TestHedgeAbortsPrimary(unittest.TestCase):
+    """Tests that a winning hedge cuts off the primary's connection."""
+
+    def test_winning_hedge_returns_before_slow_primary(self):
+        """The hedge's answer should be returned without waiting for a hung primary."""
+        body = json.dumps({'candidates': [{'content': {'parts': [{'text': 'fast'}]}}]}).encode()
+        calls = []
+        lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                with lock:
+                    calls.append(1)
+                    first = len(calls) == 1
+                if first:
+                    time.sleep(3)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        server.daemon_threads = True
+        server.handle_error = lambda request, address: None  # the aborted primary's broken pipe
+        threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        upstream_breaker.reset()
+        policy = HedgePolicy(percentile=95, min_delay_s=0.05, max_ratio=1.0, min_samples=1)
+        policy.record_latency(0.01)
+        with patch('gemini_ai.upstream_hedging', policy), \
+                patch('gemini_ai.GEMINI_BASE_URL', f'http://127.0.0.1:{server.server_address[1]}'):
+            t0 = time.monotonic()
+            text, err = generate_response('prompt', request_id='r1')
+            elapsed = time.monotonic() - t0
+        self.assertEqual(text, 'fast')
+        self.assertLess(elapsed, 1.5)
+        self.assertEqual(policy.snapshot()['hedge_wins'], 1)
+
+
+class TestAdmissionController(unittest.TestCase):
+    """Tests for upstream admission control."""
+
+    def test_admits_up_to_limit_then_sheds_when_queue_full(self):
+        """Calls beyond the concurrency limit and queue size should be shed immediately."""
+        ctl = AdmissionController(max_concurrent=2, max_queue=0, max_wait_s=1)
+        self.assertTrue(ctl.acquire())
+        self.assertTrue(ctl.acquire())
+        self.assertFalse(ctl.acquire())
+        ctl.release()
+        self.assertTrue(ctl.acquire())
+        stats = ctl.snapshot()
+        self.assertEqual((stats['in_flight'], stats['admitted'], stats['shed_queue_full']), (2, 3, 1))
+
+    def test_queued_call_is_admitted_on_release(self):
+        """A waiting call should get the slot when a running call finishes."""
+        ctl = AdmissionController(max_concurrent=1, max_queue=1, max_wait_s=5)
+        self.assertTrue(ctl.acquire())
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(ctl.acquire()))
+        waiter.start()
+        for _ in range(100):
+            if ctl.snapshot()['queue_depth'] == 1:
+                break
+            time.sleep(0.01)
+        self.assertFalse(ctl.acquire())  # queue already full
+        ctl.release()
+        waiter.join(timeout=2)
+        self.assertEqual(results, [True])
+        stats = ctl.snapshot()
+        self.assertEqual((stats['queued'], stats['queue_depth'], stats['in_flight']), (1, 0, 1))
+
+    def test_queue_wait_times_out(self):
+        """A call that waits longer than max_wait_s should be shed."""
+        ctl = AdmissionController(max_concurrent=1, max_queue=5, max_wait_s=0.05)
+        self.assertTrue(ctl.acquire())
+        self.assertFalse(ctl.acquire())
+        stats = ctl.snapshot()
+        self.assertEqual(stats['shed_timeout'], 1)
+        self.assertGreaterEqual(stats['queue_wait_max_ms'], 40)
+
+    def test_deadline_shortens_wait(self):
+        """A request deadline earlier than max_wait_s should cut the wait short."""
+        ctl = AdmissionController(max_concurrent=1, max_queue=5, max_wait_s=10)
+        self.assertTrue(ctl.acquire())
+        start = time.monotonic()
+        self.assertFalse(ctl.acquire(deadline=start + 0.05))
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_disabled_controller_admits_everything(self):
+        """A max_concurrent of 0 should disable admission control."""
+        ctl = AdmissionController(max_concurrent=0, max_queue=0, max_wait_s=0)
+        for _ in range(5):
+            self.assertTrue(ctl.acquire())
+
+
+class TestRateLimiter(unittest.TestCase):
+    """Tests for the token-bucket rate limiter."""
+
+    def setUp(self):
+        self.clock = _FakeClock()
+        patcher = patch('ratelimit.time.monotonic', self.clock.monotonic)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_client_burst_then_refill(self):
+        """A client may burst, is then limited, and recovers at the refill rate."""
+        limiter = RateLimiter(client_rate_per_s=0.5, client_burst=2, global_rate_per_s=0, global_burst=1)
+        self.assertEqual(limiter.acquire('a'), 0.0)
+        self.assertEqual(limiter.acquire('a'), 0.0)
+        self.assertAlmostEqual(limiter.acquire('a'), 2.0)
+        self.assertEqual(limiter.acquire('b'), 0.0)
+        self.clock.sleep(2.0)
+        self.assertEqual(limiter.acquire('a'), 0.0)
+
+    def test_global_bucket_limits_all_clients(self):
+        """The global bucket should cap the total across clients."""
+        limiter = RateLimiter(client_rate_per_s=100, client_burst=100, global_rate_per_s=1, global_burst=2)
+        self.assertEqual(limiter.acquire('a'), 0.0)
+        self.assertEqual(limiter.acquire('b'), 0.0)
+        self.assertGreater(limiter.acquire('c'), 0.0)
+        stats = limiter.snapshot()
+        self.assertEqual((stats['allowed'], stats['limited_global']), (2, 1))
+
+    def test_rejected_request_takes_no_client_token(self):
+        """A globally limited request should not drain the client's bucket."""
+        limiter = RateLimiter(client_rate_per_s=0.001, client_burst=2, global_rate_per_s=1, global_burst=1)
+        self.assertEqual(limiter.acquire('a'), 0.0)
+        self.assertGreater(limiter.acquire('a'), 0.0)
+        self.clock.sleep(1.0)
+        self.assertEqual(limiter.acquire('a'), 0.0)
+
+    def test_client_map_is_bounded(self):
+        """Idle client buckets should be evicted beyond max_clients."""
+        limiter = RateLimiter(client_rate_per_s=1, client_burst=1, global_rate_per_s=0, global_burst=1, max_clients=2)
+        for client in ('a', 'b', 'c'):
+            limiter.acquire(client)
+        self.assertEqual(limiter.snapshot()['clients'], 2)
+
+    def test_acquire_many_takes_what_both_buckets_allow(self):
+        """A multi-token acquire should be capped by the emptier bucket."""
+        limiter = RateLimiter(client_rate_per_s=1, client_burst=5, global_rate_per_s=1, global_burst=3)
+        granted, wait = limiter.acquire_many('a', 4)
+        self.assertEqual(granted, 3)
+        self.assertGreater(wait, 0)
+        self.assertEqual(limiter.acquire_many('a', 2)[0], 0)
+        stats = limiter.snapshot()
+        self.assertEqual((stats['allowed'], stats['limited_global']), (3, 3))
+
+    def test_disabled_limiter_admits_everything(self):
+        """A disabled limiter should never limit."""
+        limiter = RateLimiter(client_rate_per_s=0.001, client_burst=1, global_rate_per_s=0.001, global_burst=1, enabled=False)
+        for _ in range(5):
+            self.assertEqual(limiter.acquire('a'), 0.0)
+
+    def test_client_identity(self):
+        """Known API keys take precedence; X-Forwarded-For is only used when trusted."""
+        self.assertEqual(client_identity('k1', '1.1.1.1', '2.2.2.2', True, {'k1'}), 'key:k1')
+        self.assertEqual(client_identity('k2', '1.1.1.1', '2.2.2.2', False, {'k1'}), 'ip:2.2.2.2')
+        self.assertEqual(client_identity(None, '1.1.1.1', '2.2.2.2', True), 'ip:1.1.1.1')
+        self.assertEqual(client_identity(None, '1.1.1.1', '2.2.2.2', False), 'ip:2.2.2.2')
+
+    def test_client_identity_ignores_spoofed_forwarded_for(self):
+        """Entries a client writes before the ones trusted proxies append should not change its identity."""
+        # The proxy appends the real peer 3.3.3.3 to whatever the client sent
+        for header in ('1.1.1.1, 3.3.3.3', '9.9.9.9, 1.1.1.1, 3.3.3.3', ', 3.3.3.3'):
+            with self.subTest(header=header):
+                self.assertEqual(client_identity(None, header, '10.0.0.1', True), 'ip:3.3.3.3')
+        # Two proxies: the outer one appends the client, the inner one the outer proxy
+        two_hops = client_identity(None, '1.1.1.1, 3.3.3.3, 10.0.0.2', '10.0.0.1', True, proxy_hops=2)
+        self.assertEqual(two_hops, 'ip:3.3.3.3')
+        # Fewer entries than trusted hops: fall back to the peer address
+        self.assertEqual(client_identity(None, '3.3.3.3', '10.0.0.1', True, proxy_hops=2), 'ip:10.0.0.1')
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests for the metrics registry and the /metrics endpoint."""
+
+    def setUp(self):
+        app.testing = True
+        self.client = app.test_client()
+        metrics.registry.reset()
+        upstream_breaker.reset()
+        self.addCleanup(metrics.registry.reset)
+
+    def test_histogram_renders_cumulative_buckets(self):
+        """Buckets should be cumulative and end with +Inf, _sum and _count."""
+        hist = metrics.Histogram('demo_seconds', 'Demo.', buckets=(1, 5), labelnames=('route',))
+        for value in (0.5, 1, 3, 10):
+            hist.observe(value, '/x')
+        lines = hist.render()
+        self.assertIn('demo_seconds_bucket{route="/x",le="1"} 2', lines)
+        self.assertIn('demo_seconds_bucket{route="/x",le="5"} 3', lines)
+        self.assertIn('demo_seconds_bucket{route="/x",le="+Inf"} 4', lines)
+        self.assertIn('demo_seconds_sum{route="/x"} 14.5', lines)
+        self.assertIn('demo_seconds_count{route="/x"} 4', lines)
+
+    def test_counter_escapes_label_values(self):
+        """Label values should be escaped for the text format."""
+        counter = metrics.Counter('demo_total', 'Demo.', ('name',))
+        counter.inc('a"b')
+        counter.inc('a"b', amount=2)
+        self.assertIn('demo_total{name="a\\"b"} 3', counter.render())
+
+    def test_metrics_endpoint_reports_requests(self):
+        """Requests should be counted by route and status code."""
+        self.client.get('/health')
+        self.client.post('/ask-ai', data='not json')
+        response = self.client.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+        body = response.get_data(as_text=True)
+        self.assertIn('tutor_http_requests_total{route="/health",status="200"} 1', body)
+        self.assertIn('tutor_http_requests_total{route="/ask-ai",status="400"} 1', body)
+        self.assertIn('tutor_http_request_duration_seconds_count{route="/ask-ai",status="400"} 1', body)
+
+    @patch('app.generate_response')
+    def test_metrics_endpoint_reports_admission_and_breaker(self, mock_generate):
+        """Queue depth, slot wait time and breaker state should be exported."""
+        mock_generate.return_value = ('answer', None)
+        rate_limiter.reset()
+        response_cache.clear()
+        fingerprint.answer_cache.clear()
+        ctl = AdmissionController(max_concurrent=2, max_queue=4, max_wait_s=1)
+        with patch('app.admission', ctl):
+            self.client.post('/ask-ai', json={'question': 'What does zip() return?'})
+            self.assertTrue(ctl.acquire())
+            body = self.client.get('/metrics').get_data(as_text=True)
+            ctl.release()
+
+        self.assertIn('# TYPE tutor_admission_queue_depth gauge', body)
+        self.assertIn('tutor_admission_queue_depth 0', body)
+        self.assertIn('tutor_admission_in_flight 1', body)
+        self.assertIn('tutor_admission_wait_seconds_count{outcome="admitted"} 1', body)
+        self.assertIn('tutor_upstream_breaker_state{state="closed"} 1', body)
+        self.assertIn('tutor_upstream_breaker_state{state="open"} 0', body)
+
+    def test_metrics_endpoint_can_be_disabled(self):
+        """The endpoint should 404 when METRICS_ENABLED is off."""
+        with patch('app.METRICS_ENABLED', False):
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+    @patch('app.generate_response')
+    def test_prompt_and_code_sizes_are_observed(self, mock_generate):
+        """Prompt and code sizes should be recorded for each tutoring request."""
+        mock_generate.return_value = ('answer', None)
+        rate_limiter.reset()
+        response_cache.clear()
+        fingerprint.answer_cache.clear()
+        self.client.post('/ask-ai', json={'question': 'q', 'code': 'x = 1'})
+        self.assertEqual(metrics.prompt_chars.count(), 1)
+        self.assertEqual(metrics.code_chars.count(), 1)
+
+    @patch('gemini_ai.GEMINI_API_KEY', 'test-key')
+    @patch('gemini_ai.time.sleep')
+    @patch('gemini_ai._get_http_session')
+    def test_upstream_attempts_and_retries(self, mock_session, mock_sleep):
+        """Retries should be counted by the failed status and attempts observed per call."""
+        ok = MagicMock(status_code=200, json=MagicMock(
+            return_value={'candidates': [{'content': {'parts': [{'text': 'hi'}]}}]}))
+        mock_session.return_value.post.side_effect = [
+            MagicMock(status_code=503, text='busy'),
+            requests.Timeout(),
+            ok,
+        ]
+        text, err = generate_response('prompt', request_id='m1')
+
+        self.assertEqual(text, 'hi')
+        self.assertEqual(metrics.upstream_retries.value('503'), 1)
+        self.assertEqual(metrics.upstream_retries.value('timeout'), 1)
+        self.assertIn('tutor_upstream_attempts_bucket{le="2"} 0', metrics.upstream_attempts.render())
+        self.assertIn('tutor_upstream_attempts_bucket{le="3"} 1', metrics.upstream_attempts.render())
+        self.assertEqual(metrics.upstream_seconds.count(), 1)
+
+    def test_sanitizer_actions_are_counted(self):
+        """Omitted code blocks and truncations should be counted."""
+        sanitize_tutor_output('plain answer')
+        sanitize_tutor_output('```python\n' + 'x = 1\n' * 20 + '```')
+        sanitize_tutor_output('\n'.join(['import os'] * 20))
+        self.assertEqual(metrics.sanitizer_seconds.count(), 3)
+        self.assertEqual(metrics.sanitizer_actions.value('code_omitted'), 1)
+        self.assertEqual(metrics.sanitizer_actions.value('truncated'), 1)
+
+
+class TestServerTiming(unittest.TestCase):
+    """Tests for the Server-Timing header."""
+
+    def setUp(self):
+        app.testing = True
+        self.client = app.test_client()
+        response_cache.clear()
+        fingerprint.answer_cache.clear()
+        rate_limiter.reset()
+        upstream_breaker.reset()
+
+    def test_header_format(self):
+        """Stages should render as name;dur=ms with an optional quoted desc and a total."""
+        recorder = server_timing.ServerTiming()
+        recorder.add('parse', 0.0012)
+        recorder.add('upstream-1', 1.5, desc='503 "busy"')
+        value = recorder.header_value()
+        self.assertTrue(value.startswith('parse;dur=1.2, upstream-1;dur=1500.0;desc="503 \\"busy\\"", total;dur='))
+
+    def test_record_without_recorder_is_noop(self):
+        """Recording outside an active request should do nothing."""
+        server_timing.record('upstream-1', 1.0)
+        with server_timing.stage('parse'):
+            pass
+
+    def test_header_absent_when_disabled(self):
+        """No header should be sent unless SERVER_TIMING_ENABLED is set."""
+        with patch('app.SERVER_TIMING_ENABLED', False):
+            response = self.client.get('/health')
+        self.assertNotIn('Server-Timing', response.headers)
+
+    @patch('gemini_ai.GEMINI_API_KEY', 'test-key')
+    @patch('gemini_ai.time.sleep')
+    @patch('gemini_ai._get_http_session')
+    def test_ask_ai_reports_stage_breakdown(self, mock_session, mock_sleep):
+        """Parse, local answers, prompt, each attempt, backoff and sanitize should be reported."""
+        ok = MagicMock(status_code=200, json=MagicMock(
+            return_value={'candidates': [{'content': {'parts': [{'text': 'hint'}]}}]}))
+        mock_session.return_value.post.side_effect = [MagicMock(status_code=503, text='busy'), ok]
+
+        with patch('app.SERVER_TIMING_ENABLED', True):
+            response = self.client.post('/ask-ai', json={'question': 'timing?'})
+
+        self.assertEqual(response.status_code, 200)
+        names = [part.split(';')[0] for part in response.headers['Server-Timing'].split(', ')]
+        self.assertEqual(
+            names,
+            ['parse', 'local', 'prompt', 'fingerprint', 'queue', 'upstream-1', 'backoff-1', 'upstream-2', 'sanitize', 'total'],
+        )
+
+
+class TestGeminiStub(unittest.TestCase):
+    """Tests for the local Gemini stub used in load tests."""
+
+    def _start(self, **config):
+        server, base_url = start_in_thread(StubConfig(seed=1, **config))
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        patchers = [
+            patch('gemini_ai.GEMINI_BASE_URL', base_url),
+            patch('gemini_ai.GEMINI_API_KEY', 'stub-key'),
+            patch('gemini_ai.RETRY_DELAYS_S', [0]),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+        upstream_breaker.reset()
+        self.addCleanup(upstream_breaker.reset)
+        return server
+
+    def test_generate_response_against_stub(self):
+        """generate_response() should get a tutor answer from the stub."""
+        server = self._start(output_tokens=20)
+        text, err = generate_response('prompt', request_id='s1')
+        self.assertIsNone(err)
+        self.assertTrue(text.startswith("1) What's going wrong"))
+        self.assertEqual(server.state.snapshot(), {'requests': 1, 'with_system_instruction': 1, 'ok': 1})
+
+    def test_injected_503_is_retried(self):
+        """Injected 503s should be retried and then reported."""
+        server = self._start(rate_503=1.0)
+        text, err = generate_response('prompt', request_id='s2')
+        self.assertIsNone(text)
+        self.assertEqual(err['status'], 503)
+        self.assertEqual(server.state.snapshot(), {'requests': 2, 'with_system_instruction': 2, '503': 2})
+
+    def test_malformed_payload_is_an_error(self):
+        """A truncated JSON body should surface as a failure, not an exception."""
+        self._start(rate_malformed=1.0)
+        text, err = generate_response('prompt', request_id='s3')
+        self.assertIsNone(text)
+        self.assertIsNotNone(err)
+
+    def test_stream_response_against_stub(self):
+        """The streaming endpoint should deliver the answer in several SSE events."""
+        self._start(output_tokens=40)
+        chunks, err = stream_response('prompt', request_id='s4')
+        self.assertIsNone(err)
+        parts = list(chunks)
+        self.assertGreater(len(parts), 1)
+        self.assertEqual(len(''.join(parts).split(' ')), 40)
+
+    def test_context_cache_against_stub(self):
+        """With context caching on, calls should reference the cached content instead of the instructions."""
+        server = self._start(output_tokens=20)
+        self.addCleanup(tutor_context.reset)
+        with patch.object(tutor_context, 'enabled', True):
+            for i in range(2):
+                text, err = generate_response('prompt', request_id=f'c{i}')
+                self.assertIsNone(err)
+            self.assertEqual(tutor_context.snapshot()['created'], 1)
+            self.assertEqual(server.state.snapshot()['cached_contents_created'], 1)
+            self.assertEqual(server.state.snapshot()['with_cached_content'], 2)
+            self.assertNotIn('with_system_instruction', server.state.snapshot())
+
+    def test_expired_context_cache_falls_back_inline(self):
+        """A 404 for the cached content should invalidate it and retry with inline instructions."""
+        server = self._start(output_tokens=20)
+        self.addCleanup(tutor_context.reset)
+        with patch.object(tutor_context, 'enabled', True):
+            self.assertIsNotNone(tutor_context.name())
+            server.state.cached_contents.clear()  # expired upstream
+            text, err = generate_response('prompt', request_id='c3')
+        self.assertIsNone(err)
+        self.assertTrue(text.startswith("1) What's going wrong"))
+        stats = server.state.snapshot()
+        self.assertEqual(stats['cached_content_missing'], 1)
+        self.assertEqual(stats['with_system_instruction'], 1)
+        self.assertEqual(tutor_context.snapshot()['invalidations'], 1)
+
+    def test_expired_context_cache_retry_is_not_a_retry_slot(self):
+        """The inline rebuild should run even when no retries are configured."""
+        server = self._start(output_tokens=20)
+        self.addCleanup(tutor_context.reset)
+        with patch.object(tutor_context, 'enabled', True), patch('gemini_ai.RETRY_DELAYS_S', []):
+            self.assertIsNotNone(tutor_context.name())
+            server.state.cached_contents.clear()
+            text, err = generate_response('prompt', request_id='c4')
+        self.assertIsNone(err)
+        self.assertEqual(server.state.snapshot()['with_system_instruction'], 1)
+
+    def test_prompt_error_keeps_context_cache(self):
+        """A 400 that does not name the cached content should not invalidate it."""
+        self._start(output_tokens=20)
+        self.addCleanup(tutor_context.reset)
+        bad_request = MagicMock(status_code=400, json=MagicMock(
+            return_value={'error': {'code': 400, 'message': 'Request contains an invalid argument.'}}))
+        with patch.object(tutor_context, 'enabled', True), \
+                patch('gemini_ai._post_generate', return_value=bad_request) as post:
+            name = tutor_context.name()
+            text, err = generate_response('prompt', request_id='c5')
+            self.assertEqual(tutor_context.name(create=False), name)
+        self.assertIsNone(text)
+        self.assertEqual(err['status'], 400)
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(tutor_context.snapshot()['invalidations'], 0)
+
+    def test_parse_latency(self):
+        """Latency specs are in milliseconds; bad specs are rejected."""
+        rng = random.Random(0)
+        self.assertEqual(parse_latency('const:250')(rng), 0.25)
+        self.assertTrue(0.1 <= parse_latency('uniform:100,200')(rng) <= 0.2)
+        self.assertGreater(parse_latency('lognormal:400,0.5')(rng), 0)
+        with self.assertRaises(ValueError):
+            parse_latency('gamma:1')
+
+
+class TestLoadTestReport(unittest.TestCase):
+    """Tests for the load-test harness helpers."""
+
+    def test_percentile_nearest_rank(self):
+        """Percentiles should use the nearest-rank method."""
+        values = [float(v) for v in range(1, 101)]
+        self.assertEqual(percentile(values, 50), 50.0)
+        self.assertEqual(percentile(values, 95), 95.0)
+        self.assertEqual(percentile(values, 99), 99.0)
+        self.assertEqual(percentile([7.0], 99), 7.0)
+        self.assertIsNone(percentile([], 50))
+
+    def test_payload_mix_is_valid_and_unique(self):
+        """Generated bodies should pass validation limits and never repeat."""
+        rng = random.Random(3)
+        bodies = [make_ask_body(rng, seq)[1] for seq in range(200)]
+        self.assertEqual(len({b['question'] for b in bodies}), 200)
+        self.assertGreater(max(len(b['code']) for b in bodies), 79_000)
+        self.assertLessEqual(max(len(b['code']) for b in bodies), 80_000)
+        for body in bodies:
+            ast.parse(body['code'])
+        self.assertEqual({b['level'] for b in bodies}, {'beginner', 'intermediate', 'advanced'})
+
+    def test_report_counts_errors_and_attempts(self):
+        """The report should give rates, status counts and attempts per request."""
+        recorder = Recorder()
+        recorder.add('/ask-ai', 'small_question', 200, 0.1)
+        recorder.add('/ask-ai', 'small_question', 502, 0.3)
+        recorder.add('/health', 'health', 200, 0.001)
+        report = build_report(recorder, 2.0, {}, {'requests': 3, 'ok': 2, '503': 1})
+
+        ask = report['endpoints']['/ask-ai']
+        self.assertEqual((ask['requests'], ask['rps'], ask['error_rate']), (2, 1.0, 0.5))
+        self.assertEqual(ask['status_counts'], {'200': 1, '502': 1})
+        self.assertEqual(ask['latency_ms']['p99'], 300.0)
+        self.assertEqual(report['upstream']['attempts_per_request'], 1.5)
+        self.assertEqual(report['upstream']['outcomes'], {'ok': 2, '503': 1})
+        json.dumps(report)
+
+
+class TestMicrobenchmarkCompare(unittest.TestCase):
+    """Tests for comparing microbenchmark runs."""
+
+    def test_flags_only_cases_beyond_ratio(self):
+        """Cases slower than the allowed ratio should be reported; new cases are not."""
+        baseline = {'a': {'min_us': 10.0}, 'b': {'min_us': 10.0}}
+        results = {'a': {'min_us': 12.0}, 'b': {'min_us': 15.0}, 'c': {'min_us': 1.0}}
+        with patch('sys.stdout'):
+            regressed = compare_benchmarks(results, baseline, max_ratio=1.3)
+        self.assertEqual(regressed, ['b'])
+
+
+class TestResolveDeadline(unittest.TestCase):
+    """Tests for per-request deadline resolution."""
+
+    @patch('validation.REQUEST_DEADLINE_S', 25.0)
+    def test_header_can_only_tighten_budget(self):
+        """X-Deadline-Ms should shorten but never extend the configured budget."""
+        with patch('validation.time.monotonic', return_value=100.0):
+            self.assertEqual(resolve_deadline(None), 125.0)
+            self.assertEqual(resolve_deadline('5000'), 105.0)
+            self.assertEqual(resolve_deadline('60000'), 125.0)
+            self.assertEqual(resolve_deadline('garbage'), 125.0)
+            self.assertEqual(resolve_deadline('-1'), 125.0)
+
+    @patch('validation.REQUEST_DEADLINE_S', 0.0)
+    def test_zero_config_disables_default_budget(self):
+        """With no configured budget only the header applies."""
+        with patch('validation.time.monotonic', return_value=100.0):
+            self.assertIsNone(resolve_deadline(None))
+            self.assertEqual(resolve_deadline('2000'), 102.0)
+
+
+class TestAsgiApp(unittest.TestCase):
+    """Tests for the async ASGI entry point."""
+
+    def setUp(self):
+        """Set up test client."""
+        self.client = TestClient(asgi_app.app)
+        asgi_app.response_cache.clear()
+        fingerprint.answer_cache.clear()
+
+    def test_health_returns_ok(self):
+        """Health endpoint should return status ok."""
+        response = self.client.get('/health')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'ok')
+
+    def test_ask_ai_requires_json(self):
+        """Should return 400 when Content-Type is not JSON."""
+        response = self.client.post('/ask-ai', content='not json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Content-Type', response.json()['error'])
+
+    def test_ask_ai_validates_fields(self):
+        """Should apply the same field validation as the Flask app."""
+        response = self.client.post('/ask-ai', json={'topic': 'test'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/ask-ai', json={'question': 'q', 'code': 'x' * 100000})
+        self.assertEqual(response.status_code, 413)
+
+    @patch('asgi_app.generate_response_async', new_callable=AsyncMock)
+    def test_ask_ai_answers_syntax_errors_locally(self, mock_generate):
+        """Code that does not parse should be answered without calling Gemini."""
+        response = self.client.post('/ask-ai', json={'question': 'q', 'code': 'def f():\nreturn 1\n'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Answer-Source'], 'syntax-check')
+        self.assertIn('IndentationError', response.json()['answer'])
+        mock_generate.assert_not_called()
+
+    @patch('asgi_app.generate_response_async', new_callable=AsyncMock)
+    def test_ask_ai_returns_answer_and_caches(self, mock_generate):
+        """Should return the answer and serve repeats from the cache."""
+        mock_generate.return_value = ('This is the tutor response', None)
+        first = self.client.post('/ask-ai', json={'question': 'How do I reverse a list?'})
+        second = self.client.post('/ask-ai', json={'question': 'How do I reverse a list?'})
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json()['answer'], 'This is the tutor response')
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(mock_generate.await_count, 1)
+
+    @patch('asgi_app.generate_response_async', new_callable=AsyncMock)
+    def test_ask_ai_handles_api_error(self, mock_generate):
+        """Should return 502 when the AI API fails."""
+        mock_generate.return_value = (None, {'message': 'API key invalid'})
+        response = self.client.post('/ask-ai', json={'question': 'test question'})
+        self.assertEqual(response.status_code, 502)
+        self.assertIn('AI provider error', response.json()['error'])
+
+
+class TestGenerateResponseAsync(unittest.TestCase):
+    """Tests for the coroutine version of generate_response()."""
+
+    def setUp(self):
+        upstream_breaker.reset()
+
+    def _run_with_transport(self, handler):
+        async def main():
+            gemini_ai_async._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            try:
+                return await gemini_ai_async.generate_response_async('prompt', request_id='r1')
+            finally:
+                await gemini_ai_async.close_async_client()
+        return asyncio.run(main())
+
+    @patch('gemini_ai_async.GEMINI_API_KEY', 'test-key')
+    @patch('gemini_ai_async.asyncio.sleep', new_callable=AsyncMock)
+    def test_retries_transient_errors(self, mock_sleep):
+        """Should back off with asyncio.sleep and retry on 503."""
+        statuses = iter([503, 200])
+
+        def handler(request):
+            status = next(statuses)
+            if status != 200:
+                return httpx.Response(status, json={'error': 'busy'})
+            return httpx.Response(200, json={'candidates': [{'content': {'parts': [{'text': 'ok'}]}}]})
+
+        text, err = self._run_with_transport(handler)
+        self.assertEqual(text, 'ok')
+        self.assertIsNone(err)
+        mock_sleep.assert_awaited_once_with(1)
+
+    @patch('gemini_ai_async.GEMINI_API_KEY', 'test-key')
+    def test_returns_error_on_client_error(self):
+        """Should stop on non-retryable statuses and return the error."""
+        text, err = self._run_with_transport(lambda request: httpx.Response(400, json={'error': 'bad'}))
+        self.assertIsNone(text)
+        self.assertEqual(err['status'], 400)
+
+
 class TestBuildTutorPrompt(unittest.TestCase):
     """Tests for the build_tutor_prompt function."""
 
@@ -148,6 +2099,393 @@ class TestBuildTutorPrompt(unittest.TestCase):
         self.assertIn('What is a variable?', prompt)
 
 
+    def test_prompt_leaves_rules_to_system_instruction(self):
+        """The static tutor rules should travel as systemInstruction, not in the prompt."""
+        prompt = build_tutor_prompt('loops', 'x = 1', 'Why?', 'beginner')
+        self.assertNotIn('STRICT TUTOR MODE', prompt)
+        payload = _build_payload(prompt)
+        self.assertEqual(payload['systemInstruction']['parts'][0]['text'], TUTOR_SYSTEM_INSTRUCTION)
+        self.assertNotIn('cachedContent', payload)
+
+    def test_payload_references_cached_content(self):
+        """With a cached-content name the instructions should not be sent inline."""
+        payload = _build_payload('prompt', cached_content='cachedContents/abc')
+        self.assertEqual(payload['cachedContent'], 'cachedContents/abc')
+        self.assertNotIn('systemInstruction', payload)
+
+
+class TestCodeCompaction(unittest.TestCase):
+    """Tests for compact_code()."""
+
+    def test_small_clean_code_is_unchanged(self):
+        """Code that is already tidy and within budget should pass through."""
+        code = 'x = 1\nprint(x)\n'
+        result = compact_code(code, 'why?', budget_tokens=100)
+        self.assertFalse(result.changed)
+        self.assertEqual(result.code, code)
+        self.assertEqual(result.chars_removed, 0)
+
+    def test_whitespace_is_normalized(self):
+        """Trailing whitespace and trailing blank lines should be removed; inner blank lines kept."""
+        result = compact_code('\nx = 1   \n\n\n\n\ny = 2\t\n\n', budget_tokens=0)
+        self.assertEqual(result.code, '\nx = 1\n\n\n\n\ny = 2')
+        self.assertEqual(result.steps, ['whitespace'])
+
+    def test_line_numbers_are_kept_under_budget(self):
+        """PEP 8 spacing and stripped comments should not move any line."""
+        code = (
+            '# area helpers  \n'
+            'def area(r):\n'
+            '    """Area.\n\n    Of a circle.\n    """\n'
+            '    return 3.14 * r * r\n'
+            '\n\n'
+            'def main():\n'
+            '    print(area(2), area(3))\n'
+            '\n\n'
+            'main()\n'
+        )
+        result = compact_code(code, 'Why is line 11 wrong?', budget_tokens=1000, strip_comments=True)
+        self.assertEqual(result.steps, ['whitespace', 'comments'])
+        lines = result.code.splitlines()
+        self.assertEqual(len(lines), len(code.splitlines()))
+        self.assertEqual(lines[10], '    print(area(2), area(3))')
+        self.assertEqual(lines[13], 'main()')
+
+    def test_comments_and_docstrings_are_collapsed(self):
+        """With strip_comments, comments go and docstrings shrink to one line."""
+        code = (
+            'def f(x):\n'
+            '    """Add one.\n\n    Long explanation.\n    """\n'
+            '    # full-line comment\n'
+            '    return x + 1  # inline\n'
+            "s = '# not a comment'\n"
+        )
+        result = compact_code(code, strip_comments=True)
+        self.assertEqual(
+            result.code,
+            'def f(x):\n    """..."""\n\n\n\n\n    return x + 1\ns = \'# not a comment\'',
+        )
+        self.assertIn('comments', result.steps)
+
+    def test_untokenizable_code_keeps_comments(self):
+        """Code with an unterminated string should not be mangled."""
+        code = 'x = """\n# still text\n'
+        self.assertIn('# still text', compact_code(code, strip_comments=True).code)
+
+    def test_budget_keeps_function_named_in_question(self):
+        """Over budget, the function the question names should be kept."""
+        code = 'import math\n\n' + ''.join(f'def f{i}(v):\n    return v * {i}\n\n' for i in range(500))
+        code += 'def average(values):\n    return sum(values) / len(values)\n'
+        result = compact_code(code, 'Why does average() crash?', budget_tokens=60)
+        self.assertIn('budget', result.steps)
+        self.assertIn('import math', result.code)
+        self.assertIn('def average(values):\n    return sum(values) / len(values)', result.code)
+        self.assertRegex(result.code, r'# \.\.\. lines \d+-\d+ omitted \.\.\.')
+        self.assertLessEqual(estimate_tokens(result.code), 60)
+
+    def test_budget_keeps_slice_dependencies_before_signatures(self):
+        """Over budget after slicing, dependencies should outrank signatures and the budget should hold."""
+        code = ''.join(
+            f'def helper_{i}(value, scale=1, offset=0):\n'
+            f'    result = value * scale + offset\n'
+            f'    if result > {i}:\n'
+            f'        result -= {i}\n'
+            f'    return result\n\n'
+            for i in range(300)
+        )
+        code += 'def compute_total(values):\n    return sum(helper_7(v) for v in values)\n'
+        result = compact_code(code, 'Why does compute_total() return the wrong number?', budget_tokens=4000)
+        self.assertEqual(result.steps, ['slice', 'budget'])
+        self.assertIn('def compute_total(values):', result.code)
+        self.assertIn('def helper_7(value, scale=1, offset=0):\n    result = value * scale + offset', result.code)
+        self.assertIn('        result -= 7\n', result.code)
+        self.assertLessEqual(estimate_tokens(result.code), 4000)
+
+    def test_budget_keeps_traceback_lines(self):
+        """Lines named in a pasted traceback should be kept, with original line numbers in markers."""
+        code = ''.join(f'value_{i} = {i}\n' for i in range(1, 1001))
+        question = 'Traceback (most recent call last):\n  File "main.py", line 500, in <module>\nNameError'
+        result = compact_code(code, question, budget_tokens=40)
+        self.assertIn('value_500 = 500', result.code)
+        self.assertIn('# ... lines 1-', result.code)
+        self.assertTrue(result.code.endswith('-1000 omitted ...'))
+        self.assertGreater(result.chars_removed, 10_000)
+
+    def test_budget_without_hints_keeps_the_top(self):
+        """With nothing to anchor on, the start of the file should be kept."""
+        code = ''.join(f'value_{i} = {i}\n' for i in range(1, 1001))
+        result = compact_code(code, 'What is wrong?', budget_tokens=40)
+        self.assertTrue(result.code.startswith('value_1 = 1\n'))
+
+
+class TestCodeSlicing(unittest.TestCase):
+    """Tests for the AST slicer used on large submissions."""
+
+    CODE = (
+        'import math\n'                          # 1
+        'LIMIT = 10\n'                           # 2
+        'UNUSED = 3\n'                           # 3
+        '\n'                                     # 4
+        '@cache\n'                               # 5
+        'def helper(x):\n'                       # 6
+        '    return min(x, LIMIT)\n'             # 7
+        '\n'                                     # 8
+        'def other(a, b=2) -> int:\n'            # 9
+        '    return a + b\n'                     # 10
+        '\n'                                     # 11
+        'def average(values):\n'                 # 12
+        '    return helper(sum(values)) / len(values)\n'  # 13
+        '\n'                                     # 14
+        'class Stack(list):\n'                   # 15
+        '    def __init__(self):\n'              # 16
+        '        self.top = None\n'              # 17
+        '    def push(self, x):\n'               # 18
+        '        self.append(x)\n'               # 19
+        '    def pop_twice(self):\n'             # 20
+        '        return self.pop(), self.pop()\n'  # 21
+        '\n'                                     # 22
+        'print(average([1, 2]))\n'               # 23
+    )
+
+    def test_named_function_with_dependencies(self):
+        """A named function keeps its direct dependencies; other definitions become signatures."""
+        plan = slice_code(self.CODE, 'Why is average() wrong?')
+        for line in (1, 2, 5, 6, 7, 12, 13, 23):
+            self.assertIn(line, plan.keep)
+        self.assertNotIn(3, plan.keep)
+        self.assertEqual(plan.summaries[9], (10, 'def other(a, b=2) -> int: ...  # lines 9-10'))
+        self.assertEqual(plan.summaries[15], (21, 'class Stack(list): ...  # lines 15-21'))
+
+    def test_traceback_line_targets_method(self):
+        """A traceback line inside a method keeps the class header, __init__ and that method."""
+        plan = slice_code(self.CODE, 'File "main.py", line 21, in pop_twice\nIndexError')
+        for line in (15, 16, 17, 20, 21):
+            self.assertIn(line, plan.keep)
+        self.assertEqual(plan.summaries[18], (19, '    def push(self, x): ...  # lines 18-19'))
+        self.assertEqual(plan.summaries[12][0], 13)
+
+    def test_no_slice_without_references_or_parse(self):
+        """Nothing to anchor on, or code that does not parse, gives no slice."""
+        self.assertIsNone(slice_code(self.CODE, 'What does this do?'))
+        self.assertIsNone(slice_code('def average(:\n', 'Why is average() wrong?'))
+
+    def test_code_nested_too_deeply_is_not_sliced(self):
+        """Code too deeply nested to parse gives no slice, and deep defaults get a short signature."""
+        for code in ('x=' + '1+' * 20000 + '1', 'x=' + '-' * 30000 + '1'):
+            with self.subTest(size=len(code)):
+                self.assertIsNone(slice_code(code, 'Why is x wrong?'))
+        code = 'def helper(x=' + '1 + ' * 500 + '1):\n    return x\n\ndef main():\n    return 1\n'
+        plan = slice_code(code, 'Why is main() wrong?')
+        self.assertEqual(plan.summaries[1], (2, 'def helper(...): ...  # lines 1-2'))
+
+    def test_large_submission_shrinks_by_an_order_of_magnitude(self):
+        """Sliced through compact_code(), a big multi-function file should shrink at least tenfold."""
+        body = ''.join(f'    step_{j} = value + {j}\n    if step_{j} > 10:\n        print(step_{j})\n' for j in range(15))
+        code = ''.join(f'def handler_{i}(value):\n{body}    return value\n\n' for i in range(60))
+        code += 'def total(values):\n    return sum(handler_1(v) for v in values)\n'
+        result = compact_code(code, 'Why does total() return the wrong number?', budget_tokens=4000)
+        self.assertEqual(result.steps, ['slice'])
+        self.assertGreater(result.original_chars / len(result.code), 10)
+        self.assertIn('def total(values):', result.code)
+        self.assertIn('    step_14 = value + 14', result.code)  # handler_1 kept as a dependency
+        self.assertIn('def handler_2(value): ...  # lines', result.code)
+
+
+class TestSyntaxCheck(unittest.TestCase):
+    """Tests for the local syntax-error answers."""
+
+    @staticmethod
+    def _answer(code):
+        try:
+            compile(code, '<student>', 'exec')
+        except SyntaxError as exc:
+            return build_syntax_answer(code, exc)
+        raise AssertionError('code parsed')
+
+    def test_categories(self):
+        """Common mistakes should get category-specific advice."""
+        cases = {
+            'if x == 1\n    pass\n': 'missing_colon',
+            'def f():\nreturn 1\n': 'indentation',
+            'x = (1,\ny = 2\n': 'unclosed_bracket',
+            "s = 'abc\n": 'unterminated_string',
+            "print 'hi'\n": 'print_statement',
+            'if x = 1:\n    pass\n': 'assignment_vs_comparison',
+            'a = [1 2]\n': 'missing_comma',
+            'x = \u201chi\u201d\n': 'invalid_character',
+            'for in x:\n    pass\n': 'other',
+        }
+        for code, category in cases.items():
+            with self.subTest(code=code):
+                self.assertEqual(self._answer(code)[1], category)
+
+    def test_answer_quotes_line_with_caret(self):
+        """The answer should show the offending line with a caret under the error."""
+        answer, _ = self._answer('total = 0\nif total > 1\n    pass\n')
+        self.assertIn("expected ':' (line 2, column 13)", answer)
+        self.assertIn('```python\nif total > 1\n            ^\n```', answer)
+        self.assertTrue(answer.index('1) Diagnosis') < answer.index('3) Hints') < answer.index('5) Next small step'))
+
+    def test_valid_or_missing_code_is_not_answered(self):
+        """Code that parses, or no code at all, should go to the normal path."""
+        self.assertIsNone(fast_path_answer({'code': 'x = 1\n', 'question': 'q'}, 'r1'))
+        self.assertIsNone(fast_path_answer({'code': '  \n', 'question': 'q'}, 'r2'))
+        self.assertIsNotNone(fast_path_answer({'code': 'x = (\n', 'question': 'q'}, 'r3'))
+
+    def test_deeply_nested_code_is_not_answered(self):
+        """Code too deeply nested for the parser should go to the normal path, not fail."""
+        for code in ('x=' + '1+' * 20000 + '1', 'x=' + '-' * 30000 + '1'):
+            with self.subTest(size=len(code)):
+                self.assertIsNone(fast_path_answer({'code': code, 'question': 'q'}, 'r1'))
+
+
+class TestFaqIndex(unittest.TestCase):
+    """Tests for the offline FAQ index."""
+
+    ENTRIES = [
+        {'question': 'What is a variable?', 'alternates': ['How do variables work?'], 'answer': 'variables'},
+        {'question': 'list vs tuple', 'level': 'any', 'answer': 'sequences'},
+        {'question': 'What is a decorator?', 'level': 'advanced', 'answer': 'decorators'},
+    ]
+
+    def test_normalize(self):
+        """Stopwords, case and plural s should not change the terms."""
+        self.assertEqual(faq.normalize('What are Variables?'), ['variable'])
+        self.assertEqual(faq.normalize('what is a variable'), ['variable'])
+        self.assertEqual(faq.normalize('list vs tuples, class'), ['list', 'vs', 'tuple', 'class'])
+
+    def test_lookup_scores_and_threshold(self):
+        """Paraphrases should score near 1 and unrelated questions near 0."""
+        index = faq.FaqIndex(faq.build_index(self.ENTRIES))
+        answer, score = index.lookup('How do variables work', 'beginner')
+        self.assertEqual(answer, 'variables')
+        self.assertAlmostEqual(score, 1.0, places=5)
+        self.assertEqual(index.lookup('tuple vs list?')[0], 'sequences')
+        answer, score = index.lookup('What is recursion?')
+        self.assertLess(score, 0.5)
+
+    def test_level_filtering(self):
+        """Entries for another level should not match; "any" entries always do."""
+        index = faq.FaqIndex(faq.build_index(self.ENTRIES))
+        self.assertIsNone(index.lookup('what is a decorator', 'beginner')[0])
+        self.assertEqual(index.lookup('what is a decorator', 'advanced')[0], 'decorators')
+        self.assertEqual(index.lookup('list vs tuple', 'advanced')[0], 'sequences')
+
+    def test_index_file_round_trip(self):
+        """The build command's file should map and answer like the in-memory index."""
+        with tempfile.TemporaryDirectory() as tmp:
+            corpus = os.path.join(tmp, 'faq.jsonl')
+            with open(corpus, 'w', encoding='utf-8') as fh:
+                fh.write('\n'.join(json.dumps(e) for e in self.ENTRIES) + '\n')
+            out = os.path.join(tmp, 'faq.idx')
+            self.assertEqual(faq.main(['faq.py', 'build', corpus, out]), 0)
+            index = faq.FaqIndex.open(out)
+            self.assertEqual((index.answer_count, index.doc_count), (3, 4))
+            self.assertEqual(index.lookup('variables')[0], 'variables')
+
+    def test_corpus_validation(self):
+        """Malformed corpus lines should be rejected with their line number."""
+        with tempfile.TemporaryDirectory() as tmp:
+            corpus = os.path.join(tmp, 'faq.jsonl')
+            with open(corpus, 'w', encoding='utf-8') as fh:
+                fh.write(json.dumps({'question': 'q', 'answer': 'a', 'level': 'expert'}) + '\n')
+            with self.assertRaisesRegex(ValueError, ':1: level'):
+                faq.load_corpus(corpus)
+
+    def test_shipped_corpus_loads(self):
+        """The bundled corpus should be valid and answer its own questions."""
+        entries = faq.load_corpus(faq.FAQ_CORPUS_PATH)
+        index = faq.FaqIndex(faq.build_index(entries))
+        for entry in entries:
+            with self.subTest(question=entry['question']):
+                answer, score = index.lookup(entry['question'], entry.get('level', 'any'))
+                self.assertEqual(answer, entry['answer'])
+                self.assertGreaterEqual(score, faq.FAQ_MIN_SCORE)
+
+    def test_narrower_question_does_not_match_broader_entry(self):
+        """A question adding a term the entry lacks should miss, however close the score."""
+        index = faq.FaqIndex(faq.build_index(faq.load_corpus(faq.FAQ_CORPUS_PATH)))
+        self.assertIsNotNone(index.lookup('What is a class?', 'beginner')[0])
+        self.assertEqual(index.lookup('What is a class variable?', 'beginner'), (None, 0.0))
+        with patch('faq.get_index', return_value=index):
+            fields = {'topic': '', 'code': '', 'question': 'What is a class variable?', 'level': 'beginner'}
+            self.assertIsNone(faq.faq_answer(fields, 'r1'))
+
+
+class TestContextCache(unittest.TestCase):
+    """Tests for the cached-content holder."""
+
+    def test_creates_once_and_reuses(self):
+        """The resource should be created on first use and reused until it nears expiry."""
+        create = MagicMock(return_value='cachedContents/1')
+        cache = ContextCache(create, ttl_s=3600)
+        self.assertEqual(cache.name(), 'cachedContents/1')
+        self.assertEqual(cache.name(), 'cachedContents/1')
+        create.assert_called_once_with(3600)
+        self.assertTrue(cache.snapshot()['active'])
+
+    def test_disabled_returns_none(self):
+        """A disabled cache should never create a resource."""
+        create = MagicMock(return_value='cachedContents/1')
+        cache = ContextCache(create, ttl_s=3600, enabled=False)
+        self.assertIsNone(cache.name())
+        create.assert_not_called()
+
+    def test_failure_backs_off(self):
+        """After a failed creation, callers should fall back inline without retrying immediately."""
+        create = MagicMock(side_effect=[None, 'cachedContents/2'])
+        cache = ContextCache(create, ttl_s=3600, retry_after_failure_s=300)
+        self.assertIsNone(cache.name())
+        self.assertIsNone(cache.name())
+        self.assertEqual(create.call_count, 1)
+        self.assertEqual(cache.snapshot()['failures'], 1)
+
+    def test_create_false_only_reuses(self):
+        """name(create=False) should not create a resource."""
+        create = MagicMock(return_value='cachedContents/1')
+        cache = ContextCache(create, ttl_s=3600)
+        self.assertIsNone(cache.name(create=False))
+        cache.name()
+        self.assertEqual(cache.name(create=False), 'cachedContents/1')
+        create.assert_called_once()
+
+    def test_invalidate_forgets_matching_name(self):
+        """Invalidating the current name should force a new creation."""
+        create = MagicMock(side_effect=['cachedContents/1', 'cachedContents/2'])
+        cache = ContextCache(create, ttl_s=3600)
+        cache.name()
+        cache.invalidate('cachedContents/other')
+        self.assertEqual(cache.name(), 'cachedContents/1')
+        cache.invalidate('cachedContents/1')
+        self.assertEqual(cache.name(), 'cachedContents/2')
+        self.assertEqual(cache.snapshot()['invalidations'], 1)
+
+    def test_slow_creation_does_not_hold_the_request(self):
+        """A creation slower than wait_s should leave the caller inline and finish in the background."""
+        release = threading.Event()
+        create = MagicMock(side_effect=lambda ttl_s: release.wait(5) and 'cachedContents/1')
+        cache = ContextCache(create, ttl_s=3600)
+        started = time.monotonic()
+        self.assertIsNone(cache.name(wait_s=0.05))
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertIsNone(cache.name(wait_s=0.05))  # still creating: not started twice
+        release.set()
+        for _ in range(100):
+            if cache.name(create=False):
+                break
+            time.sleep(0.01)
+        self.assertEqual(cache.name(create=False), 'cachedContents/1')
+        create.assert_called_once()
+
+    def test_wait_leaves_most_of_the_deadline_for_generation(self):
+        """Waiting for creation should be capped by the setting and by half the remaining deadline."""
+        with patch('gemini_ai.GEMINI_CONTEXT_CACHE_MAX_WAIT_S', 1.0):
+            self.assertEqual(_context_cache_wait(None), 1.0)
+            self.assertEqual(_context_cache_wait(time.monotonic() + 10), 1.0)
+            self.assertLessEqual(_context_cache_wait(time.monotonic() + 0.5), 0.25)
+            self.assertEqual(_context_cache_wait(time.monotonic() - 1), 0.0)
+
+
 class TestSanitizeTutorOutput(unittest.TestCase):
     """Tests for the sanitize_tutor_output function."""
 
@@ -188,6 +2526,110 @@ Done!"""
         self.assertIn('[Output truncated', result)
 
 
+def _regex_sanitize(text):
+    """Reference implementation: the original regex-based sanitizer."""
+    import re
+    if not text:
+        return text
+
+    def _replace_block(match):
+        if len((match.group(1) or '').splitlines()) > MAX_CODE_BLOCK_LINES:
+            return _CODE_OMITTED_NOTICE
+        return match.group(0)
+
+    text2 = re.sub(r"```(?:[\w+-]+)?\n(.*?)```", _replace_block, text, flags=re.DOTALL)
+    lines = text2.splitlines()
+    starts = ('import ', 'from ', 'def ', 'class ', 'if __name__')
+    if sum(1 for ln in lines if ln.lstrip().startswith(starts)) >= SUSPICIOUS_LINE_THRESHOLD:
+        text2 = '\n'.join(lines[:MAX_OUTPUT_LINES]) + '\n\n[Output truncated to avoid full-solution code.]'
+    return text2
+
+
+class TestFenceScanner(unittest.TestCase):
+    """Tests that the single-pass fence scanner matches the original regex."""
+
+    def test_matches_regex_on_adversarial_input(self):
+        """Adversarial fence layouts should be handled like the regex did."""
+        cases = [
+            '```py\n' * 50,
+            '```' + 'a' * 500,
+            '`' * 1000,
+            '```a ' * 100,
+            '````python\nx\n```',
+            '```c++\n' + 'x\n' * 9 + '```tail',
+            'import x ```py\n' + 'y\n' * 12 + '```\n' + 'def f():\n' * 11,
+            '```\n```',
+        ]
+        for text in cases:
+            self.assertEqual(sanitize_tutor_output(text), _regex_sanitize(text), text[:40])
+
+    def test_matches_regex_on_random_input(self):
+        """Random mixes of fences, whitespace and suspicious lines should match."""
+        import random
+        rnd = random.Random(5)
+        pieces = ['import a\n', 'def f():\n', 'x = 1\n', '```py\n', '```\n', '```', '\r\n', '\r',
+                  ' ', '\t', '\xa0', '\x85', '\x0c', 'class Z\r', '  from q\n', '``', '```a b\n']
+        for _ in range(500):
+            text = ''.join(rnd.choice(pieces) for _ in range(rnd.randint(0, 200)))
+            self.assertEqual(sanitize_tutor_output(text), _regex_sanitize(text), repr(text))
+
+
+class TestStreamingSanitizer(unittest.TestCase):
+    """Tests for the incremental StreamingSanitizer."""
+
+    @staticmethod
+    def _run(text, size):
+        sanitizer = StreamingSanitizer()
+        out = [sanitizer.feed(text[i:i + size]) for i in range(0, len(text), size)]
+        out.append(sanitizer.close())
+        return ''.join(out)
+
+    def _assert_matches_batch(self, text):
+        for size in (1, 2, 3, 7, 64, len(text) or 1):
+            self.assertEqual(self._run(text, size), sanitize_tutor_output(text) or '', (text, size))
+
+    def test_matches_batch_on_short_code(self):
+        """Short fenced code should stream through unchanged."""
+        self._assert_matches_batch("Here:\n```python\nx = 1\nprint(x)\n```\nThat's it!")
+
+    def test_matches_batch_on_long_code(self):
+        """Long fenced code should be replaced with the notice."""
+        long_code = '\n'.join(f'line{i} = {i}' for i in range(20))
+        self._assert_matches_batch(f"Solution:\n```python\n{long_code}\n```\nDone!")
+
+    def test_matches_batch_on_unterminated_fence(self):
+        """An unterminated fence should be emitted verbatim at close."""
+        self._assert_matches_batch("Start ```py\nx = 1\n" + "y\n" * 20 + "`` and ` end")
+
+    def test_matches_batch_on_truncation(self):
+        """Suspicious unfenced output should be truncated identically."""
+        lines = [f'import module{i}' for i in range(20)] + [f'x{i} = {i}' for i in range(150)]
+        self._assert_matches_batch('\n'.join(lines))
+        self._assert_matches_batch('\r\n'.join(lines[:40]))
+        self._assert_matches_batch('Intro\n' + '\n'.join(lines[:15]) + '\nEnd.')
+
+    def test_matches_batch_on_random_input(self):
+        """Randomly composed outputs should match the batch function."""
+        import random
+        rnd = random.Random(42)
+        pieces = ['import a\n', 'def f():\n', 'x = 1\n', '```py\n', '```\n', '```', 'text\r\n', '\r', ' ', '`']
+        for _ in range(300):
+            self._assert_matches_batch(''.join(rnd.choice(pieces) for _ in range(rnd.randint(0, 120))))
+
+    def test_emits_plain_text_immediately(self):
+        """Plain prose should not be held back."""
+        sanitizer = StreamingSanitizer()
+        self.assertEqual(sanitizer.feed('Diagnosis: the loop'), 'Diagnosis: the loop')
+        self.assertEqual(sanitizer.feed(' never ends.\nWhy'), ' never ends.\nWhy')
+        self.assertEqual(sanitizer.close(), '')
+
+    def test_holds_open_fence_until_closed(self):
+        """An open fence should be held until it is known to be short."""
+        sanitizer = StreamingSanitizer()
+        self.assertEqual(sanitizer.feed('Look:\n```python\nx = 1\n'), 'Look:\n')
+        self.assertEqual(sanitizer.feed('```\nok'), '```python\nx = 1\n```\nok')
+
+
 class TestModuleIntegration(unittest.TestCase):
     """Integration tests for module connectivity."""
 
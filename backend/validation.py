@@ -0,0 +1,62 @@
+"""
+Request validation for the AI Python Teacher backend.
+
+Shared by the Flask (WSGI) and ASGI entry points so both apply the same
+rules to tutoring requests.
+"""
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from config import REQUEST_DEADLINE_S
+
+# Maximum number of characters accepted in the 'code' field
+MAX_CODE_CHARS = 80_000
+
+
+def validate_ask_fields(body: Dict[str, Any]) -> Tuple[Optional[Dict[str, str]], Optional[Tuple[int, str]]]:
+    """
+    Normalize and validate the fields of a tutoring request body.
+
+    Args:
+        body: The decoded JSON request body
+
+    Returns:
+        A tuple of (fields, error). On success, fields holds topic, code,
+        question and level as strings. On failure, error is (status, message).
+    """
+    if not isinstance(body, dict):
+        body = {}
+    fields = {
+        "topic": str(body.get("topic") or "").strip(),
+        "code": str(body.get("code") or ""),
+        "question": str(body.get("question") or "").strip(),
+        "level": str(body.get("level") or "beginner").strip(),
+    }
+    if not fields["question"]:
+        return None, (400, "Field 'question' is required.")
+    if len(fields["code"]) > MAX_CODE_CHARS:
+        return None, (413, "Field 'code' is too large.")
+    return fields, None
+
+
+def resolve_deadline(header_value: Optional[str]) -> Optional[float]:
+    """
+    Work out the time.monotonic() deadline for a request.
+
+    The budget is REQUEST_DEADLINE_S, tightened by a positive X-Deadline-Ms
+    header value; clients cannot extend it past the configured limit.
+
+    Args:
+        header_value: The raw X-Deadline-Ms header, if any
+
+    Returns:
+        The deadline, or None when no budget applies
+    """
+    budget_s: Optional[float] = REQUEST_DEADLINE_S if REQUEST_DEADLINE_S > 0 else None
+    try:
+        header_s = int(header_value) / 1000 if header_value else 0
+    except ValueError:
+        header_s = 0
+    if header_s > 0:
+        budget_s = header_s if budget_s is None else min(budget_s, header_s)
+    return None if budget_s is None else time.monotonic() + budget_s
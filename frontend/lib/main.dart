@@ -1,5 +1,6 @@
 import 'dart:async';
 import 'dart:convert';
+import 'dart:math';
 
 import 'package:flutter/material.dart';
 import 'package:http/http.dart' as http;
@@ -93,6 +94,15 @@ for i in range(len(nums)):
 
   void _code_controller_dispose() => _codeController.dispose();
 
+  static final Random _random = Random.secure();
+
+  /// A random id sent as X-Request-Id; kept for all retries of one request
+  /// so the backend can replay the answer instead of asking Gemini again.
+  String _newRequestId() {
+    final bytes = List<int>.generate(16, (_) => _random.nextInt(256));
+    return bytes.map((b) => b.toRadixString(16).padLeft(2, '0')).join();
+  }
+
   Future<Map<String, dynamic>> _postJsonWithRetry(
     Uri url,
     Map<String, dynamic> payload,
@@ -104,6 +114,7 @@ for i in range(len(nums)):
       const Duration(seconds: 4),
     ];
 
+    final requestId = _newRequestId();
     Object? lastError;
 
     for (var i = 0; i < delays.length; i++) {
@@ -115,9 +126,10 @@ for i in range(len(nums)):
         final resp = await _http
             .post(
               url,
-              headers: const {
+              headers: {
                 'Content-Type': 'application/json',
                 'Accept': 'application/json',
+                'X-Request-Id': requestId,
               },
               body: jsonEncode(payload),
             )